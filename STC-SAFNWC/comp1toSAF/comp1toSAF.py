@@ -48,6 +48,7 @@ import SAFNWCnc
 from io107 import readidx107
 import geosat
 import constants as cst
+from background import background
 
 # misc parameters
 # step in the cloudtop procedure
@@ -140,13 +141,17 @@ def main():
     satmap1 = pixmap(gg,'1')
     satfill = {}
 
-    # Build the satellite field generator
-    get_sat1 = {'MSG1': read_sat1(sdate,satmap1.zone['MSG1']['dtRange1'],satdir1['MSG1'],pre=True),\
-                'Hima': read_sat1(sdate,satmap1.zone['Hima']['dtRange1'],satdir1['Hima'],pre=True)}
+    # Build the satellite field generators, read in background threads
+    # (only the processed zones as the readers start immediately)
+    get_sat1 = {'MSG1': background(read_sat1(sdate,satmap1.zone['MSG1']['dtRange1'],satdir1['MSG1'],pre=True))}
+    if doHima:
+        get_sat1['Hima'] = background(read_sat1(sdate,satmap1.zone['Hima']['dtRange1'],satdir1['Hima'],pre=True))
     #get_satSAF = {'MSG1': read_satSAF(sdate,'MSG1',satmapSAF.zone['MSG1']['dtRangeSAF'],satdirSAF['MSG1'],pre=True),\
     #              'Hima': read_satSAF(sdate,'Hima',satmapSAF.zone['Hima']['dtRangeSAF'],satdirSAF['Hima'],pre=True)}
-    get_satSAF = {'MSG1': read_satSAF(sdate,'MSG1',satmapSAF.zone['MSG1']['dtRangeSAF'],pre=True),\
-                  'Hima': read_satSAF(sdate,'Hima',satmapSAF.zone['Hima']['dtRangeSAF'],pre=True)}
+    # The SAF images are also regridded in the background
+    get_satSAF = {'MSG1': background(read_gridSAF(sdate,'MSG1',satmapSAF.zone['MSG1']['dtRangeSAF'],gg,pre=True))}
+    if doHima:
+        get_satSAF['Hima'] = background(read_gridSAF(sdate,'Hima',satmapSAF.zone['Hima']['dtRangeSAF'],gg,pre=True))
     current_date = sdate
 
     """ Main loop on the output time steps """
@@ -183,29 +188,11 @@ def main():
             
         while satmapSAF.check('MSG1',current_date) is False:
             # if not get next satellite image 
-            datsatm = next(get_satSAF['MSG1'])
+            pmm = next(get_satSAF['MSG1'])
             # Check that the image is available
-            if datsatm is not None:
+            if pmm is not None:
                 # all the data need to be read because of possible gaps 
                 # and extensions to be done in such cases
-                pmm = geosat.SatGrid(datsatm,gg)
-                pmm._sat_togrid('CTTH_PRESS')
-                #print('pm1 diag',len(datsat1.var['CTTH_PRESS'][:].compressed()),
-                #                 len(pm1.var['CTTH_PRESS'][:].compressed()))
-                pmm._sat_togrid('ctth_alti')
-                pmm._sat_togrid('ctth_tempe')
-                pmm._sat_togrid('ctth_quality')
-                pmm._sat_togrid('ctth_conditions')
-                pmm._sat_togrid('ctth_status_flag')
-                pmm._sat_togrid('ctth_method')
-                pmm._sat_togrid('CT')
-                pmm._sat_togrid('ct_cumuliform')
-                pmm._sat_togrid('ct_multilayer')
-                pmm._sat_togrid('ct_status_flag')
-                pmm._sat_togrid('CMa')
-                pmm._sat_togrid('cma_status_flag')
-                pmm._sat_togrid('cma_quality')
-                pmm.attr = datsatm.attr.copy()
                 satmapSAF.fillSAF('MSG1',pmm)
                 del pmm
                 #del datsat1
@@ -224,34 +211,10 @@ def main():
         if doHima:                
             while satmapSAF.check('Hima',current_date) is False:
                 # if not get next satellite image 
-                datsath = next(get_satSAF['Hima'])
+                pmh = next(get_satSAF['Hima'])
                 # Check that the image is available
-                if datsath is not None:
-                    # not elegant as it duplicates the while test but saves 
-                    # some processing
-                    #if (current_date <= datsath.attr['lease_time']) | \
-                    #   (current_date > datsath.attr['date']): continue
-                    # not a good odea when some image is missing
-                    pmh = geosat.SatGrid(datsath,gg)
-                    pmh._sat_togrid('CTTH_PRESS')
-                    #print('pmh diag',len(datsath.var['CTTH_PRESS'][:].compressed()),
-                    #                 len(pmh.var['CTTH_PRESS'][:].compressed()))
-                    pmh._sat_togrid('ctth_tempe')
-                    pmh._sat_togrid('ctth_alti')
-                    pmh._sat_togrid('ctth_quality')
-                    pmh._sat_togrid('ctth_conditions')
-                    pmh._sat_togrid('ctth_status_flag')
-                    pmh._sat_togrid('ctth_method')
-                    pmh._sat_togrid('CT')
-                    pmh._sat_togrid('ct_cumuliform')
-                    pmh._sat_togrid('ct_multilayer')
-                    pmh._sat_togrid('ct_status_flag')
-                    pmh._sat_togrid('CMa')
-                    pmh._sat_togrid('cma_status_flag')
-                    pmh._sat_togrid('cma_quality')
-                    pmh.attr = datsath.attr
+                if pmh is not None:
                     satmapSAF.fillSAF('Hima',pmh)
-                    #del datsath
                     del pmh
                 else:
                     # if the image is missing, extend the leaseof previous image
@@ -360,54 +323,74 @@ def read_satSAF(t0,sat,dtRange,pre=False):
         #    print('sat should be MSG1 or Hima')
         #    return
         try:
-            if NewSAF:             
-                dat = SAFNWCnc.SAFNWC_CTTH(current_time,namesat[sat],BBname='SAFBox')
-                dat_ct = SAFNWCnc.SAFNWC_CT(current_time,namesat[sat],BBname='SAFBox')
-                dat_cma = SAFNWCnc.SAFNWC_CMa(current_time,namesat[sat],BBname='SAFBox')
-            else:
-                dat = SAFNWCnc.SAFNWC_CTTH(current_time,namesat[sat])
-                dat_ct = SAFNWCnc.SAFNWC_CT(current_time,namesat[sat])
-                dat_cma = SAFNWCnc.SAFNWC_CMa(current_time,namesat[sat])
-            dat._CTTH_PRESS()
-            # This pressure i left in hPa to allow masked with the fill_value in sat_togrid
-            # The conversion to Pa is made in fill
-            dat.attr['dtRange'] = dt
-            # if pre, the validity interval follows the time of the satellite image
-            # if not pre (default) the validity interval is before 
-            if pre:
-               dat.attr['lease_time'] = current_time 
-               dat.attr['date'] = current_time + dtRange
-            else:
-               dat.attr['lease_time'] = current_time - dtRange
-               dat.attr['date'] = current_time
-            dat._get_var('ctth_alti')
-            dat._get_var('ctth_tempe')
-            dat._get_var('ctth_status_flag')
-            dat._get_var('ctth_conditions')
-            dat._get_var('ctth_quality')
-            dat._get_var('ctth_method')
-            dat.close()
-            dat_ct._CT()
-            dat_ct._get_var('ct_cumuliform')
-            dat_ct._get_var('ct_multilayer')
-            dat_ct._get_var('ct_status_flag')
-            dat.var['CT'] = dat_ct.var['CT']
-            dat.var['ct_cumuliform'] = dat_ct.var['ct_cumuliform']
-            dat.var['ct_multilayer'] = dat_ct.var['ct_multilayer']
-            dat.var['ct_status_flag'] = dat_ct.var['ct_status_flag']
-            dat_ct.close()
-            dat_cma._CMa()
-            dat_cma._get_var('cma_status_flag')
-            dat_cma._get_var('cma_quality')
-            dat.var['CMa'] = dat_cma.var['CMa']
-            dat.var['cma_status_flag'] = dat_cma.var['cma_status_flag']
-            dat.var['cma_quality'] = dat_cma.var['cma_quality']
-            dat_cma.close()
+            with SAFNWCnc.nc_lock:
+                if NewSAF:             
+                    dat = SAFNWCnc.SAFNWC_CTTH(current_time,namesat[sat],BBname='SAFBox')
+                    dat_ct = SAFNWCnc.SAFNWC_CT(current_time,namesat[sat],BBname='SAFBox')
+                    dat_cma = SAFNWCnc.SAFNWC_CMa(current_time,namesat[sat],BBname='SAFBox')
+                else:
+                    dat = SAFNWCnc.SAFNWC_CTTH(current_time,namesat[sat])
+                    dat_ct = SAFNWCnc.SAFNWC_CT(current_time,namesat[sat])
+                    dat_cma = SAFNWCnc.SAFNWC_CMa(current_time,namesat[sat])
+                dat._CTTH_PRESS()
+                # This pressure i left in hPa to allow masked with the fill_value in sat_togrid
+                # The conversion to Pa is made in fill
+                dat.attr['dtRange'] = dt
+                # if pre, the validity interval follows the time of the satellite image
+                # if not pre (default) the validity interval is before 
+                if pre:
+                   dat.attr['lease_time'] = current_time 
+                   dat.attr['date'] = current_time + dtRange
+                else:
+                   dat.attr['lease_time'] = current_time - dtRange
+                   dat.attr['date'] = current_time
+                dat._get_var('ctth_alti')
+                dat._get_var('ctth_tempe')
+                dat._get_var('ctth_status_flag')
+                dat._get_var('ctth_conditions')
+                dat._get_var('ctth_quality')
+                dat._get_var('ctth_method')
+                dat.close()
+                dat_ct._CT()
+                dat_ct._get_var('ct_cumuliform')
+                dat_ct._get_var('ct_multilayer')
+                dat_ct._get_var('ct_status_flag')
+                dat.var['CT'] = dat_ct.var['CT']
+                dat.var['ct_cumuliform'] = dat_ct.var['ct_cumuliform']
+                dat.var['ct_multilayer'] = dat_ct.var['ct_multilayer']
+                dat.var['ct_status_flag'] = dat_ct.var['ct_status_flag']
+                dat_ct.close()
+                dat_cma._CMa()
+                dat_cma._get_var('cma_status_flag')
+                dat_cma._get_var('cma_quality')
+                dat.var['CMa'] = dat_cma.var['CMa']
+                dat.var['cma_status_flag'] = dat_cma.var['cma_status_flag']
+                dat.var['cma_quality'] = dat_cma.var['cma_quality']
+                dat_cma.close()
         except FileNotFoundError:
             print('SAF file not found ',current_time,namesat[sat])
             dat = None
         current_time -= dtRange
         yield dat
+
+# Variables of the SAF images regridded on the pixmap grid
+SAF_vars = ['CTTH_PRESS','ctth_alti','ctth_tempe','ctth_quality','ctth_conditions',
+            'ctth_status_flag','ctth_method','CT','ct_cumuliform','ct_multilayer',
+            'ct_status_flag','CMa','cma_status_flag','cma_quality']
+
+def read_gridSAF(t0,sat,dtRange,gg,pre=False):
+    """ Generator of the satellite data of read_satSAF regridded on gg,
+    or None for a missing image """
+    for datsat in read_satSAF(t0,sat,dtRange,pre=pre):
+        if datsat is None:
+            yield None
+            continue
+        pm = geosat.SatGrid(datsat,gg)
+        for var in SAF_vars:
+            pm._sat_togrid(var)
+        pm.attr = datsat.attr.copy()
+        del datsat
+        yield pm
         
 #%%
 """ Describe the pixel map that contains slice of cloudtop data """
@@ -4,6 +4,15 @@
 Calculates the cold point temperature and pressure and store them in the TPP directory
 as hdf5 files.
 
+The hours of a month are processed by a pool of worker processes, each reading
+its ECMWF file and computing the cold point and WMO tropopauses independently.
+Each worker holds a full ERA5 field, so the default is a few workers, and the
+cores are shared among the numba kernels of the workers.
+
+Usage:
+python mkTPP.py -y 2017 -m 8 -w 4
+mkTPP_range(date1,date2,workers=4) can also be called from another script
+
 Created on Mon June 4 2018
 Modified on Mon 15 Februray 2020 to add WMO topopause
 
@@ -11,15 +20,18 @@ Modified on Mon 15 Februray 2020 to add WMO topopause
 """
 
 import os
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numba
 from ECMWF_N import ECMWF
 from datetime import datetime, timedelta
 import flammkuchen as fl
 
 maindir = '/data/legras/flexpart_in/STC/ERA5/TPP/HR'
 
-date = datetime(2017,8,1,0)
-
-while date < datetime(2017,9,1,0):
+def mkTPP(date):
+    """ Calculates and stores the tropopauses of one date """
     print('processing ',date)
     outfile = date.strftime('TPP%y%m%d%H.hdf5')
     fullname = os.path.join(maindir,date.strftime('%Y/%m'),outfile)
@@ -40,4 +52,43 @@ while date < datetime(2017,9,1,0):
     tpp['lons'] = fdd.attr['lons']
     tpp['date'] = fdd.date
     fl.save(fullname,tpp,compression='zlib')
-    date += timedelta(hours=1)
+    return fullname
+
+def init_worker(nthreads):
+    """ Limits the number of threads of the numba kernels in a worker """
+    numba.set_num_threads(nthreads)
+
+def mkTPP_range(date1,date2,step=timedelta(hours=1),workers=1):
+    """ Processes the dates from date1 (included) to date2 (excluded) """
+    dates = []
+    date = date1
+    while date < date2:
+        dates.append(date)
+        date += step
+    if workers <= 1:
+        for date in dates:
+            mkTPP(date)
+        return
+    # spawn as the numba threads of the parent must not be forked
+    nthreads = max(1,os.cpu_count()//workers)
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker,initargs=(nthreads,)) as pool:
+        for fullname in pool.map(mkTPP,dates):
+            print('written ',fullname)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-y","--year",type=int,help="year")
+    parser.add_argument("-m","--month",type=int,choices=range(1,13),help="month")
+    parser.add_argument("-w","--workers",type=int,help="number of worker processes")
+
+    year = 2017
+    month = 8
+    workers = min(4,os.cpu_count())
+    args = parser.parse_args()
+    if args.year is not None: year = args.year
+    if args.month is not None: month = args.month
+    if args.workers is not None: workers = args.workers
+
+    mkTPP_range(datetime(year,month,1,0),datetime(year+month//12,month%12+1,1,0),workers=workers)
@@ -20,7 +20,7 @@ import matplotlib.colorbar as clb
 from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
 import cartopy.crs as ccrs
 from scipy.ndimage import gaussian_filter
-import deepdish as dd
+from prodstore import load_prod
 import socket
 from os.path import join
 import constants as cst
@@ -129,7 +129,8 @@ def main():
         months = 'Jul-Aug'
 
     for fname in fnames:
-        ended = dd.io.load(fname)
+        # read only the fields used here
+        ended = load_prod(fname,fields=['flag_source','src/x','src/y','src/t','src/p','src/age'])
 
         # %% The new calculation has additional steps / analys.py due to the
         # introduction of the filtering and the theta distribution of the sources.
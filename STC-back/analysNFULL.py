@@ -9,7 +9,7 @@ import pickle, gzip
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 from mpl_toolkits.basemap import Basemap
-import deepdish as dd
+from prodstore import load_prod
 import socket
 from os.path import join
 # flags
@@ -70,7 +70,8 @@ def main():
     
     i=0
     for fname in [fname1,fname2]:   
-        ended = dd.io.load(fname)
+        # read only the fields used here
+        ended = load_prod(fname,fields=['flag_source','src/x','src/y'])
     
         # number of parcels launched per bin
         bin_size = int(len(ended['src']['x'])/bloc_size)
@@ -17,45 +17,30 @@ Modified to process BCK runs 2 March 2018
 import socket
 import numpy as np
 from collections import defaultdict
-from numba import jit
+from numba import jit, prange
 from datetime import datetime, timedelta
 import os
-import deepdish as dd
 import pickle
 #import pickle, gzip
 import sys
 import argparse
-import psutil
 
-from io107 import readpart107, readidx107
-p0 = 100000.
-I_DEAD = 0x200000
-I_HIT = 0x400000
-I_OLD = 0x800000
-I_CROSSED = 0x2000000
-I_DBORNE =  0x1000000
-I_STOP = I_HIT + I_DEAD
+from io107 import readidx107
+from prodstore import save_prod_or_pickle
+from backsrc import BackEngine, HitKernel, p0, I_DEAD, I_HIT, I_STOP
+from background import background
 
 # misc parameters
 # step in the cloudtop procedure
 cloudtop_step = timedelta(hours=12)
-# low p cut in the M55 traczilla runs
-lowpcut = 3000
-# highpcut in the M55 traczilla runs
-highpcut = 50000
-
 # if True print a lot oj junk
 verbose = False
 debug = True
 
-# idx_orgn was not set to 1 but to 0 in M55 and GLO runs
-IDX_ORGN = 0
-
 #%%
 """@@@@@@@@@@@@@@@@@@@@@@@@   MAIN   @@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@"""
 
 def main():
-    global IDX_ORGN
     parser = argparse.ArgumentParser()
     parser.add_argument("-y","--year",type=int,help="year")
     parser.add_argument("-m","--month",type=int,choices=1+np.arange(12),help="month")
@@ -63,6 +48,8 @@ def main():
     parser.add_argument("-l","--level",type=int,help="PT level")
     parser.add_argument("-s","--suffix",type=str,help="suffix for special cases")
     parser.add_argument("-q","--quiet",type=str,choices=["y","n"],help="quiet (y) or not (n)")
+    parser.add_argument("-r","--resume",action='store_true',help="restart from the last checkpoint")
+    parser.add_argument("-j","--threads",type=int,help="number of threads of the numba kernels")
 
     # to be updated
     if socket.gethostname() == 'graphium':
@@ -85,15 +72,16 @@ def main():
     # step and max output time
     step = 6
     hmax = 1824
-    dstep = timedelta (hours=step)
     # age limit in days
     age_bound = 44.
+    # step in hours between two checkpoints
+    checkpoint_step = 120
+    # number of threads of the numba kernels
+    threads = 1
     # time width of the parcel slice
     slice_width = timedelta(minutes=5)
     # dtRange
     dtRange={'MSG1':timedelta(minutes=30),'Hima':timedelta(minutes=20)}
-    # number of slices between two outputs
-    nb_slices = int(dstep/slice_width)
     # default values of parameters
     # start date of the backward run, corresponding to itime=0 
     year=2017
@@ -114,6 +102,8 @@ def main():
         advect=args.advect
     if args.level is not None:
         level=args.level
+    if args.threads is not None:
+        threads=args.threads
     if args.suffix is not None:
         suffix='-'+args.suffix
     if args.quiet is not None:
@@ -157,8 +147,9 @@ def main():
 
     # Output file
     out_file = os.path.join(out_dir,'BACK-'+advect+fdate.strftime('-%b-%Y-')+str(level)+'K'+suffix+'.hdf5z')
-    out_file1 = os.path.join(out_dir,'BACK-'+advect+fdate.strftime('-%b-%Y-')+str(level)+'K'+suffix+'.hdf5b')
     out_file2 = os.path.join(out_dir,'BACK-'+advect+fdate.strftime('-%b-%Y-')+str(level)+'K'+suffix+'.pkl')
+    # Checkpoint file
+    ckpt_file = os.path.join(out_dir,'BACK-'+advect+fdate.strftime('-%b-%Y-')+str(level)+'K'+suffix+'.ckpt')
 
     # Directories for the satellite cloud top files
     satdir ={'MSG1':os.path.join(main_sat_dir,'StratoClim+1kmD_msg1-c'),\
@@ -167,296 +158,21 @@ def main():
     """ Initialization of the calculation """
     # Initialize the slice map to be used as a buffer for the cloudtops
     satmap = pixmap()
-    satfill = {}
-    datsat = {}
-    # Initialize the dictionary of the parcel dictionaries
-    partStep={}
-
-    # Build the satellite field generator
-    get_sat = {'MSG1': read_sat(sdate,dtRange['MSG1'],satdir['MSG1']),\
-               'Hima': read_sat(sdate,dtRange['Hima'],satdir['Hima'])}
-
-    # Open the part_000 file that contains the initial positions
-    part0 = readidx107(os.path.join(ftraj,'part_000'),quiet=True)
-    print('numpart',part0['numpart'])
-    numpart = part0['numpart']
-    numpart_s = granule_size
-  
-    # stamp_date not set in these runs
-    # current_date actually shifted by one day / sdate
-    current_date = sdate
-    # check flag is clean
-    print('check flag is clean ',((part0['flag']&I_HIT)!=0).sum(),((part0['flag']&I_DEAD)!=0).sum(),\
-                                 ((part0['flag']&I_CROSSED)!=0).sum())
-    # check idx_orgn
-    if part0['idx_orgn'] != 0:
-        print('MINCHIA, IDX_ORGN NOT 0 AS ASSUMED, CORRECTED WITH READ VALUE')
-        print('VALUE ',part0['idx_orgn'])
-        IDX_ORGN = part0['idx_orgn']
-    idx1 = IDX_ORGN
-
-    # Build a dictionary to host the results
-    prod0 = defaultdict(dict)
-    prod0['src']['x'] = np.full(part0['numpart'],fill_value=np.nan,dtype='float')
-    prod0['src']['y'] = np.full(part0['numpart'],fill_value=np.nan,dtype='float')
-    prod0['src']['p'] = np.full(part0['numpart'],fill_value=np.nan,dtype='float')
-    prod0['src']['t'] = np.full(part0['numpart'],fill_value=np.nan,dtype='float')
-    prod0['src']['age'] = np.full(part0['numpart'],fill_value=np.nan,dtype='int')
-    prod0['flag_source'] = part0['flag']
-    prod0['rvs'] = np.full(part0['numpart'],0.01,dtype='float')
-    
-    # truncate eventually to 32 bits at the output stage
-
-    # read the part_000 file for the first granule
-    partStep[0] = {}
-    partStep[0]['x']=part0['x'][:granule_size]
-    partStep[0]['y']=part0['y'][:granule_size]
-    partStep[0]['t']=part0['t'][:granule_size]
-    partStep[0]['p']=part0['p'][:granule_size]
-    partStep[0]['t']=part0['t'][:granule_size]
-    partStep[0]['idx_back']=part0['idx_back'][:granule_size]
-    partStep[0]['ir_start']=part0['ir_start'][:granule_size]
-    partStep[0]['itime'] = 0
-
-    # number of hists and exits
-    nhits = 0
-    nexits = 0
-    ndborne = 0
-    nnew = granule_size
-    nold = 0
-
-    # used to get non borne parcels
-    new = np.empty(part0['numpart'],dtype='bool')
-    new.fill(False)
-
-    print('Initialization completed')
-
-
-    """ Main loop on the output time steps """
-    for hour in range(step,hmax+1,step):
-        pid = os.getpid()
-        py = psutil.Process(pid)
-        memoryUse = py.memory_info()[0]/2**30
-        print('memory use: {:4.2f} gb'.format(memoryUse))
-        # Get rid of dictionary no longer used
-        if hour >= 2*step: del partStep[hour-2*step]
-      
-        # Read the new data
-        partStep[hour] = readpart107(hour,ftraj,quiet=True)
-        # Link the names
-        partante = partStep[hour-step]
-        partpost = partStep[hour] 
-        
-        if partpost['nact']>0:
-            print('hour ',hour,'  numact ', partpost['nact'], '  max p ',partpost['p'].max())
-        else:
-            print('hour ',hour,'  numact ', partpost['nact'])
-        # New date valid for partpost
-        current_date -= dstep
-        
-        # Processing of water mixing ratio
-        # Select non stopped parcels in partante
-        selec = (prod0['flag_source'][partante['idx_back']-IDX_ORGN] & I_STOP) == 0
-        idx = partante['idx_back'][selec]
-        prod0['rvs'][idx-IDX_ORGN] = np.minimum(prod0['rvs'][idx-IDX_ORGN],\
-                satratio(partante['p'][selec],partante['t'][selec]))
-             
-        """ Select the parcels that are common to the two steps
-        ketp_a is a logical field with same length as partante
-        kept_p is a logical field with same length as partpost
-        """
-        kept_a = np.in1d(partante['idx_back'],partpost['idx_back'],assume_unique=True)
-        kept_p = np.in1d(partpost['idx_back'],partante['idx_back'],assume_unique=True)
-        #new_p = ~np.in1d(partpost['idx_back'],partpost['idx_back'],assume_unique=True)
-        print('kept a, p ',len(kept_a),len(kept_p),kept_a.sum(),kept_p.sum(),'  new ',len(partpost['x'])-kept_p.sum())
-        nnew += len(partpost['x'])-kept_p.sum()
-            
-        """ PROCESSING OF DEADBORNE PARCELS
-        Manage the parcels launched during the last 6-hour which have already
-        exited and do not appear in posold or posact (borne dead parcels).
-        These parcels are stored in the last part of posact, at most
-        the last granule_quanta parcels. """
-        if numpart_s < numpart :
-            print("manage deadborne",flush=True)
-            # First index of the current quanta """
-            numpart_s += granule_quanta
-            print("idx1",idx1," numpart_s",numpart_s) 
-            # Extract the last granule_size indexes from posacti, this is where the new parcels should be
-            if hour==step:
-                idx_act = partpost['idx_back']
-            else:
-                idx_act = partpost['idx_back'][-granule_quanta:]
-            # Generate the list of indexes that should be found in this range
-            # ACHTUNG ACHTUNG : this works because IDX_ORGN=1, FIX THAT
-            idx_theor = np.arange(idx1,numpart_s+IDX_ORGN)
-            # Find the missing indexes in idx_act (make a single line after validation)
-            kept_borne = np.in1d(idx_theor,idx_act,assume_unique=True)
-            idx_deadborne = idx_theor[~kept_borne]
-            # Process these parcels by assigning exit at initial location
-            prod0['flag_source'][idx_deadborne-IDX_ORGN] = prod0['flag_source'][idx_deadborne-IDX_ORGN] | I_DEAD+I_DBORNE
-            prod0['src']['x'][idx_deadborne-IDX_ORGN] = part0['x'][idx_deadborne-IDX_ORGN]
-            prod0['src']['y'][idx_deadborne-IDX_ORGN] = part0['y'][idx_deadborne-IDX_ORGN]
-            prod0['src']['p'][idx_deadborne-IDX_ORGN] = part0['p'][idx_deadborne-IDX_ORGN]
-            prod0['src']['t'][idx_deadborne-IDX_ORGN] = part0['t'][idx_deadborne-IDX_ORGN]
-            prod0['src']['age'][idx_deadborne-IDX_ORGN] = 0.
-            print("number of deadborne ",len(idx_deadborne))
-            ndborne += len(idx_deadborne)
-            idx1 = numpart_s + IDX_ORGN              
-
-        """ PROCESSING OF CROSSED PARCELS """
-        if len(kept_a)>0:
-            exits = exiter(int((partante['itime']+partpost['itime'])/2), \
-                partante['x'][~kept_a],partante['y'][~kept_a],partante['p'][~kept_a],\
-                partante['t'][~kept_a],partante['idx_back'][~kept_a],\
-                prod0['flag_source'],prod0['src']['x'],prod0['src']['y'],\
-                prod0['src']['p'],prod0['src']['t'],prod0['src']['age'],\
-                part0['ir_start'], satmap.range)
-            nexits += exits
-            print('exit ',nexits, exits, np.sum(~kept_a), len(kept_a) - len(kept_p))
-
-        """ PROCESSING OF PARCELS WHICH ARE COMMON TO THE TWO OUTPUTS  """
-        # Select the kept parcels which have not been hit yet
-        # !!! Never use and between two lists, the result is wrong
-
-        if kept_p.sum()==0:
-            live_a = live_p = kept_p
-        else:
-            live_a = np.logical_and(kept_a,(prod0['flag_source'][partante['idx_back']-IDX_ORGN] & I_DEAD) == 0)
-            live_p = np.logical_and(kept_p,(prod0['flag_source'][partpost['idx_back']-IDX_ORGN] & I_DEAD) == 0)
-        print('live a, p ',live_a.sum(),live_p.sum())
-        del kept_a
-        del kept_p
-        
-        """ Correction step that moves partante['x'] to avoid big jumps at the periodicity frontier on the x-axis """
-        diffx = partpost['x'][live_p] - partante['x'][live_a]
-        bb = np.zeros(len(diffx))
-        bb[diffx>180] = 360
-        bb[diffx<-180] = -360
-        partante['x'][live_a] += bb
-        del bb
-        del diffx
-        # DOES not work in the following WAY
-        #partante['x'][live_a][diffx>180] += 360
-        #partante['x'][live_a][diffx<-180] -= 360        
-
-        # Build generator for parcel locations of the 5' slices
-        gsp = get_slice_part(partante,partpost,live_a,live_p,current_date,dstep,slice_width)
-        if verbose: print('built parcel generator for ',current_date)
-
-        """  MAIN LOOP ON THE PARCEL TIME SLICES  """
-
-        for i in range(nb_slices):
-            # get the slice for the particles
-            datpart = next(gsp)
-            if verbose: print('part slice ',i, datpart['time'])
-            # Make sure the present satellite slice is OK
-            # The while should ensure that the run synchronizes
-            # when it starts.
-            while satmap.check('MSG1',datpart['time']) is False:
-                # if not get next satellite slice
-                try:
-                    void = next(satfill['MSG1'])
-                # read new satellite file if the slice generator is over
-                # make a new slice generator and get first slice
-                except:
-                    datsat['MSG1'] = next(get_sat['MSG1'])
-                    satfill['MSG1'] = satmap.fill('MSG1',datsat)
-                    void = next(satfill['MSG1'])
-                finally:
-                    if verbose: print('check MSG1 ',satmap.check('MSG1',datpart['time']),'##',datpart['time'],
-                          '##',satmap.zone['MSG1']['ti'],'##',satmap.zone['MSG1']['tf'])
-            while satmap.check('Hima',datpart['time']) is False:
-                try:
-                    void = next(satfill['Hima'])
-                except:
-                    datsat['Hima'] = next(get_sat['Hima'])
-                    satfill['Hima'] = satmap.fill('Hima',datsat)
-                    void = next(satfill['Hima'])
-                finally:
-                    if verbose: print('check Hima ',satmap.check('Hima',datpart['time']),'##',datpart['time'],
-                          '##',satmap.zone['Hima']['ti'],'##',satmap.zone['Hima']['tf'])
-            
-            """ Select the parcels located within the domain """
-             # TODO TODO the values used here should be derived from parameters defined above
-            indomain = np.all((datpart['x']>-10,datpart['x']<160,datpart['y']>0,datpart['y']<50),axis=0)
-            
-            """ PROCESS THE COMPARISON OF PARCEL PRESSURES TO CLOUDS """
-            if indomain.sum() >0:
-                nhits += convbirth(datpart['itime'],
-                    datpart['x'][indomain],datpart['y'][indomain],datpart['p'][indomain],\
-                    datpart['t'][indomain],datpart['idx_back'][indomain],\
-                    prod0['flag_source'],prod0['src']['x'],prod0['src']['y'],\
-                    prod0['src']['p'],prod0['src']['t'],prod0['src']['age'],\
-                    satmap.ptop, part0['ir_start'],\
-                    satmap.range[0,0],satmap.range[1,0],satmap.stepx,satmap.stepy,satmap.binx,satmap.biny)
-
-            sys.stdout.flush()
-            
-            """ End of of loop on slices """
-
-        # Check the age limit (easier to do it here)
-        print("Manage age limit",flush=True)
-        age_sec = part0['ir_start'][partante['idx_back']-IDX_ORGN]-partante['itime']
-        IIold_o = age_sec > (age_bound-0.25) * 86400
-        IIold_o = IIold_o & ((prod0['flag_source'][partante['idx_back']-IDX_ORGN] & I_STOP)==0)
-        idx_IIold = partante['idx_back'][IIold_o]
-        j_IIold_o = np.where(IIold_o)
-        prod0['flag_source'][idx_IIold-IDX_ORGN] = prod0['flag_source'][idx_IIold-IDX_ORGN] | I_DEAD+I_OLD
-        prod0['src']['x'][idx_IIold-IDX_ORGN] = partante['x'][j_IIold_o]
-        prod0['src']['y'][idx_IIold-IDX_ORGN] = partante['y'][j_IIold_o]
-        prod0['src']['p'][idx_IIold-IDX_ORGN] = partante['p'][j_IIold_o]
-        prod0['src']['t'][idx_IIold-IDX_ORGN] = partante['t'][j_IIold_o]
-        prod0['src']['age'][idx_IIold-IDX_ORGN] = ((part0['ir_start'][idx_IIold-IDX_ORGN]- partante['itime'])/86400)
-        print("number of IIold ",len(idx_IIold)) 
-        nold += len(idx_IIold)
-        
-        # find parcels still alive       if kept_p.sum()==0:
-        try:
-            nlive = ((prod0['flag_source'][partpost['idx_back']-IDX_ORGN] & I_DEAD) == 0).sum()
-            #n_nohit = ((prod0['flag_source'][partpost['idx_back']-IDX_ORGN] & I_HIT) == 0).sum()
-        except:
-            nlive = 0
-            #n_nohit =0
-        print('end hour ',hour,'  numact', partpost['nact'],' nnew',nnew, ' nexits',nexits,' nhits',nhits, ' nlive',nlive,\
-              ' nold',nold,' ndborne',ndborne)
-        # check that nold + nlive + nhits + nexits = nnew
-        if nnew != nexits + nhits + nlive + nold:
-            print('@@@ ACHTUNG nnew not equal to sum ',nnew,nexits+nhits+nlive+nold)
-
-    """ End of the procedure and storage of the result """
-    pid = os.getpid()
-    py = psutil.Process(pid)
-    memoryUse = py.memory_info()[0]/2**30
-    print('memory use before clean: {:4.2f} gb'.format(memoryUse))
-    del partante
-    del partpost
-    del live_a
-    del live_p
-    del datsat
-    del datpart
-    del satfill
-    prod0['rvs'] = prod0['rvs'].astype(np.float32)
-    for var in ['age','p','t','x','y']:
-        prod0['src'][var] = prod0['src'][var].astype(np.float32)
-    pid = os.getpid()
-    py = psutil.Process(pid)
-    memoryUse = py.memory_info()[0]/2**30
-    print('memory use after clean: {:4.2f} gb'.format(memoryUse))
+
+    # The step loop, exits, deadborne and age limit are done by the engine
+    engine = BackEngine(ftraj,sdate,CloudtopHit(satmap,sdate,dtRange,satdir,slice_width),step=step,hmax=hmax,
+                        age_bound=age_bound,granule_size=granule_size,granule_quanta=granule_quanta,
+                        verbose=verbose,checkpoint=ckpt_file,checkpoint_step=checkpoint_step,
+                        resume=args.resume,threads=threads)
+    prod0 = engine.run()
+
     #output file
     #pickle.dump(prod0,gzip.open(out_file,'wb'))
     #try:
     #    dd.io.save(out_file1,prod0,compression='blosc')
     #except:
     #    print('error with dd blosc')
-    try:
-        dd.io.save(out_file,prod0,compression='zlib')
-    except:
-        print('error with dd zlib')
-        try:
-            pickle.dump(prod0,open(out_file2,'wb'))
-        except:
-            print('error with pickle')
-            dd.io.save(out_file1,prod0,compression='blosc')
+    save_prod_or_pickle(out_file,prod0,out_file2)
     #try:
     #    pickle.dump(prod0,open(out_file2,'wb'))
     #except:
@@ -477,74 +193,104 @@ def satratio(p,T):
 vsatratio = np.vectorize(satratio)
 
 #%%
-""" Functions related to the parcel data """
-
-def get_slice_part(part_a,part_p,live_a,live_p,current_date,dstep,slice_width):
-    """ Generator to generate 5' slices along flight track """
-    nb_slices = int(dstep/slice_width)
-    ta = current_date + dstep
-    tp = current_date
-    tf = ta
-    empty_live = (live_a.sum() == 0)
-    for i in range(nb_slices):
-        ti = tf- slice_width
-        # note that 0.5*(ti+tf) cannot be calculated as we are adding two dates
-        tmid = ti+0.5*(tf-ti)
-        coefa = (tmid-tp)/dstep
-        coefp = (ta-tmid)/dstep
-        dat = {}
-        dat['time'] = tmid
-        if empty_live:
-           dat['idx_back'] = dat['x'] = dat['y'] = dat['p'] = dat['t'] = np.array([])
-           dat['itime']= None
-        else:
-            dat['idx_back'] = part_a['idx_back'][live_a]
-            dat['x'] = coefa*part_a['x'][live_a] + coefp*part_p['x'][live_p]
-            dat['y'] = coefa*part_a['y'][live_a] + coefp*part_p['y'][live_p]
-            dat['p'] = coefa*part_a['p'][live_a] + coefp*part_p['p'][live_p]
-            dat['t'] = coefa*part_a['t'][live_a] + coefp*part_p['t'][live_p]
-            dat['itime'] = int(coefa*part_a['itime'] + coefp*part_p['itime'])
-
-        tf -= slice_width
-        yield dat
+""" Hit kernel comparing the parcels to the cloudtop slices """
 
-#%%
-""" Function managing the exiting parcels.
-    We only consider exiting through top or bottom"""
+class CloudtopHit(HitKernel):
 
-@jit(nopython=True)
-def exiter(itime, x,y,p,t,idx_back, flag,xc,yc,pc,tc,age, ir_start, rr):
-    nexits = 0
-    for i in range(len(x)):
-        i0 = idx_back[i]-IDX_ORGN
-        if flag[i0] & I_DEAD == 0:
-            nexits += 1
-            xc[i0] = x[i]
-            yc[i0] = y[i]
-            tc[i0] = t[i]
-            pc[i0] = p[i]
-            age[i0] = ir_start[i0] - itime
-            if p[i] > highpcut - 150: excode = 1
-            elif p[i] < lowpcut  + 15 : excode = 2
-            else:                   excode = 7
-            flag[i0] |= (excode << 13) + I_DEAD + I_CROSSED
-    return nexits
+    def __init__(self,satmap,sdate,dtRange,satdir,slice_width):
+        self.satmap = satmap
+        self.dtRange = dtRange
+        self.satdir = satdir
+        self.slice_width = slice_width
+        self.start_sat(sdate)
+
+    def start_sat(self,date):
+        # Build the satellite field generators, read in background threads
+        self.get_sat = {'MSG1': background(read_sat(date,self.dtRange['MSG1'],self.satdir['MSG1'])),\
+                        'Hima': background(read_sat(date,self.dtRange['Hima'],self.satdir['Hima']))}
+        self.satfill = {}
+        self.datsat = {}
+
+    def restore(self,engine,state):
+        # restart the satellite readers at the date of the checkpoint
+        self.start_sat(engine.current_date)
+
+    def init(self,engine):
+        # Minimum of the saturation mixing ratio along the trajectory
+        engine.prod0['rvs'] = np.full(engine.numpart,0.01,dtype=np.float32)
+
+    def start_step(self,engine,partante,partpost):
+        # Processing of water mixing ratio
+        # Select non stopped parcels in partante
+        prod0 = engine.prod0
+        selec = (prod0['flag_source'][partante['idx_back']-engine.idx_orgn] & I_STOP) == 0
+        idx = partante['idx_back'][selec]-engine.idx_orgn
+        prod0['rvs'][idx] = np.minimum(prod0['rvs'][idx],satratio(partante['p'][selec],partante['t'][selec]))
+
+    def process(self,engine,datpart):
+        satmap = self.satmap
+        if verbose: print('part slice ', datpart['time'])
+        # Make sure the present satellite slice is OK
+        # The while should ensure that the run synchronizes
+        # when it starts.
+        for zone in ['MSG1','Hima']:
+            while satmap.check(zone,datpart['time']) is False:
+                # if not get next satellite slice
+                try:
+                    void = next(self.satfill[zone])
+                # read new satellite file if the slice generator is over
+                # make a new slice generator and get first slice
+                except:
+                    self.datsat[zone] = next(self.get_sat[zone])
+                    self.satfill[zone] = satmap.fill(zone,self.datsat)
+                    void = next(self.satfill[zone])
+                finally:
+                    if verbose: print('check ',zone,satmap.check(zone,datpart['time']),'##',datpart['time'],
+                          '##',satmap.zone[zone]['ti'],'##',satmap.zone[zone]['tf'])
+
+        """ Select the parcels located within the domain """
+        # TODO TODO the values used here should be derived from parameters defined above
+        indomain = np.all((datpart['x']>-10,datpart['x']<160,datpart['y']>0,datpart['y']<50),axis=0)
+
+        """ PROCESS THE COMPARISON OF PARCEL PRESSURES TO CLOUDS """
+        if indomain.sum() == 0:
+            return 0
+        src = engine.prod0['src']
+        return convbirth(datpart['itime'],
+            datpart['x'][indomain],datpart['y'][indomain],datpart['p'][indomain],\
+            datpart['t'][indomain],datpart['idx_back'][indomain],\
+            engine.prod0['flag_source'],src['x'][0],src['y'][0],src['p'][0],src['t'][0],src['age'][0],\
+            satmap.ptop, engine.part0['ir_start'],\
+            satmap.range[0,0],satmap.range[1,0],satmap.stepx,satmap.stepy,satmap.binx,satmap.biny,\
+            engine.idx_orgn)
+
+    def report(self,engine,partpost):
+        nlive = ((engine.prod0['flag_source'][partpost['idx_back']-engine.idx_orgn] & I_DEAD) == 0).sum()
+        print('end hour ',engine.hour,'  numact', partpost['nact'],' nnew',engine.nnew, ' nexits',engine.nexits,
+              ' nhits',engine.nhits, ' nlive',nlive,' nold',engine.nold,' ndborne',engine.ndborne)
+        # check that nold + nlive + nhits + nexits = nnew
+        if engine.nnew != engine.nexits + engine.nhits + nlive + engine.nold:
+            print('@@@ ACHTUNG nnew not equal to sum ',engine.nnew,engine.nexits+engine.nhits+nlive+engine.nold)
+
+    def finalize(self,engine):
+        del self.datsat
+        del self.satfill
 
 #%%
 """ Function doing the comparison between parcels and clouds and setting the result field 
     Parcels outside the domain are not accounted."""
 
-@jit(nopython=True)
-def convbirth(itime, x,y,p,t,idx_back, flag,xc,yc,pc,tc,age, ptop, ir_start, x0,y0,stepx,stepy,binx,biny):
+@jit(nopython=True,parallel=True,nogil=True)
+def convbirth(itime, x,y,p,t,idx_back, flag,xc,yc,pc,tc,age, ptop, ir_start, x0,y0,stepx,stepy,binx,biny,idx_orgn):
     nhits = 0
-    for i in range(len(x)):
+    for i in prange(len(x)):
         idx = int(np.floor((x[i]-x0)/stepx))
         idy = int(np.floor((y[i]-y0)/stepy))
         #if any([idx<0, idy<0, idx>binx-1, idy>biny-1]):
         if (idx<0) or (idy<0) or (idx>binx-1) or (idy>biny-1):
             continue
         if ptop[idy,idx] < p[i]:
-            i0 = idx_back[i]-IDX_ORGN
+            i0 = idx_back[i]-idx_orgn
             if flag[i0] & I_DEAD == 0:
                 nhits += 1
                 flag[i0] |= I_HIT + I_DEAD
@@ -20,58 +20,44 @@ Add the regional analysis as well
 import socket
 import numpy as np
 import math
-from collections import defaultdict
-from numba import jit, int64
+from numba import jit, prange, int64
 from datetime import datetime, timedelta
 import os
 import pickle, gzip
-import deepdish as dd
+from functools import partial
+from prodstore import save_prod_or_pickle
 import sys
 import argparse
-import psutil
 from sys import exit
-from scipy.interpolate import RegularGridInterpolator
-from ECMWF_N import ECMWF
-from mki2d import tohyb
-
-from io107 import readpart107, readidx107
-p0 = 100000.
-I_DEAD = 0x200000
-I_HIT = 0x400000
-I_OLD = 0x800000
-I_CROSSED = 0x2000000
-I_DBORNE =  0x1000000
-I_STOP = I_HIT + I_DEAD
+from ECMWF_N import ECMWF, sample_grid
+from mki2d import tohyb_table
+from metcache import SliceCache
+
+from backsrc import BackEngine, HitKernel, run_batch, thread_bounds, I_DEAD, I_HIT, I_CROSSED
 
 # misc parameters
 # step in the ERA5 and ERA-I data
 ERA5_step = timedelta(hours=1)
 ERAI_step = timedelta(hours=3)
-# low p cut in the M55 traczilla runs
-lowpcut = 3000
-# highpcut in the M55 traczilla runs
-highpcut = 50000
-
+rea_step = {'ERA5':ERA5_step,'ERAI':ERAI_step}
 # if True print a lot oj junk
 verbose = False
 debug = True
 
-# idx_orgn was not set to 1 but to 0 in M55 and GLO runs
-IDX_ORGN = 0
-
 #%%
 """@@@@@@@@@@@@@@@@@@@@@@@@   MAIN   @@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@"""
 
 def main():
-    global IDX_ORGN
     parser = argparse.ArgumentParser()
     parser.add_argument("-y","--year",type=int,help="year")
     parser.add_argument("-m","--month",type=int,choices=1+np.arange(12),help="month")
     parser.add_argument("-a","--advect",type=str,choices=["OPZ","EAD","EAZ","EID","EIZ"],help="source of advecting winds")
-    parser.add_argument("-l","--level",type=int,help="PT level")
+    parser.add_argument("-l","--level",type=int,nargs='+',help="PT level(s), processed in lockstep if several")
     parser.add_argument("-s","--suffix",type=str,help="suffix for special cases")
     parser.add_argument("-q","--quiet",type=str,choices=["y","n"],help="quiet (y) or not (n)")
     parser.add_argument("-r","--reanalysis",type=str,choices=["ERA5","ERAI"],help="reanalysis for detrainement")
+    parser.add_argument("-rs","--resume",action='store_true',help="restart from the last checkpoint")
+    parser.add_argument("-j","--threads",type=int,help="number of threads of the numba kernels")
 
     # to be updated
     if socket.gethostname() == 'graphium':
@@ -89,21 +75,26 @@ def main():
     # step and max output time
     step = 6
     hmax = 1824
-    dstep = timedelta (hours=step)
     # age limit in days
     age_bound = 44.
+    # step in hours between two checkpoints
+    checkpoint_step = 120
+    # number of threads of the numba kernels
+    threads = 1
     # time width of the parcel slice
     # slice_width cannot be chosen independently of the step
-    # see below the main loop
     # ACHTUNG ACHTUNG!!!! If you change this value, change also the chi erosion in detrainer which is hard coded
     # to occur by 1-hour steps
     slice_width = timedelta(hours=1)
-    # number of slices between two outputs
-    nb_slices = int(dstep/slice_width)
     # defines here the offset for the detrainment (100h)
     detr_offset = 1/(100*3600.)
     # defines the domain where M55 parcels are living (no FULL trajectories for this setup)
     domain = np.array([[-10.,160.],[0.,50.]])
+    # number of reanalysis slices decoded in advance
+    prefetch = 2
+    # maximum number of reanalysis slices kept in the cache (about 50 MB each for ERA5),
+    # enough for the runs of two successive months to share their hours
+    cache_max = 2000
     
     # default values of changeable parameters
     # start date of the backward run, corresponding to itime=0 
@@ -115,21 +106,32 @@ def main():
     advect = 'EAD'
     suffix =''
     quiet = False
-    level = 380
+    levels = [380,]
     # choice of the reanalysis from which detrainement rates are extracted
     rea = 'ERA5'
     args = parser.parse_args()
-    if args.year is not None: year=args.year
-    if args.month is not None: month=args.month+1
-    if args.advect is not None: advect=args.advect
-    if args.level is not None: level=args.level
-    if args.suffix is not None: suffix='-'+args.suffix
+    if args.year is not None:
+        year=args.year
+    if args.month is not None:
+        month=args.month+1
+    if args.advect is not None:
+        advect=args.advect
+    if args.level is not None:
+        levels=args.level
+    if args.threads is not None:
+        threads=args.threads
+    if args.suffix is not None:
+        suffix='-'+args.suffix
     if args.quiet is not None:
-        if args.quiet=='y': quiet=True
-        else: quiet=False
-    if args.reanalysis is not None: rea = args.reanalysis
-    
+        if args.quiet=='y':
+            quiet=True
+        else:
+            quiet=False
+    if args.reanalysis is not None:
+        rea = args.reanalysis
 
+    # Cache of the reanalysis slices, shared by the runs on different levels and months
+    cache_dir = os.path.join(out_dir,rea+'-CACHE')
     # Update the out_dir with the platform
     out_dir = os.path.join(out_dir,'STC-BACK-DETR-OUT')
     sdate = datetime(year,month,day)
@@ -152,7 +154,7 @@ def main():
     # Manage the file that receives the print output
     if quiet:
         # Output file
-        print_file = os.path.join(out_dir,'out','BACK-'+advect+fdate.strftime('-%b-%Y-')+str(level)+'K'+suffix+'-'+rea+'.out')
+        print_file = os.path.join(out_dir,'out','BACK-'+advect+fdate.strftime('-%b-%Y-')+'-'.join(str(level) for level in levels)+'K'+suffix+'-'+rea+'.out')
         fsock = open(print_file,'w')
         sys.stdout=fsock
 
@@ -162,491 +164,220 @@ def main():
     print('year',year,'month',month,'day',day)
     print('advect',advect)
     print('suffix',suffix)
+    print('reanalysis',rea)
 
+    # Name of the run for each level
+    runs = {level:'BACK-'+advect+fdate.strftime('-%b-%Y-')+str(level)+'K'+suffix+'-'+rea for level in levels}
     # Directory of the backward trajectories
-    ftraj = os.path.join(traj_dir,'BACK-'+advect+fdate.strftime('-%b-%Y-')+str(level)+'K'+suffix)    
+    ftraj = {level:os.path.join(traj_dir,runs[level]) for level in levels}
 
     # Output file
-    out_file = os.path.join(out_dir,'BACK-'+advect+fdate.strftime('-%b-%Y-')+str(level)+'K'+suffix+'-'+rea+'.hdf5b')    
-    out_file1 = os.path.join(out_dir,'BACK-'+advect+fdate.strftime('-%b-%Y-')+str(level)+'K'+suffix+'-'+rea+'.hdf5z')    
-    #out_file2 = os.path.join(out_dir,'BACK-'+advect+fdate.strftime('-%b-%Y-')+str(level)+'K'+suffix+'.pkl')
-    
+    out_file = {level:os.path.join(out_dir,runs[level]+'.hdf5z') for level in levels}
+    # fallback if the hdf5z file cannot be written
+    out_file2 = {level:os.path.join(out_dir,runs[level]+'.pkl') for level in levels}
+    # Checkpoint file
+    ckpt_file = {level:os.path.join(out_dir,runs[level]+'.ckpt') for level in levels}
+
     # Read the region mask
     # ACHTUNG: the mask should fit the domain and dimensions of the prodO['source']
-    # defined below
+    # defined in DetrHit
     if rea == 'ERA5':
         mm = pickle.load(gzip.open(os.path.join(mask_dir,'MaskCartopy2-ERA5-STC.pkl')))
     elif rea == 'ERAI':
         mm = pickle.load(gzip.open(os.path.join(mask_dir,'MaskCartopy2-ERA-I.pkl')))
-    mask = mm['mask']
 
     """ Initialization of the calculation """
-    # Initialize the dictionary of the parcel dictionaries
-    partStep={}   
-
-    # Open the part_000 file that contains the initial positions
-    part0 = readidx107(os.path.join(ftraj,'part_000'),quiet=False)
-    print('numpart',part0['numpart'])
-    numpart = part0['numpart']
-    numpart_s = granule_size
-    
-    # stamp_date not set in these runs
-    # current_date actually shifted by one day / sdate
-    current_date = sdate
-    # check flag is clean
-    print('check flag is clean ',((part0['flag']&I_HIT)!=0).sum(),((part0['flag']&I_DEAD)!=0).sum(),\
-                                 ((part0['flag']&I_CROSSED)!=0).sum())
-
-    # check idx_orgn
-    if part0['idx_orgn'] != 0:
-        print('MINCHIA, IDX_ORGN NOT 0 AS ASSUMED, CORRECTED WITH READ VALUE')
-        print('VALUE ',part0['idx_orgn'])
-        IDX_ORGN = part0['idx_orgn']
-    idx1 = IDX_ORGN
-
-    # Build a dictionary to host the results
-    prod0 = defaultdict(dict)
-    # Locations of the crossing and detrainement
-    nsrc = 6
-    prod0['src']['x'] = np.full(shape=(nsrc,part0['numpart']),fill_value=np.nan,dtype='float')
-    prod0['src']['y'] = np.full(shape=(nsrc,part0['numpart']),fill_value=np.nan,dtype='float')
-    prod0['src']['p'] = np.full(shape=(nsrc,part0['numpart']),fill_value=np.nan,dtype='float')
-    prod0['src']['t'] = np.full(shape=(nsrc,part0['numpart']),fill_value=np.nan,dtype='float')
-    prod0['src']['age'] = np.full(shape=(nsrc,part0['numpart']),fill_value=np.nan,dtype='float')
-    # Flag is copied from index
-    prod0['flag_source'] = part0['flag']
-    # Make a source array to accumulate the chi 
-    # For ERA5: Dimension is that of the STC ERA5 fields (201,681) at 0.25° resolution
-    # For ERAI: The domain is the reduced domain (10-50N,10W,160E) at 1° resolution, that is (51,171) size
-    # Both latitudes and longitudes are growing
-    if rea == 'ERA5':
-        prod0['source'] = np.zeros(shape=(201,681),dtype='float')
-        xshift = 0
-        yshift = 0
-    elif rea == 'ERAI':
-        prod0['source'] = np.zeros(shape=(51,171),dtype='float')
-        # shift of the source grid in the original ERAI grid with origins at (90S, 179W)
-        xshift = -169
-        yshift = -90
-    # truncate eventually to 32 bits at the output stage
-    # Source array that cumulates within regions as a function of time
-    prod0['pl'] = np.zeros(shape=(len(mm['regcode'])+1),dtype='float')
-
-    # Initialize the erosion 
-    prod0['chi'] = np.full(part0['numpart'],1.,dtype='float')
-    prod0['passed'] = np.full(part0['numpart'],10,dtype='int')
-   
-    # Build the interpolator to the hybrid level
-    fhyb, void = tohyb(rea)
-    #vfhyb = np.vectorize(fhyb)
-
-    # Read the part_000 file for the first granule
-    partStep[0] = {}
-    partStep[0]['x']=part0['x'][:granule_size]
-    partStep[0]['y']=part0['y'][:granule_size]
-    partStep[0]['t']=part0['t'][:granule_size]
-    partStep[0]['p']=part0['p'][:granule_size]
-    partStep[0]['t']=part0['t'][:granule_size]
-    partStep[0]['idx_back']=part0['idx_back'][:granule_size]
-    partStep[0]['ir_start']=part0['ir_start'][:granule_size]
-    partStep[0]['itime'] = 0
-
-    # number of hists and exits
-    nhits = np.array([0,0,0,0,0,0])
-    nexits = 0
-    ndborne = 0
-    nnew = granule_size
-    nold = 0
-    nradada = 0
-
-    # used to get non borne parcels
-    new = np.empty(part0['numpart'],dtype='bool')
-    new.fill(False)
-
-    print('Initialization completed')
-
-    """ Main loop on the output time steps """
-    for hour in range(step,hmax+1,step):
-        pid = os.getpid()
-        py = psutil.Process(pid)
-        memoryUse = py.memory_info()[0]/2**30
-        print('memory use: {:4.2f} gb'.format(memoryUse))
-        # Get rid of dictionary no longer used
-        if hour >= 2*step: del partStep[hour-2*step]
-        # Read the new data
-        partStep[hour] = readpart107(hour,ftraj,quiet=True)
-        # Link the names
-        partante = partStep[hour-step]
-        partpost = partStep[hour]
-        if partpost['nact']>0:
-            print('hour ',hour,'  numact ', partpost['nact'], '  max p ',partpost['p'].max())
-        else:
-            print('hour ',hour,'  numact ', partpost['nact'])
-        # New date valid for partpost
-        current_date -= dstep
-        """ Select the parcels that are common to the two steps
-        ketp_a is a logical field with same length as partante
-        kept_p is a logical field with same length as partpost
-        After the launch of the earliest parcel along the flight track, there
-        should not be any member in new.
-        """
-        kept_a = np.in1d(partante['idx_back'],partpost['idx_back'],assume_unique=True)
-        kept_p = np.in1d(partpost['idx_back'],partante['idx_back'],assume_unique=True)
-        #new_p = ~np.in1d(partpost['idx_back'],partpost['idx_back'],assume_unique=True)
-        print('kept a, p ',len(kept_a),len(kept_p),kept_a.sum(),kept_p.sum(),'  new ',len(partpost['x'])-kept_p.sum())
-        nnew += len(partpost['x'])-kept_p.sum()
-        sys.stdout.flush()
-        
-        """ PROCESSING OF DEADBORNE PARCELS
-        Manage the parcels launched during the last 6-hour which have already
-        exited and do not appear in posold or posact (borne dead parcels).
-        These parcels are stored in the last part of posact, at most
-        the last granule_quanta parcels. 
-        PB: this does not process the first parcels launched at time 0 since initially
-        numpart_s = granule_size"""
-        if numpart_s < numpart :
-            print("manage deadborne",flush=True)
-            # First index of the current quanta """
-            numpart_s += granule_quanta
-            print("numpart_s ",numpart_s) 
-            # Extract the last granule_size indexes from posact
-            if hour==step:
-                idx_act = partpost['idx_back']
-            else:    
-                idx_act = partpost['idx_back'][-granule_quanta:]
-            # Generate the list of indexes that should be found in this range
-            idx_theor = np.arange(idx1,numpart_s+IDX_ORGN)
-            # Find the missing indexes in idx_act (make a single line after validation)
-            kept_borne = np.in1d(idx_theor,idx_act,assume_unique=True)
-            idx_deadborne = idx_theor[~kept_borne]
-            # Process these parcels by assigning exit at initial location
-            prod0['flag_source'][idx_deadborne-IDX_ORGN] = prod0['flag_source'][idx_deadborne-IDX_ORGN] | I_DEAD+I_DBORNE
-            prod0['src']['x'][0,idx_deadborne-IDX_ORGN] = part0['x'][idx_deadborne-IDX_ORGN]
-            prod0['src']['y'][0,idx_deadborne-IDX_ORGN] = part0['y'][idx_deadborne-IDX_ORGN]
-            prod0['src']['p'][0,idx_deadborne-IDX_ORGN] = part0['p'][idx_deadborne-IDX_ORGN]
-            prod0['src']['t'][0,idx_deadborne-IDX_ORGN] = part0['t'][idx_deadborne-IDX_ORGN]
-            prod0['src']['age'][0,idx_deadborne-IDX_ORGN] = 0.
-            print("number of deadborne ",len(idx_deadborne))
-            ndborne += len(idx_deadborne)
-            idx1 = numpart_s + IDX_ORGN
-        sys.stdout.flush()
-
-        """ PROCESSING OF CROSSED PARCELS """
-        # last known location before crossing stored in the index 0 of src fields
-        if len(kept_a)>0:
-            exits = exiter(int((partante['itime']+partpost['itime'])/2), \
-                partante['x'][~kept_a],partante['y'][~kept_a],partante['p'][~kept_a],\
-                partante['t'][~kept_a],partante['idx_back'][~kept_a],\
-                prod0['flag_source'],prod0['src']['x'],prod0['src']['y'],\
-                prod0['src']['p'],prod0['src']['t'],prod0['src']['age'],\
-                part0['ir_start'], domain)
-            nexits += exits
-            #nhits[0] += exits
-            print('exit ',nexits, exits, np.sum(~kept_a), len(kept_a) - len(kept_p))
-        sys.stdout.flush()
-
-        """ PROCESSING OF PARCELS WHICH ARE COMMON TO THE TWO OUTPUTS  """
-        # Select the kept parcels which have not been hit yet
-        # !!! Never use and between two lists, the result is wrong
-
-        if kept_p.sum()==0:
-            live_a = live_p = kept_p
-        else:
-            live_a = np.logical_and(kept_a,(prod0['flag_source'][partante['idx_back']-IDX_ORGN] & I_DEAD) == 0)
-            live_p = np.logical_and(kept_p,(prod0['flag_source'][partpost['idx_back']-IDX_ORGN] & I_DEAD) == 0)
-        print('live a, p ',live_a.sum(),live_p.sum())
-        del kept_a
-        del kept_p
-        sys.stdout.flush()
-
-        # Build generator for live parcel locations of the 1h slices
-        gsp = get_slice_part(partante,partpost,live_a,live_p,current_date,dstep,slice_width)
-        if verbose: print('built parcel generator for ',current_date)
-
-        """  MAIN LOOP ON THE PARCEL TIME SLICES  """
-
-        for i in range(nb_slices):
-            # get the next slice for the particles
-            datpart = next(gsp)         
-            # skip if no particles
-            if datpart['ti'] == None:
-                continue
-            print('current_date ',datpart['ti'])
-            #@@ test
-#            print('ti in main ',datpart['ti'])
-#            print('pi in main ',np.min(datpart['pi']),np.max(datpart['pi']))
-#            print('idx_back   ',np.min(datpart['idx_back']),np.max(datpart['idx_back']))
-#            #@@ end test
-            # What follows is not independent of the choices of step and slice_width
-            # TO DO : a more general version that does not have this dependency
-            # This should not be difficult using a generator with validity times
-            # We just need to make sure the entrainment data and SP data are valid 
-            # during the interval [ti tf]
-            # Read ERA5 data as the files are also available every hour
-            # this might not work if output step is changed without changing slice width 
-            # the detrainement is actually defined as an average over the next hour that is between ti and tf
-            if rea == 'ERA5':
-                datrean = read_ECMWF(datpart['ti'],rea)
-                # calculate the -log surface pressure at parcel location at time ti  
-                # create a 2D linear interpolar from the surface pressure field
-                lsp = RegularGridInterpolator((datrean.attr['lats'],datrean.attr['lons']),\
-                        -np.log(datrean.var['SP']))
-            # calculate the -log surface pressure at parcel location at time ti  
-            # create a 2D linear interpolar from the surface pressure field
-            lsp = RegularGridInterpolator((datrean.attr['lats'],datrean.attr['lons']),\
-                                          -np.log(datrean.var['SP']))
-             # perform the interpolation for the location of live parcels at time 0.5*(ti+tf)
-            datpart['lsp'] = lsp(np.transpose([0.5*(datpart['yi']+datpart['yf']),
-                                               0.5*(datpart['xi']+datpart['xf'])]))
-            #@@ test
-#            print('surface pressure ',np.exp(-np.min(datpart['lspi'])),np.exp(-np.max(datpart['lspi'])))
-#            print('particle pressure ',np.min(datpart['pi']),np.max(datpart['pi'])) 
-            #@@ end test
-            # get the closest hybrid level at time ti
-            # define first -log sigma = -log(p) - -log(ps)
-            lsig = - np.log(0.5*(datpart['pi']+datpart['pf'])) - datpart['lsp']
-            #@@ test
-#            print('sigma ',np.exp(-np.max(lsig)),np.exp(-np.min(lsig)))
-            #@@ end test
-            # get the hybrid level at time ti, the rank of the first retained level is substracted to have hyb starting from 0
-            # +1 because the levels are counted from 1, not 0 and +0.5 because we get the closest neighbour
-            hyb = np.floor(fhyb(np.transpose([lsig,datpart['lsp']]))+0.5).astype(np.int64)-datrean.attr['levs'][0]
-            #@@ test the extreme values of sigma end ps
-            if np.min(lsig) < - np.log(0.95):
-                print('large sigma detected ',np.exp(-np.min(lsig)))
-            if np.max(datpart['lsp']) > -np.log(45000):
-                print('small ps detected ',np.exp(-np.max(datpart['lsp'])))
-                
-            """ PROCESS THE PARCELS WHICH ARE TOO CLOSE TO GROUND
-             These parcels are flagged as crossed and dead, their last location is stored in the
-             index 0 of src fields.
-             This test handles also the cases outside the interpolation domain as NaN produced by fhyb
-             generates very large value of hyb. 
-             The trajectories which are stopped here have exited the domain where winds are available to flexpart
-             and therefore are wrong from this point. For this reason we label them from their last valid position.
-             The threshold 100 is valid for the particular STC ERA5 archive only.
-             With ERA-I, this section should not operate."""
-            if np.max(hyb)> 100 :
-                selec = hyb>100
-                nr = radada(datpart['itime'],
-                        datpart['xf'][selec],datpart['yf'][selec],datpart['pf'][selec],
-                        datpart['tempf'][selec],datpart['idx_back'][selec],
-                        prod0['flag_source'],prod0['src']['x'],prod0['src']['y'],
-                        prod0['src']['p'],prod0['src']['t'],prod0['src']['age'] ,
-                        part0['ir_start'])
-                nradada += nr
-                nhits[0] += nr
-           
-            """ PROCESS THE (ADJOINT) DETRAINMENT """
-            n1 = detrainer(datpart['itime'], 
-                datpart['xi'],datpart['yi'],datpart['pi'],datpart['tempi'],hyb,
-                datpart['xf'],datpart['yf'], datrean.var['UDR'], datpart['idx_back'],\
-                prod0['flag_source'],part0['ir_start'], prod0['chi'],prod0['passed'],\
-                prod0['src']['x'],prod0['src']['y'],prod0['src']['p'],prod0['src']['t'],\
-                prod0['src']['age'],prod0['source'],prod0['pl'],\
-                datrean.attr['Lo1'],datrean.attr['La1'],datrean.attr['dlo'],datrean.attr['dla'],
-                xshift,yshift,detr_offset,mask)
-            nhits += n1
-            #@@ test
-            # print('return from detrainer',nhits)
-            #@@ end test    
-            sys.stdout.flush()
-
-        """ End of of loop on slices """
-        
-        # Check the age limit (easier to do it here)
-        print("Manage age limit",flush=True)
-        age_sec = part0['ir_start'][partante['idx_back']-IDX_ORGN]-partante['itime']
-        IIold_o = age_sec > (age_bound-0.25) * 86400
-        IIold_o = IIold_o & ((prod0['flag_source'][partante['idx_back']-IDX_ORGN] & I_STOP)==0)
-        idx_IIold = partante['idx_back'][IIold_o]
-        j_IIold_o = np.where(IIold_o)
-        prod0['flag_source'][idx_IIold-IDX_ORGN] = prod0['flag_source'][idx_IIold-IDX_ORGN] | I_DEAD+I_OLD
-        prod0['src']['x'][0,idx_IIold-IDX_ORGN] = partante['x'][j_IIold_o]
-        prod0['src']['y'][0,idx_IIold-IDX_ORGN] = partante['y'][j_IIold_o]
-        prod0['src']['p'][0,idx_IIold-IDX_ORGN] = partante['p'][j_IIold_o]
-        prod0['src']['t'][0,idx_IIold-IDX_ORGN] = partante['t'][j_IIold_o]
-        prod0['src']['age'][0,idx_IIold-IDX_ORGN] = ((part0['ir_start'][idx_IIold-IDX_ORGN]- partante['itime'])/86400)
-        print("number of IIold ",len(idx_IIold)) 
-        nold += len(idx_IIold)
- 
-        
-        # find parcels still alive       if kept_p.sum()==0:
+    # The reanalysis slices are read backward in time, the next ones by a worker,
+    # down to the end of the run
+    cache = SliceCache(cache_dir,partial(read_ECMWF,rea=rea),['UDR','SP'],attrs=['Lo1','La1','dlo','dla','levs'],
+                       prefetch=prefetch,step=-rea_step[rea],prefix={'ERA5':'STC-','ERAI':'EI-'}[rea],
+                       end=sdate-timedelta(hours=hmax),max_slices=cache_max)
+    # The step loop, exits, deadborne and age limit are done by the engines.
+    # The exits through the sides of the domain are distinguished.
+    # The levels are processed in lockstep and their kernels share the cache,
+    # so that each reanalysis slice is read once
+    engines = [BackEngine(ftraj[level],sdate,DetrHit(detr_offset,domain,slice_width,cache,rea,mm['mask'],len(mm['regcode'])),
+                          step=step,hmax=hmax,
+                          age_bound=age_bound,granule_size=granule_size,granule_quanta=granule_quanta,
+                          verbose=verbose,checkpoint=ckpt_file[level],checkpoint_step=checkpoint_step,
+                          resume=args.resume,threads=threads,exit_domain=domain) for level in levels]
+    prods = run_batch(engines)
+    cache.close()
+
+    #output file, chunked along the parcels, to be read by prodstore.load_prod
+    failed = []
+    for level, prod0 in zip(levels,prods):
         try:
-            # number of parcels still alive
-            nlive = ((prod0['flag_source'][partpost['idx_back']-IDX_ORGN] & I_DEAD) == 0).sum()
-            # number of parcels still alive and not hit
-            nprist = ((prod0['flag_source'][partpost['idx_back']-IDX_ORGN] & (I_DEAD+I_HIT)) == 0).sum()
-            # number of parcels which have hit and crossed
-            nouthit = ((prod0['flag_source'][partpost['idx_back']-IDX_ORGN] & I_HIT+I_CROSSED) == I_HIT+I_CROSSED).sum()
-            # number of parcels which heve crossed without hit
-            noutprist = ((prod0['flag_source'][partpost['idx_back']-IDX_ORGN] & I_HIT+I_CROSSED) == I_CROSSED).sum()
-            # number of parcels which have hit without crossing
-            nhitpure = ((prod0['flag_source'][partpost['idx_back']-IDX_ORGN] & I_HIT+I_CROSSED) == I_HIT).sum()                  
-        except:
-            nlive = 0
-            nprist =0
-            nouthit = 0
-            noutprist = 0
-            nhitpure = 0
-            nprist = part0['numpart']
-            
-        print('end hour ',hour,'  numact', partpost['nact'], ' nnew',nnew,' nexits',nexits,' nold',nold,' ndborne',ndborne)
-        print('nhits',nhits)
-        print('nlive', nlive,' nprist',nprist,' nouthit',nouthit,' noutprist',noutprist,' nhitpure',nhitpure)
-        # check that nprist + nhits + nexits + nold = nnew
-        #if partpost['nact'] != nprist + nouthit + noutprist + nhitpure + ndborne:
-        #    print('@@@ ACHTUNG numact not equal to sum ',partpost['nact'],nprist + nouthit + noutprist + nhitpure + ndborne)
-      
-
-    """ End of the procedure and storage of the result """
-    pid = os.getpid()
-    py = psutil.Process(pid)
-    memoryUse = py.memory_info()[0]/2**30
-    print('memory use before clean: {:4.2f} gb'.format(memoryUse))
-    del partante
-    del partpost
-    del live_a
-    del live_p
-    del datpart
-    # reduction of the size of prod0 by converting float64 into float32
-    prod0['chi'] = prod0['chi'].astype(np.float32)
-    prod0['passed'] = prod0['passed'].astype(np.int32)
-    prod0['source'] = prod0['source'].astype(np.float32)
-    for var in ['age','p','t','x','y']:
-        prod0['src'][var] = prod0['src'][var].astype(np.float32)
-    pid = os.getpid()
-    py = psutil.Process(pid)
-    memoryUse = py.memory_info()[0]/2**30
-    print('memory use after clean: {:4.2f} gb'.format(memoryUse))
-
-    #output file
-    try:
-        dd.io.save(out_file1,prod0,compression='blosc')
-    except:
-        print('error with dd blosc')
-    try:
-        dd.io.save(out_file,prod0,compression='zlib')
-    except:
-        print('error with dd zlib')
-    #try:
-    #    pickle.dump(prod0,open(out_file2,'wb'))
-    #except:
-    #    print('error with pickle')
+            save_prod_or_pickle(out_file[level],prod0,out_file2[level])
+        except Exception as e:
+            # try the other levels before raising
+            print('cannot save ',level,e)
+            failed.append(level)
+    if len(failed) > 0:
+        raise OSError('results not saved for levels '+str(failed))
 
     # close the print file
-    print('completed run')
     if quiet: fsock.close()
-    return
 
 """@@@@@@@@@@@@@@@@@@@@@@@@@@@ END OF MAIN @@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@"""
 
 #%%
-""" Functions related to the parcel data """
-
-def get_slice_part(part_a,part_p,live_a,live_p,current_date,dstep,slice_width):
-    """ Generator to generate slices along flight track determined by the slice_width. 
-    Each slice is a sub-interval [ti, tf] dividing the interval [tp, ta] between two outputs.
-    tp <= ti < tf <= ta
-    part_a: previously read positions (time ta)
-    part_p: last read positions (time tp = ta - step)
-    Each call returns the position of the parcels at the beginning and end of each subinterval.
-    The first generated interval is for tf = ta, 
-    nb_slices = int(dstep/slice_width+0.0001) and then they are scanned backward.
-    ACHTUNG: bounds for xf and yf are hard coded
-    """
-    nb_slices = int(dstep/slice_width+0.0001)
-    ta = current_date + dstep
-    tp = current_date
-    tf = ta
-    empty_live = (live_a.sum() == 0)
-    itime = part_p['itime']
-    dat = {}
-    for i in range(nb_slices):
-        ti = tf - slice_width
-        itime -= slice_width.seconds
-        # note that 0.5*(ti+tf) cannot be calculated as we are adding two dates
-        coefai = (ti-tp)/dstep
-        coefpi = (ta-ti)/dstep
-        dat['ti'] = ti
-        dat['tf'] = tf
-        dat['itime'] = itime
-        if empty_live:
-           dat['idx_back'] = dat['xi'] = dat['yi'] = dat['pi'] = dat['ti'] = []
-           dat['xf'] = dat['yf'] = dat['pf'] = dat['tf'] = []
-           dat['ti'] = dat['tf'] = None
-        else:
-            #@@ test
-#            print('i, coefs  ',i,coefai,coefpi)
-#            print('pres a    ',np.min(part_a['p'][live_a]),np.max(part_a['p'][live_a]))
-#            print('pres p    ',np.min(part_p['p'][live_p]),np.max(part_p['p'][live_p]))
-            #@@ end test
-            if i == 0:
-                dat['idx_back'] = part_a['idx_back'][live_a]
-                dat['xf'] = np.clip(part_a['x'][live_a],-10.,160.)
-                dat['yf'] = np.clip(part_a['y'][live_a],0.,50.)
-                dat['pf'] = part_a['p'][live_a]
-                dat['tempf'] = part_a['t'][live_a]
-                #dat['pf'] = part_a['p'][live_a]
-                #dat['tempf'] = part_a['t'][live_a]
-                dat['xi'] = np.clip(coefai*part_a['x'][live_a] + coefpi*part_p['x'][live_p],-10.,160.)
-                dat['yi'] = np.clip(coefai*part_a['y'][live_a] + coefpi*part_p['y'][live_p],0.,50.)
-                dat['pi'] = coefai*part_a['p'][live_a] + coefpi*part_p['p'][live_p]
-                #@@ test
-#                print('pi        ',np.min(dat['pi']),np.max(dat['pi']))         
-                #@@ end test
-                dat['tempi'] = coefai*part_a['t'][live_a] + coefpi*part_p['t'][live_p]
-            elif i == nb_slices-1:
-                dat['xf'] = dat['xi'].copy()
-                dat['yf'] = dat['yi'].copy()
-                dat['pf'] = dat['pi'].copy()
-                dat['tempf'] = dat['tempi'].copy()
-                dat['xi'] = np.clip(part_p['x'][live_p],-10.,160.)
-                dat['yi'] = np.clip(part_p['y'][live_p],0.,50.)
-                dat['pi'] = part_p['p'][live_p]
-                dat['tempi'] = part_p['t'][live_p]
-            else:
-                dat['xf'] = dat['xi'].copy()
-                dat['yf'] = dat['yi'].copy()
-                dat['pf'] = dat['pi'].copy()
-                dat['tempf'] = dat['tempi'].copy()
-                dat['xi'] = np.clip(coefai*part_a['x'][live_a] + coefpi*part_p['x'][live_p],-10.,160.)
-                dat['yi'] = np.clip(coefai*part_a['y'][live_a] + coefpi*part_p['y'][live_p],0.,50.)
-                dat['pi'] = coefai*part_a['p'][live_a] + coefpi*part_p['p'][live_p]
-                dat['tempi'] = coefai*part_a['t'][live_a] + coefpi*part_p['t'][live_p]
-        tf -= slice_width
-        yield dat
+""" Hit kernel eroding the parcels by the (adjoint) detrainment of the reanalysis 
+The parcels are processed over 1h segments and the src fields store the 
+location where chi falls below 0.9, 0.7, 0.5, 0.3 and 0.1 in the indexes 1 to 5.
+The source of chi is accumulated on the grid of the domain and within the regions
+of the mask. """
 
-#%%
-""" Function managing the exiting parcels """
+class DetrHit(HitKernel):
+    nsrc = 6
+    slicing = 'pair'
+    age_dtype = 'float'
+
+    def __init__(self,detr_offset,domain,slice_width,cache,rea,mask,nregions):
+        self.detr_offset = detr_offset
+        self.domain = domain
+        self.slice_width = slice_width
+        # cache of the reanalysis slices (UDR/RHO and SP)
+        self.cache = cache
+        self.rea = rea
+        self.mask = mask
+        self.nregions = nregions
+        self.nradada = 0
+        # Build the lookup table of the hybrid level
+        self.fhyb = tohyb_table(rea)
+        # For ERA5: Dimension is that of the STC ERA5 fields (201,681) at 0.25° resolution
+        # For ERAI: The domain is the reduced domain (10-50N,10W,160E) at 1° resolution, that is (51,171) size
+        # Both latitudes and longitudes are growing
+        if rea == 'ERA5':
+            self.shape = (201,681)
+            self.xshift = 0
+            self.yshift = 0
+        elif rea == 'ERAI':
+            self.shape = (51,171)
+            # shift of the source grid in the original ERAI grid with origins at (90S, 179W)
+            self.xshift = -169
+            self.yshift = -90
+
+    def init(self,engine):
+        prod0 = engine.prod0
+        # Make a source array to accumulate the chi 
+        prod0['source'] = np.zeros(shape=self.shape,dtype='float')
+        # Source array that cumulates within regions as a function of time
+        prod0['pl'] = np.zeros(shape=(self.nregions+1),dtype='float')
+        # Initialize the erosion 
+        prod0['chi'] = np.full(engine.numpart,1.,dtype='float')
+        prod0['passed'] = np.full(engine.numpart,10,dtype=np.int32)
+
+    def process(self,engine,datpart):
+        # skip if no particles
+        if datpart['ti'] == None:
+            return 0
+        print('current_date ',datpart['ti'])
+        prod0 = engine.prod0
+        part0 = engine.part0
+        nhits = np.zeros(self.nsrc,dtype=int)
+        # The ERA5 files are available every hour and the ERA-I files every 3 hours,
+        # the detrainement is actually defined as an average over the period that
+        # follows the time of the file
+        ti = datpart['ti']
+        datrean = self.cache.get(ti - timedelta(hours=ti.hour % (rea_step[self.rea].seconds//3600)))
+
+        """ The parcels are kept within the domain """
+        [[x0,x1],[y0,y1]] = self.domain
+        for var in ['xi','xf']:
+            datpart[var] = np.clip(datpart[var],x0,x1)
+        for var in ['yi','yf']:
+            datpart[var] = np.clip(datpart[var],y0,y1)
+
+        """ 
+         Calculate the -log surface pressure at parcel location at time 0.5*(ti+tf)
+         by bilinear interpolation of the surface pressure field.
+         It is used to determine sigma and the hybrid level. """
+        lsp = sample_grid(datrean.var['SP'],0.5*(datpart['xi']+datpart['xf']),0.5*(datpart['yi']+datpart['yf']),
+                          datrean.attr['Lo1'],datrean.attr['La1'],datrean.attr['dlo'],datrean.attr['dla'],
+                          mlog=True)
+        # get the closest hybrid level
+        # define first -log sigma = -log(p) - -log(ps)
+        lsig = - np.log(0.5*(datpart['pi']+datpart['pf'])) - lsp
+        # get the hybrid level, the rank of the first retained level is substracted to have hyb starting from 0 
+        hyb = np.floor(self.fhyb(np.transpose([lsig,lsp]))+0.5).astype(np.int64)-datrean.attr['levs'][0]
+        #@@ test the extreme values of sigma end ps
+        if np.min(lsig) < - np.log(0.95):
+            print('large sigma detected ',np.exp(-np.min(lsig)))
+        if np.max(lsp) > -np.log(45000):
+            print('small ps detected ',np.exp(-np.max(lsp)))
+            
+        """ PROCESS THE PARCELS WHICH ARE TOO CLOSE TO GROUND
+         These parcels are flagged as crossed and dead, their last location is stored in the
+         index 0 of src fields.
+         This test handles also the cases outside the interpolation domain as NaN produced by fhyb
+         generates very large value of hyb. 
+         The trajectories which are stopped here have exited the domain where winds are available to flexpart
+         and therefore are wrong from this point. For this reason we label them from their last valid position.
+         The threshold 100 is valid for the particular STC ERA5 archive only.
+         With ERA-I, this section should not operate."""
+        if np.max(hyb)> 100 :
+            selec = hyb>100
+            nr = radada(datpart['itime'],
+                 datpart['xf'][selec],datpart['yf'][selec],datpart['pf'][selec],
+                 datpart['tempf'][selec],datpart['idx_back'][selec],
+                 prod0['flag_source'],prod0['src']['x'],prod0['src']['y'],
+                 prod0['src']['p'],prod0['src']['t'],prod0['src']['age'],
+                 part0['ir_start'],engine.idx_orgn)
+            self.nradada += nr
+            nhits[0] += nr
+   
+        """ PROCESS THE (ADJOINT) DETRAINMENT """
+        n1 = detrainer(datpart['itime'], 
+            datpart['xi'],datpart['yi'],datpart['pi'],datpart['tempi'],hyb,
+            datpart['xf'],datpart['yf'], datrean.var['UDR'], datpart['idx_back'],\
+            prod0['flag_source'],part0['ir_start'], prod0['chi'],prod0['passed'],\
+            prod0['src']['x'],prod0['src']['y'],prod0['src']['p'],prod0['src']['t'],prod0['src']['age'],\
+            prod0['source'],prod0['pl'],\
+            datrean.attr['Lo1'],datrean.attr['La1'],datrean.attr['dlo'],datrean.attr['dla'],\
+            self.xshift,self.yshift,self.detr_offset,self.mask,engine.idx_orgn,engine.threads)
+        nhits += np.array(n1)
+        return nhits
+
+    def report(self,engine,partpost):
+        # find parcels still alive
+        flag = engine.prod0['flag_source'][partpost['idx_back']-engine.idx_orgn]
+        # number of parcels still alive
+        nlive = ((flag & I_DEAD) == 0).sum()
+        # number of parcels still alive and not hit
+        nprist = ((flag & (I_DEAD+I_HIT)) == 0).sum()
+        # number of parcels which have hit and crossed
+        nouthit = ((flag & I_HIT+I_CROSSED) == I_HIT+I_CROSSED).sum()
+        # number of parcels which heve crossed without hit
+        noutprist = ((flag & I_HIT+I_CROSSED) == I_CROSSED).sum()
+        # number of parcels which have hit without crossing
+        nhitpure = ((flag & I_HIT+I_CROSSED) == I_HIT).sum()
+        print('end hour ',engine.hour,'  numact', partpost['nact'], ' nnew',engine.nnew,' nexits',engine.nexits,
+              ' nold',engine.nold,' ndborne',engine.ndborne)
+        print('nhits',engine.nhits)
+        print('nlive', nlive,' nprist',nprist,' nouthit',nouthit,' noutprist',noutprist,' nhitpure',nhitpure)
 
-@jit(nopython=True,cache=True)
-def exiter(itime, x,y,p,t,idx_back, flag,xc,yc,pc,tc,age, ir_start, rr):
-    nexits = 0
-    for i in range(len(x)):
-        i0 = idx_back[i]-IDX_ORGN
-        if flag[i0] & I_DEAD == 0:
-            nexits += 1
-            xc[0,i0] = x[i]
-            yc[0,i0] = y[i]
-            tc[0,i0] = t[i]
-            pc[0,i0] = p[i]
-            age[0,i0] = ir_start[i0] - itime
-            if   y[i] < rr[1,0] + 4.: excode = 6
-            elif x[i] < rr[0,0] + 4.: excode = 3
-            elif y[i] > rr[1,1] - 4.: excode = 4
-            elif x[i] > rr[0,1] - 4.: excode = 5
-            elif p[i] > highpcut - 150: excode = 1
-            elif p[i] < lowpcut  + 15 : excode = 2
-            else:                   excode = 7
-            flag[i0] |= (excode << 13) + I_DEAD + I_CROSSED
-    return nexits
+    def state(self):
+        return {'nradada':self.nradada}
+
+    def restore(self,engine,state):
+        self.nradada = int(state['nradada'])
+
+    def finalize(self,engine):
+        # chi and source are accumulated in float64 and converted at the end
+        prod0 = engine.prod0
+        prod0['chi'] = prod0['chi'].astype(np.float32)
+        prod0['source'] = prod0['source'].astype(np.float32)
+        prod0['pl'] = prod0['pl'].astype(np.float32)
+
+#%%
+""" Function managing the parcels which fall below the lowest hybrid level. """
 
-@jit(nopython=True,cache=True)
-def radada(itime, x,y,p,t,idx_back, flag,xc,yc,pc,tc,age, ir_start):
+@jit(nopython=True,parallel=True,cache=True)
+def radada(itime, x,y,p,t,idx_back, flag,xc,yc,pc,tc,age, ir_start, idx_orgn):
     nexits =  0
-    for i in range(len(x)):
-        i0 = idx_back[i]-IDX_ORGN
+    for i in prange(len(x)):
+        i0 = idx_back[i]-idx_orgn
         if flag[i0] & I_DEAD == 0:
             nexits += 1
             xc[0,i0] = x[i]
@@ -660,117 +391,105 @@ def radada(itime, x,y,p,t,idx_back, flag,xc,yc,pc,tc,age, ir_start):
 
 """ Function finding the detrainment at the location of the parcel and doing the job """
 
-@jit(nopython=True,cache=True)
+@jit(nopython=True,parallel=True,cache=True)
 def detrainer(itime, xi,yi,pi,ti,hyb,xf,yf, udr, idx_back,flag,ir_start,chi,passed,\
               xc,yc,pc,tc,age,source,pl,\
-              Lo1,La1,dlo,dla,xshift,yshift,detr_offset,mask):
-    nhits = [0,0,0,0,0,0]
+              Lo1,La1,dlo,dla,xshift,yshift,detr_offset,mask,idx_orgn,nchunks):
     # get dimensions (without using shape)
     nlat = len(source)
     nlon = len(source[0])
+    # the parcels are split into nchunks chunks processed in parallel,
+    # each with its own hit counters, source grid and regional sources
+    bounds = thread_bounds(len(xi),nchunks)
+    nhits = np.zeros((nchunks,6),dtype=int64)
+    source_loc = np.zeros((nchunks,nlat,nlon))
+    pl_loc = np.zeros((nchunks,len(pl)))
     # loop on the kept parcels
-    for i in range(len(xi)):
-        i0 = idx_back[i]-IDX_ORGN
-        #@@ test
-#        if i0<0 or i0>=7601000:
-#            print('i0',i0)
-        #@@ end test
-        # consider only the live parcel
-        if flag[i0] & I_DEAD ==0:
-            # find integer coordinates of closest location on the mesh
-            # It is assumed no point outside the domain
-            xig = int(math.floor((xi[i]-Lo1)/dlo+0.5))
-            yig = int(math.floor((yi[i]-La1)/dla+0.5))
-            xfg = int(math.floor((xf[i]-Lo1)/dlo+0.5))
-            yfg = int(math.floor((yf[i]-La1)/dla+0.5))
-            #@@ test
-#            if xig<0 or xig>679:
-#                print('xig ',xig,'i ',i,'xi ',xi[i])
-#            if xfg<0 or xfg>679:
-#                print('xfg ',xfg)
-#            if yig<0 or yig>199:
-#                print('yig ',yig)
-#            if yfg<0 or yfg>199:
-#                print('yfg ',yfg)
-#            if hyb[i]<0 or hyb[i]>100:
-#                print('hyb ',hyb[i])
-            #@@ end test
-            # find the meshes on the path 
-            ll = line(xig,yig,xfg,yfg)
-            # calculate mean detrainment on the path
-            detr = 0.
-            for j in range(len(ll)):
-                #@@ test
-#                 if ll[j][1]<0 or ll[j][1]>200:
-#                     print('ll1 ',ll[j])
-#                 if ll[j][1]<0 or ll[j][1]>680:
-#                     print('ll0 ',ll[j])
-                #@@ test    
-                detr += udr[hyb[i],ll[j][1],ll[j][0]]
-            detr = detr/len(ll)
-            # erode the parcel
-            if detr >= detr_offset:
-                newchi = chi[i0] * math.exp(-3600*detr)
-                xm = min(nlon-1,max(0,int(0.5*(xig+xfg))+xshift))
-                ym = min(nlat-1,max(0,int(0.5*(yig+yfg))+yshift))
-                source[ym,xm] += chi[i0] - newchi
-                pl[int(mask[ym,xm])] += chi[i0] - newchi
-                chi[i0] = newchi
-                if passed[i0] >1:
-                    if passed[i0] == 10:
-                        if chi[i0] < 0.9:
-                            xc[1,i0] = xi[i]
-                            yc[1,i0] = yi[i]
-                            pc[1,i0] = pi[i]
-                            tc[1,i0] = ti[i]
-                            age[1,i0] = ir_start[i0] - itime
-                            flag[i0] |= I_HIT
-                            passed[i0] = 9
-                            nhits[1] += 1
-                    if passed[i0] == 9:
-                        if chi[i0] < 0.7:
-                            xc[2,i0] = xi[i]
-                            yc[2,i0] = yi[i]
-                            pc[2,i0] = pi[i]
-                            tc[2,i0] = ti[i]
-                            age[2,i0] = ir_start[i0] - itime
-                            passed[i0] = 7
-                            nhits[2] += 1
-                    if passed[i0] == 7:
-                        if chi[i0] < 0.5:
-                            xc[3,i0] = xi[i]
-                            yc[3,i0] = yi[i]
-                            pc[3,i0] = pi[i]
-                            tc[3,i0] = ti[i]
-                            age[3,i0] = ir_start[i0] - itime
-                            passed[i0] = 5
-                            nhits[3] += 1
-                    if passed[i0] == 5:
-                        if chi[i0] < 0.3:
-                            xc[4,i0] = xi[i]
-                            yc[4,i0] = yi[i]
-                            pc[4,i0] = pi[i]
-                            tc[4,i0] = ti[i]
-                            age[4,i0] = ir_start[i0] - itime
-                            passed[i0] = 3
-                            nhits[4] += 1
-                    if passed[i0] == 3:
-                        if chi[i0] < 0.1:
-                            xc[5,i0] = xi[i]
-                            yc[5,i0] = yi[i]
-                            pc[5,i0] = pi[i]
-                            tc[5,i0] = ti[i]
-                            age[5,i0] = ir_start[i0] - itime
-                            passed[i0] = 1
-                            nhits[5] += 1
-    return nhits
+    for c in prange(nchunks):
+        for i in range(bounds[c],bounds[c+1]):
+            i0 = idx_back[i]-idx_orgn
+            # consider only the live parcel
+            if flag[i0] & I_DEAD ==0:
+                # find integer coordinates of closest location on the mesh
+                # It is assumed no point outside the domain
+                xig = int(math.floor((xi[i]-Lo1)/dlo+0.5))
+                yig = int(math.floor((yi[i]-La1)/dla+0.5))
+                xfg = int(math.floor((xf[i]-Lo1)/dlo+0.5))
+                yfg = int(math.floor((yf[i]-La1)/dla+0.5))
+                # find the meshes on the path 
+                ll = line(xig,yig,xfg,yfg)
+                # calculate mean detrainment on the path
+                detr = 0.
+                for j in range(len(ll)):
+                    detr += udr[hyb[i],ll[j][1],ll[j][0]]
+                detr = detr/len(ll)
+                # erode the parcel
+                if detr >= detr_offset:
+                    newchi = chi[i0] * math.exp(-3600*detr)
+                    xm = min(nlon-1,max(0,int(0.5*(xig+xfg))+xshift))
+                    ym = min(nlat-1,max(0,int(0.5*(yig+yfg))+yshift))
+                    source_loc[c,ym,xm] += chi[i0] - newchi
+                    pl_loc[c,int(mask[ym,xm])] += chi[i0] - newchi
+                    chi[i0] = newchi
+                    if passed[i0] >1:
+                        if passed[i0] == 10:
+                            if chi[i0] < 0.9:
+                                xc[1,i0] = xi[i]
+                                yc[1,i0] = yi[i]
+                                pc[1,i0] = pi[i]
+                                tc[1,i0] = ti[i]
+                                age[1,i0] = ir_start[i0] - itime
+                                flag[i0] |= I_HIT
+                                passed[i0] = 9
+                                nhits[c,1] += 1
+                        if passed[i0] == 9:
+                            if chi[i0] < 0.7:
+                                xc[2,i0] = xi[i]
+                                yc[2,i0] = yi[i]
+                                pc[2,i0] = pi[i]
+                                tc[2,i0] = ti[i]
+                                age[2,i0] = ir_start[i0] - itime
+                                passed[i0] = 7
+                                nhits[c,2] += 1
+                        if passed[i0] == 7:
+                            if chi[i0] < 0.5:
+                                xc[3,i0] = xi[i]
+                                yc[3,i0] = yi[i]
+                                pc[3,i0] = pi[i]
+                                tc[3,i0] = ti[i]
+                                age[3,i0] = ir_start[i0] - itime
+                                passed[i0] = 5
+                                nhits[c,3] += 1
+                        if passed[i0] == 5:
+                            if chi[i0] < 0.3:
+                                xc[4,i0] = xi[i]
+                                yc[4,i0] = yi[i]
+                                pc[4,i0] = pi[i]
+                                tc[4,i0] = ti[i]
+                                age[4,i0] = ir_start[i0] - itime
+                                passed[i0] = 3
+                                nhits[c,4] += 1
+                        if passed[i0] == 3:
+                            if chi[i0] < 0.1:
+                                xc[5,i0] = xi[i]
+                                yc[5,i0] = yi[i]
+                                pc[5,i0] = pi[i]
+                                tc[5,i0] = ti[i]
+                                age[5,i0] = ir_start[i0] - itime
+                                passed[i0] = 1
+                                nhits[c,5] += 1
+    for c in range(nchunks):
+        source += source_loc[c]
+        pl += pl_loc[c]
+    return nhits.sum(axis=0)
 
 #%%
 """ Function related to ECMWF read """
 
-def read_ECMWF(date,rea):
+def read_ECMWF(date,rea='ERA5'):
     """ Script reading the ECMWF data.
     Not a generator as this is synchronized with the 1h part slice.
+    Called through the SliceCache which stores UDR/RHO and SP.
     The data are assumed valid over the 1h period that follows the timestamp.
     This is quite OK for UDR as this quantity is defined as a mean/accumuation over
     this one-hour period.
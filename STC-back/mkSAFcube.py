@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Preprocessing of the SAFNWC cloud top pressure for the convsrcSAF back runs.
+
+For each image of a month, the CTTH_PRESS and CT fields are read and regridded
+as in convsrcSAFFullBack. Each zone of the pixmap is filtered by cloud type and
+stored in a time cube of uint16 hPa with its validity table (see pylib/satcube.py).
+The runs started with the -c option then memory-map the cubes of the months they
+cover instead of reading the images.
+
+The cube of a month contains the images from the last one of the month to the
+first one, that is the images valid from the first of the month at 0h to the
+first of the next month at 0h.
+
+Usage:
+python mkSAFcube.py -y 2017 -m 8 -ct silviahigh
+
+@author: Bernard Legras
+"""
+import socket
+import os
+import argparse
+from datetime import datetime
+import numpy as np
+import geosat
+from satcube import CubeWriter, ZONES, cube_path
+from background import background
+from convsrcSAFFullBack import read_grid, pixmap
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-y","--year",type=int,help="year")
+    parser.add_argument("-m","--month",type=int,choices=1+np.arange(12),help="month")
+    parser.add_argument("-ct","--cloud_type",type=str,choices=["meanhigh","veryhigh","silviahigh"],help="cloud type filter")
+
+    if 'ciclad' in socket.gethostname():
+        main_sat_dir = '/data/legras/flexpart_in/SAFNWC'
+    elif ('climserv' in socket.gethostname()) | ('polytechnique' in socket.gethostname()):
+        main_sat_dir = '/data/legras/flexpart_in/SAFNWC'
+    else:
+         print ('CANNOT RECOGNIZE HOST - DO NOT RUN ON NON DEFINED HOSTS')
+         exit()
+
+    year = 2017
+    month = 8
+    cloud_type = 'silviahigh'
+    args = parser.parse_args()
+    if args.year is not None: year = args.year
+    if args.month is not None: month = args.month
+    if args.cloud_type is not None: cloud_type = args.cloud_type
+
+    satdir ={'MSG1':os.path.join(main_sat_dir,'msg1','S_NWC'),\
+             'Hima':os.path.join(main_sat_dir,'himawari','S_NWC')}
+    cube_dir = cube_path(os.path.join(main_sat_dir,'cube'),cloud_type,datetime(year,month,1))
+    mdate = datetime(year,month,1)
+    edate = datetime(year+month//12,month%12+1,1)
+
+    gg = geosat.GeoGrid('FullAMA_SAFBox')
+    satmap = pixmap(gg)
+    for zone in ZONES:
+        dtRange = satmap.zone[zone]['dtRange']
+        x1 = satmap.zone[zone]['xi']
+        x2 = x1 + satmap.zone[zone]['binx']
+        y1 = satmap.zone[zone]['yi']
+        y2 = y1 + satmap.zone[zone]['biny']
+        writer = CubeWriter(cube_dir,zone,(y2-y1,x2-x1))
+        # the image read at current_time is valid over ]current_time,current_time+dtRange]
+        current_time = edate - dtRange
+        get_sat = background(read_grid(current_time,zone,dtRange,satdir[zone],gg,pre=True))
+        while current_time >= mdate:
+            pm = next(get_sat)
+            if pm is not None:
+                satmap.fill(zone,pm,cloud_type)
+                writer.add(satmap.ptop[y1:y2,x1:x2]/100,pm.attr['lease_time'],pm.attr['date'])
+                del pm
+            current_time -= dtRange
+        writer.close()
+        print(zone,' images ',len(writer.date),' cube ',cube_dir)
+
+if __name__ == '__main__':
+    main()
@@ -193,13 +193,13 @@ if __name__ == '__main__':
     part0['nact_lastO'] = 0
     part0['nact_lastNM'] = 0
     part0['nact_lastNH'] = 0
-    part0['flag'] = np.empty(0,dtype=int)
-    part0['ir_start'] = np.empty(0,dtype=int)
-    part0['x'] = np.empty(0,dtype=float)
-    part0['y'] = np.empty(0,dtype=float)
-    part0['t'] = np.empty(0,dtype=float)
-    part0['p'] = np.empty(0,dtype=float)
-    part0['idx_back'] = np.empty(0,dtype=int)    
+
+    # The parcels are written hour by hour to the part_000 file
+    # numpart and nact are set when closing the file
+    if not os.path.exists(part_dir):
+        os.makedirs(part_dir)
+    newpart0=os.path.join(part_dir,'part_000')
+    wpart0 = io107.Writer107(newpart0,part0)
     # It is assumed that both date_end and date_beg are valid dates for the EN files
     # The scan starts from date_end and proceeds to date_beg backward in time
     date_f = date_end
@@ -243,13 +243,15 @@ if __name__ == '__main__':
             ir_start = - int((date_end - date_current).total_seconds())
             idx1 = numpart
             numpart += bloc_size
-            part0['x'] = np.append(part0['x'],xg) 
-            part0['y'] = np.append(part0['y'],yg)
-            part0['t'] = np.append(part0['t'],T_current)
-            part0['p'] = np.append(part0['p'],P_current)
-            part0['ir_start'] = np.append(part0['ir_start'],np.full(bloc_size,ir_start,dtype=int))
-            part0['idx_back'] = np.append(part0['idx_back'],np.arange(idx1+1,numpart+1,dtype=int))
-            part0['flag'] = np.append(part0['flag'],np.full(bloc_size,31,dtype=int))
+            chunk = {}
+            chunk['x'] = xg
+            chunk['y'] = yg
+            chunk['t'] = T_current.ravel()
+            chunk['p'] = P_current.ravel()
+            chunk['ir_start'] = np.full(bloc_size,ir_start,dtype=int)
+            chunk['idx_back'] = np.arange(idx1+1,numpart+1,dtype=int)
+            chunk['flag'] = np.full(bloc_size,31,dtype=int)
+            wpart0.append(chunk)
             # theta check
             theta_check = T_current*(P_current/p0)**(-kappa)
             if not quiet:
@@ -261,12 +263,5 @@ if __name__ == '__main__':
         date_f = date_p
         date_p = date_f - ENint           
     
-    # final size information 
-    part0['numpart'] = numpart
-    part0['nact'] = numpart
-    
-    # write the result as part_000 file 
-    if not os.path.exists(part_dir):
-        os.makedirs(part_dir)
-    newpart0=os.path.join(part_dir,'part_000')
-    io107.writeidx107(newpart0,part0)
+    # write the result as part_000 file, numpart = nact = number of parcels
+    wpart0.close()
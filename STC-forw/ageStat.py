@@ -165,9 +165,15 @@ thets['hmax'] = hmax
 thets['range_age'] = range_age
 thets['nstep'] = nstep
 
+# x and y are only needed to filter the parcels with respect to the FullAMA domain
+if filtering or filtering_with_return:
+    fields = ['x','y','p','t','idx_back']
+else:
+    fields = ['p','t','idx_back']
+
 l=0
 for step in range(step_start,hmax + step_inc ,step_inc):
-    data = io107.readpart107(step,run_dir,quiet=True)
+    data = io107.readpart107(step,run_dir,quiet=True,fields=fields)
     data['thet'] = data['t'] * (cst.p0/data['p'])**cst.kappa
     y0t = y0[data['idx_back']-IDX_ORGN]   
     ages = step - startime[data['idx_back']-IDX_ORGN]
@@ -242,7 +242,11 @@ sources['live'][(sources['theta']>360) & (sources['y']>=35) & (sources['x']<40)]
 for step in range(step_start,hmax + step_inc ,step_inc):
     print("history-forw> step "+str(step))
     # Read the nactive parcels at current step
-    data = io107.readpart107(step,run_dir,quiet=True)
+    # x and y are only needed to kill the exited parcels
+    if ('FULL' in supertype) & (target == 'FullAMA'):
+        data = io107.readpart107(step,run_dir,quiet=True,fields=['x','y','p','t','idx_back'])
+    else:
+        data = io107.readpart107(step,run_dir,quiet=True,fields=['p','t','idx_back'])
     # Get the list of indexes for the active parcels after removing the offset
     idxsel = data['idx_back']-IDX_ORGN
     # remove this field
@@ -163,12 +163,13 @@ if __name__ == '__main__':
     part0['nact_lastO'] = 0
     part0['nact_lastNM'] = 0
     part0['nact_lastNH'] = 0
-    part0['ir_start'] = np.empty(0,dtype=np.uint32)
-    part0['x'] = np.empty(0,dtype=float)
-    part0['y'] = np.empty(0,dtype=float)
-    part0['t'] = np.empty(0,dtype=float)
-    part0['p'] = np.empty(0,dtype=float)
-    part0['flag'] = np.empty(0,dtype=np.uint32)
+
+    # The parcels are written hour by hour to the part_000 file
+    # numpart and nact are set when closing the file
+    if not os.path.exists(part_dir):
+        os.makedirs(part_dir)
+    newpart0=os.path.join(part_dir,'part_000')
+    wpart0 = io107.Writer107(newpart0,part0)
     
     # Generate the grid of points that will be used with the masked array
     # trick to generate the coordinates of points to be launched
@@ -238,29 +239,24 @@ if __name__ == '__main__':
         # (lower left corner of the embedding mesh cell)
         for i in range(num_temp):
             tt_1d[i] = np.interp(math.log(p_1d[i]),np.log(data.var['P'][:,jy[i],ix[i]]),data.var['T'][:,jy[i],ix[i]])           
-        numpart += num_temp
-        part0['x'] = np.append(part0['x'],x_1d) 
-        part0['y'] = np.append(part0['y'],y_1d)
-        part0['t'] = np.append(part0['t'],tt_1d)
-        part0['p'] = np.append(part0['p'],p_1d)
-        part0['ir_start'] = np.append(part0['ir_start'],np.full(num_temp,ir_start,dtype=np.uint32))
+        chunk = {}
+        chunk['x'] = x_1d
+        chunk['y'] = y_1d
+        chunk['t'] = tt_1d
+        chunk['p'] = p_1d
+        chunk['ir_start'] = np.full(num_temp,ir_start,dtype=np.uint32)
         # add the type of clouds to the standard value 53=0x35 
         # The cloud type is put in the last 8 bits of the 32 bit flag
         # SAFNWC + new parcel + time relative to stampdate
         # cloud_flag 
-        part0['flag'] = np.append(part0['flag'],53 + (ct_1d.astype(np.uint32) << 24))
+        chunk['flag'] = 53 + (ct_1d.astype(np.uint32) << 24)
+        chunk['idx_back'] = (1+numpart+np.arange(num_temp)).astype(np.uint32)
+        wpart0.append(chunk)
+        numpart += num_temp
         # increment of the date
         print('date',current_date,' numpart',numpart)
         current_date = current_date + timedelta(hours=1)
         stdout.flush()
     
-    # final size information 
-    part0['idx_back'] = (1+np.arange(numpart)).astype(np.uint32)
-    part0['numpart'] = numpart
-    part0['nact'] = numpart
-    
-    # write the result as part_000 file 
-    if not os.path.exists(part_dir):
-        os.makedirs(part_dir)
-    newpart0=os.path.join(part_dir,'part_000')
-    io107.writeidx107(newpart0,part0)
\ No newline at end of file
+    # write the result as part_000 file, numpart = nact = number of parcels
+    wpart0.close()
\ No newline at end of file
@@ -188,8 +188,8 @@ sources['live'][(sources['thet']>360) & (sources['y']>=35) & (sources['x']<40)]
 # Loop on steps
 for step in range(step_start,hmax + step_inc ,step_inc):
     print("stat-forw> step "+str(step))
-    # Read the nactive parcels at current step
-    data = io107.readpart107(step,run_dir,quiet=True)
+    # Read the nactive parcels at current step (flag and ir_start not used)
+    data = io107.readpart107(step,run_dir,quiet=True,fields=['x','y','p','t','idx_back'])
     # Get the list of indexes for the active parcels after removing the offset
     idxsel = data['idx_back']-IDX_ORGN
     # Generate the list of ages of active parcels from their launch (in days)
@@ -13,6 +13,9 @@ interpolate to pressure levels
 Data are read on hybrid levels. They can interpolated to pressure levels. Do it on subgrids
 as it is a time consuming procedure.
 
+The grib files are opened with gribindex.GribFile, which reads the messages
+from a sidecar index built at the first opening of each file.
+
 Usage:
 >> from ECMWF_N import ECMWF
 open files for a date (datetime) and a project (VOLC or STC)
@@ -61,11 +64,11 @@ import cartopy.crs as ccrs
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import socket
-from scipy.interpolate import interp1d,RegularGridInterpolator
-from mki2d import tohyb
+from mki2d import tohyb_table
+from gribindex import GribFile
 import constants as cst
 import gzip,pickle
-from numba import jit
+from numba import jit, prange
 #from copy import copy,deepcopy
 
 MISSING = -999
@@ -95,6 +98,211 @@ mymap_sw=colors.ListedColormap(listcolors_sw)
 def strictly_increasing(L):
     return all(x<y for x, y in zip(L, L[1:]))
 
+def sample_grid(field,x,y,Lo1,La1,dlo,dla,hyb=None,mlog=False):
+    """ Bilinear interpolation of a field defined on a regular (lat,lon) grid
+    at the locations (x,y) of the parcels, without building an interpolator.
+    field is either 2D (lat,lon) or 3D (lev,lat,lon). In the 3D case, hyb is
+    the non integer level index of each parcel and the interpolation is also
+    linear in hyb, with the level clipped to the available levels.
+    If mlog is True, the -log of the field is interpolated, as needed for the
+    surface pressure, without allocating the transformed field.
+    Parcels outside the grid (or with NaN hyb) get NaN. """
+    x = np.ascontiguousarray(x,dtype=np.float64)
+    y = np.ascontiguousarray(y,dtype=np.float64)
+    out = np.empty(len(x))
+    if field.ndim == 2:
+        _sample2d(field,x,y,float(Lo1),float(La1),float(dlo),float(dla),mlog,out)
+    else:
+        hyb = np.ascontiguousarray(hyb,dtype=np.float64)
+        _sample3d(field,hyb,x,y,float(Lo1),float(La1),float(dlo),float(dla),mlog,out)
+    return out
+
+@jit(nopython=True,parallel=True,cache=True)
+def _sample2d(field,x,y,Lo1,La1,dlo,dla,mlog,out):
+    nlat, nlon = field.shape
+    for i in prange(len(x)):
+        u = (x[i]-Lo1)/dlo
+        v = (y[i]-La1)/dla
+        # the negated test also catches NaN
+        if not ((u >= 0) and (u <= nlon-1) and (v >= 0) and (v <= nlat-1)):
+            out[i] = np.nan
+            continue
+        ix = min(int(u),nlon-2)
+        jy = min(int(v),nlat-2)
+        px = u - ix
+        py = v - jy
+        f00 = field[jy,ix]
+        f01 = field[jy,ix+1]
+        f10 = field[jy+1,ix]
+        f11 = field[jy+1,ix+1]
+        if mlog:
+            f00 = -np.log(f00)
+            f01 = -np.log(f01)
+            f10 = -np.log(f10)
+            f11 = -np.log(f11)
+        out[i] = (1-px)*(1-py)*f00 + px*(1-py)*f01 + (1-px)*py*f10 + px*py*f11
+    return
+
+@jit(nopython=True,parallel=True,cache=True)
+def _sample3d(field,hyb,x,y,Lo1,La1,dlo,dla,mlog,out):
+    nlev, nlat, nlon = field.shape
+    for i in prange(len(x)):
+        u = (x[i]-Lo1)/dlo
+        v = (y[i]-La1)/dla
+        if not ((u >= 0) and (u <= nlon-1) and (v >= 0) and (v <= nlat-1)) \
+           or np.isnan(hyb[i]):
+            out[i] = np.nan
+            continue
+        ix = min(int(u),nlon-2)
+        jy = min(int(v),nlat-2)
+        px = u - ix
+        py = v - jy
+        lh = min(max(int(np.floor(hyb[i])),0),nlev-2)
+        hc = hyb[i] - lh
+        res = 0.
+        for l in range(2):
+            f00 = field[lh+l,jy,ix]
+            f01 = field[lh+l,jy,ix+1]
+            f10 = field[lh+l,jy+1,ix]
+            f11 = field[lh+l,jy+1,ix+1]
+            if mlog:
+                f00 = -np.log(f00)
+                f01 = -np.log(f01)
+                f10 = -np.log(f10)
+                f11 = -np.log(f11)
+            w = 1-hc if l == 0 else hc
+            res += w*((1-px)*(1-py)*f00 + px*(1-py)*f01 + (1-px)*py*f10 + px*py*f11)
+        out[i] = res
+    return
+
+def column_brackets(xp,x):
+    """ Brackets of the linear interpolation of all the columns of a field
+    (nlev,nlat,nlon) to the levels x (list or array), where the coordinate xp
+    (nlev,nlat,nlon) increases along each column.
+    Returns the index idx of the lower level and the weight w of the upper one,
+    both of shape (len(x),nlat,nlon). As in np.interp, the levels beyond the
+    column get the value at its end (w=0). The brackets are computed once for
+    all the variables interpolated with apply_brackets.
+    In the columns where xp is not increasing (e.g. potential temperature in
+    an inversion), the first bracket from the top (index 0) is used, and the
+    levels without bracket get the value at the top if x < xp[0] and at the
+    bottom otherwise. """
+    xp = np.ascontiguousarray(xp,dtype=np.float64)
+    x = np.ascontiguousarray(x,dtype=np.float64)
+    idx = np.empty((len(x),)+xp.shape[1:],dtype=np.int32)
+    w = np.empty((len(x),)+xp.shape[1:])
+    _brackets(xp,x,idx,w)
+    return idx, w
+
+def apply_brackets(field,idx,w):
+    """ Interpolation of field (nlev,nlat,nlon) with the brackets of
+    column_brackets """
+    out = np.empty(idx.shape)
+    _apply_brackets(field,idx,w,out)
+    return out
+
+@jit(nopython=True,parallel=True,cache=True)
+def _brackets(xp,x,idx,w):
+    nlev, nlat, nlon = xp.shape
+    for jy in prange(nlat):
+        for ix in range(nlon):
+            monotonic = True
+            for l in range(nlev-1):
+                if xp[l+1,jy,ix] <= xp[l,jy,ix]:
+                    monotonic = False
+                    break
+            if not monotonic:
+                _first_brackets(xp[:,jy,ix],x,idx[:,jy,ix],w[:,jy,ix])
+                continue
+            for k in range(len(x)):
+                if x[k] <= xp[0,jy,ix]:
+                    idx[k,jy,ix] = 0
+                    w[k,jy,ix] = 0.
+                elif x[k] >= xp[nlev-1,jy,ix]:
+                    idx[k,jy,ix] = nlev-1
+                    w[k,jy,ix] = 0.
+                else:
+                    # bisection of xp[l] <= x < xp[l+1]
+                    l = 0
+                    u = nlev-1
+                    while u-l > 1:
+                        m = (l+u)//2
+                        if xp[m,jy,ix] <= x[k]: l = m
+                        else: u = m
+                    idx[k,jy,ix] = l
+                    w[k,jy,ix] = (x[k]-xp[l,jy,ix])/(xp[l+1,jy,ix]-xp[l,jy,ix])
+    return
+
+@jit(nopython=True,cache=True)
+def _first_brackets(xp,x,idx,w):
+    # brackets in a single non monotonic column, searched from the top
+    nlev = len(xp)
+    for k in range(len(x)):
+        if x[k] < xp[0]:
+            idx[k] = 0
+        else:
+            idx[k] = nlev-1
+        w[k] = 0.
+        for l in range(nlev-1):
+            if xp[l] == x[k]:
+                idx[k] = l
+                break
+            if min(xp[l],xp[l+1]) < x[k] <= max(xp[l],xp[l+1]):
+                idx[k] = l
+                w[k] = (x[k]-xp[l])/(xp[l+1]-xp[l])
+                break
+    return
+
+@jit(nopython=True,parallel=True,cache=True)
+def _apply_brackets(field,idx,w,out):
+    nk, nlat, nlon = idx.shape
+    for jy in prange(nlat):
+        for ix in range(nlon):
+            for k in range(nk):
+                l = idx[k,jy,ix]
+                if w[k,jy,ix] == 0.:
+                    out[k,jy,ix] = field[l,jy,ix]
+                else:
+                    out[k,jy,ix] = field[l,jy,ix] + w[k,jy,ix]*(field[l+1,jy,ix]-field[l,jy,ix])
+    return
+
+@jit(nopython=True,parallel=True,cache=True)
+def _wmo(T,P,Z,dz,lapse,offset,highbnd,thicktrop,pwmo,Twmo,zwmo,found):
+    # WMO tropopause of each column (see ECMWF_pure._WMO)
+    nl, nlat, nlon = lapse.shape
+    for jy in prange(nlat):
+        for ix in range(nlon):
+            found[jy,ix] = False
+            # explore the levels where the lapse rate exceeds the threshold,
+            # from the bottom, to find the first case where the slope is
+            # maintained over two km
+            # This is required to avoid shallow inversion layers to be confused
+            # with the tropopause
+            for test in range(nl-1,-1,-1):
+                if not (lapse[test,jy,ix] > offset[jy]):
+                    continue
+                # location of the basis of the interval
+                # +1 to account for the shift of the finite difference
+                lev0 = test+1+highbnd
+                lev = lev0-1
+                Deltaz = dz[lev,jy,ix]
+                # performs search above the candidate tropopause
+                search = True
+                while Deltaz < thicktrop:
+                    lev -= 1
+                    Deltaz += dz[lev,jy,ix]
+                    # mean slope over the considered layer
+                    if (T[lev,jy,ix]-T[lev0,jy,ix])/Deltaz < offset[jy]:
+                        search = False
+                        break
+                if search:
+                    found[jy,ix] = True
+                    pwmo[jy,ix] = P[lev0,jy,ix]
+                    Twmo[jy,ix] = T[lev0,jy,ix]
+                    zwmo[jy,ix] = Z[lev0,jy,ix]
+                    break
+    return
+
 # Second order estimate of the first derivative dy/dx for non uniform spacing of x
 d = lambda x,y:(1/(x[2:,:,:]-x[:-2,:,:]))\
                 *((y[2:,:,:]-y[1:-1,:,:])*(x[1:-1,:,:]-x[:-2,:,:])/(x[2:,:,:]-x[1:-1,:,:])\
@@ -640,33 +848,20 @@ class ECMWF_pure(object):
         new.attr['levtype'] = 'pressure'
         new.attr['plev'] = p
         new.attr['levs'] = p
-        pmin = np.min(p)
-        pmax = np.max(p)
+        # linear interpolation in log(p), with the brackets computed once for all
+        # the columns and all the variables
+        # (the pressure increases from the top to the bottom of the columns)
+        idx, w = column_brackets(np.log(self.var['P'][:,nlatmin:nlatmax,nlonmin:nlonmax]),np.log(p))
         for var in varList:
-            new.var[var] = np.empty(shape=(len(p),nlatmax-nlatmin,nlonmax-nlonmin))
-            jyt = 0
-            # big loop that should be paralellized or calling numa for good performance
-            for jys in range(nlatmin,nlatmax):
-                ixt = 0
-                for ixs in range(nlonmin,nlonmax):
-                    # find the range of p in the column
-                    npmin = np.abs(self.var['P'][:,jys,ixs]-pmin).argmin()
-                    npmax = np.abs(self.var['P'][:,jys,ixs]-pmax).argmin()+1
-                    npmin = max(npmin - 3,0)
-                    npmax = min(npmax + 3,self.nlev)
-                    # Better version than the linear interpolation but much too slow
-                    #fint = PchipInterpolator(np.log(self.var['P'][npmin:npmax,jys,ixs]),
-                    #                     self.var[var][npmin:npmax,jys,ixs])
-                    #new.var[var][:,jyt,ixt] = fint(np.log(p))
-                    new.var[var][:,jyt,ixt] = np.interp(np.log(p),np.log(self.var['P'][npmin:npmax,jys,ixs]),self.var[var][npmin:npmax,jys,ixs])
-                    ixt += 1
-                jyt += 1
+            new.var[var] = apply_brackets(self.var[var][:,nlatmin:nlatmax,nlonmin:nlonmax],idx,w)
         return new
 
     def interpolZ(self,z,varList='All',latRange=None,lonRange=None):
         """ interpolate the variables to an altitude level or a set of altitude levels
             vars must be a list of variables or a single varibale
             z must be a list of altitudes inm
+            The brackets of the altitudes are kept in self.zbrackets and reused
+            by the next calls with the same altitudes, domain and Z field.
         """
         if 'Z' not in self.var.keys():
             self._mkz()
@@ -709,28 +904,18 @@ class ECMWF_pure(object):
         new.nlev = len(z)
         new.attr['levtype'] = 'altitude'
         new.attr['levs'] = z
-        zmin = np.min(z)
-        zmax = np.max(z)
+        # linear interpolation in -Z, which increases from the top to the bottom
+        # of the columns
+        # The brackets are searched only if the altitudes, the domain or Z have
+        # changed since the last call.
+        key = (tuple(z),nlatmin,nlatmax,nlonmin,nlonmax)
+        cache = getattr(self,'zbrackets',None)
+        if (cache is None) or (cache['Z'] is not self.var['Z']) or (cache['key'] != key):
+            idx, w = column_brackets(-self.var['Z'][:,nlatmin:nlatmax,nlonmin:nlonmax],-np.asarray(z,dtype=np.float64))
+            self.zbrackets = {'Z':self.var['Z'],'key':key,'idx':idx,'w':w}
         for var in varList:
-            new.var[var] = np.empty(shape=(len(z),nlatmax-nlatmin,nlonmax-nlonmin))
-            jyt = 0
-            # big loop that should be paralellized or calling numa for good performance
-            for jys in range(nlatmin,nlatmax):
-                ixt = 0
-                for ixs in range(nlonmin,nlonmax):
-                    # find the range of z in the column
-                    nzmin = np.abs(self.var['Z'][:,jys,ixs]-zmin).argmin()
-                    nzmax = np.abs(self.var['Z'][:,jys,ixs]-zmax).argmin()+1
-                    nzmin = max(nzmin + 3,self.nlev-1)
-                    nzmax = min(nzmax - 3,0)
-                    # Better version than the linear interpolation but much too slow
-                    #fint = PchipInterpolator(np.log(self.var['P'][npmin:npmax,jys,ixs]),
-                    #                     self.var[var][npmin:npmax,jys,ixs])
-                    #new.var[var][:,jyt,ixt] = fint(np.log(p))
-                    fint = interp1d(-self.var['Z'][nzmax:nzmin,jys,ixs],self.var[var][nzmax:nzmin,jys,ixs])
-                    new.var[var][:,jyt,ixt] =  [fint(-zz) for zz in z]
-                    ixt += 1
-                jyt += 1
+            new.var[var] = apply_brackets(self.var[var][:,nlatmin:nlatmax,nlonmin:nlonmax],
+                                          self.zbrackets['idx'],self.zbrackets['w'])
         return new
 
     def interpolPT(self,pt,varList='All',latRange=None,lonRange=None):
@@ -738,6 +923,7 @@ class ECMWF_pure(object):
             potential tempearture levels
             vars must be a list of variables or a single varibale
             pt must be a list of potential temperatures in K
+            All the levels and variables are interpolated in a single call.
         """
         if 'PT' not in self.var.keys():
             try:
@@ -760,8 +946,6 @@ class ECMWF_pure(object):
                 return
         if type(pt) in [float,int]:
             pt = [pt,]
-        ptrev = [-x for x in pt]
-        #print(ptrev)
         # first determine the boundaries of the domain
         if (latRange == []) | (latRange == None):
             nlatmin = 0
@@ -784,32 +968,14 @@ class ECMWF_pure(object):
         new.attr['levtype'] = 'potential temperature'
         new.attr['levs'] = pt
         new.attr['plev'] = MISSING
-        thetmin = np.min(pt)
-        thetmax = np.max(pt)
+        # linear interpolation in -PT, which increases from the top to the bottom
+        # of the columns, with the brackets computed once for all the columns and
+        # all the variables
+        # In the columns where PT is not monotonic, the highest crossing of each
+        # level is used.
+        idx, w = column_brackets(-self.var['PT'][:,nlatmin:nlatmax,nlonmin:nlonmax],-np.asarray(pt,dtype=np.float64))
         for var in varList:
-            new.var[var] = np.empty(shape=(len(pt),nlatmax-nlatmin,nlonmax-nlonmin))
-            jyt = 0
-            # big loop that should be paralellized or calling numa for good performance
-            for jys in range(nlatmin,nlatmax):
-                ixt = 0
-                for ixs in range(nlonmin,nlonmax):
-                    # find the range of pt in the column assumed ordered from top to bottom
-                    npup = np.abs(self.var['PT'][:,jys,ixs]-thetmax).argmin()
-                    npbot = np.abs(self.var['PT'][:,jys,ixs]-thetmin).argmin()+1
-                    npup = max(npup - 1,0)
-                    npbot = min(npbot + 1,self.nlev)
-                    #if jyt == 20 : print(npup,npbot)
-                    # Test sorting and interpolation with reverse potential temperature to ensure growth
-                    # along x-axis
-                    if np.any(self.var['PT'][npup+1:npbot,jys,ixs]-self.var['PT'][npup:npbot-1,jys,ixs]>0):
-                        #print('sort for ',ixt,jyt)
-                        pts = np.sort(-self.var['PT'][npup:npbot,jys,ixs])
-                        #print(pts)
-                    else:
-                        pts = -self.var['PT'][npup:npbot,jys,ixs]
-                    new.var[var][:,jyt,ixt] = np.interp(ptrev,pts,self.var[var][npup:npbot,jys,ixs])
-                    ixt += 1
-                jyt += 1
+            new.var[var] = apply_brackets(self.var[var][:,nlatmin:nlatmax,nlonmin:nlonmax],idx,w)
         return new
 
     def interpol_part(self,p,x,y,varList='All'):
@@ -830,38 +996,28 @@ class ECMWF_pure(object):
         result = {}
         # test whether fhyb already attached to the instance
         if not hasattr(self,'fhyb'):
-            self.fhyb,void = tohyb()
-        # generate the 2D interpolator of the surface pressure
-        lsp = RegularGridInterpolator((self.attr['lats'],self.attr['lons']),-np.log(self.var['SP']),bounds_error=True)
-        lspi = lsp(np.transpose([y,x]))
+            self.fhyb = tohyb_table()
+        # interpolate the -log surface pressure
+        lspi = sample_grid(self.var['SP'],x,y,self.attr['Lo1'],self.attr['La1'],
+                           self.attr['dlo'],self.attr['dla'],mlog=True)
+        if np.any(np.isnan(lspi)):
+            raise ValueError('parcels outside the domain of the surface pressure')
         # define -log sigma = -log(p) - -log(ps)
         lsig = - np.log(p) - lspi
         # find the non integer hybrib level with offset due to the truncation of levels
         hyb = self.fhyb(np.transpose([lsig,lspi]))-self.attr['levs'][0]+1
-        lhyb = np.floor(hyb).astype(np.int64)
         # flag non valid parcels outside the domain (see discussion in convsrc2)
         # notive that hyb == 100 not flagged as invalid, but clipped below
         non_valid = np.where(hyb>100)[0]
-        # clip lhyb to remove out of bounds problems due to non valid parcels
-        lhyb = np.clip(lhyb,0,99)
         #@@ test the extreme values of sigma end ps
         if np.min(lsig) < - np.log(0.95):
             print('large sigma detected ',np.exp(-np.min(lsig)))
         if np.max(lspi) > -np.log(45000):
             print('small ps detected ',np.exp(-np.max(lspi)))
-        # Horizontal interpolation
-        # clipping to avoid boundary effects for parcels just on the edges (especially on the eastern edge)
-        ix = np.clip(np.floor((x-self.attr['Lo1'])/self.attr['dlo']).astype(np.int64),0,self.nlon-2)
-        jy = np.clip(np.floor((y-self.attr['La1'])/self.attr['dla']).astype(np.int64),0,self.nlat-2)
-        px = ((x - self.attr['Lo1']) %  self.attr['dlo'])/self.attr['dlo']
-        py = ((y - self.attr['La1']) %  self.attr['dla'])/self.attr['dla']
+        # Trilinear interpolation, the levels are clipped within sample_grid
         for var in varList:
-            vhigh = (1-px)*(1-py)*self.var[var][lhyb,jy,ix] + (1-px)*py*self.var[var][lhyb,jy+1,ix] \
-                  + px*(1-py)*self.var[var][lhyb,jy,ix+1] + px*py*self.var[var][lhyb,jy+1,ix+1]
-            vlow  = (1-px)*(1-py)*self.var[var][lhyb+1,jy,ix] + (1-px)*py*self.var[var][lhyb+1,jy+1,ix] \
-                  + px*(1-py)*self.var[var][lhyb+1,jy,ix+1] + px*py*self.var[var][lhyb+1,jy+1,ix+1]
-            hc = hyb - lhyb
-            result[var] = (1-hc)*vhigh + hc*vlow
+            result[var] = sample_grid(self.var[var],x,y,self.attr['Lo1'],self.attr['La1'],
+                                      self.attr['dlo'],self.attr['dla'],hyb=hyb)
             result[var][non_valid] = MISSING
         return result
 
@@ -871,23 +1027,16 @@ class ECMWF_pure(object):
             print('T or P undefined')
             return
         levbnd = {'FULL-EA':[30,90],'FULL-EI':[15,43],'STC':[10,90]}
-        # TODO: find a way to avoid the big loop
-        self.d2d['pcold'] = np.empty(shape=(self.nlat,self.nlon))
-        self.d2d['Tcold'] = np.empty(shape=(self.nlat,self.nlon))
-        if 'Z' in self.var.keys():
-            self.d2d['zcold'] = np.empty(shape=(self.nlat,self.nlon))
         # Calculate the cold point in the discrete profile
         # TO DO: make a smoother version with vertical interpolation
         nc = np.argmin(self.var['T'][levbnd[self.project][0]:levbnd[self.project][1],...],axis=0)\
            + levbnd[self.project][0]
-        for jy in range(self.nlat):
-            for ix in range(self.nlon):
-                self.d2d['pcold'][jy,ix] = self.var['P'][nc[jy,ix],jy,ix]
-                self.d2d['Tcold'][jy,ix] = self.var['T'][nc[jy,ix],jy,ix]
+        # level of the cold point in each column
+        nc = nc[np.newaxis,...]
+        self.d2d['pcold'] = np.take_along_axis(self.var['P'],nc,axis=0)[0]
+        self.d2d['Tcold'] = np.take_along_axis(self.var['T'],nc,axis=0)[0]
         if  'Z' in self.var.keys():
-            for jy in range(self.nlat):
-                for ix in range(self.nlon):
-                    self.d2d['zcold'][jy,ix] = self.var['Z'][nc[jy,ix],jy,ix]
+            self.d2d['zcold'] = np.take_along_axis(self.var['Z'],nc,axis=0)[0]
         return
 
     def _lzrh(self):
@@ -986,7 +1135,6 @@ class ECMWF_pure(object):
                                           + px[k]*self.var['ASLWR'][pos[k]+1,jy,ix] + (1-px[k])*self.var['ASLWR'][pos[k],jy,ix]
         return
 
-    #@jit
     def _WMO(self,highlatOffset=False):
         """ Calculate the WMO tropopause
         When highlatoffset is true the 2K/km criterion is replaced by a 3K/km
@@ -994,13 +1142,7 @@ class ECMWF_pure(object):
         if not set(['T','P']).issubset(self.var.keys()):
             print('T or P undefined')
             return
-        self.d2d['pwmo'] = np.ma.empty(shape=(self.nlat,self.nlon))
-        self.d2d['Twmo'] = np.ma.empty(shape=(self.nlat,self.nlon))
-        if 'Z' in self.var.keys():
-            self.d2d['zwmo'] = np.empty(shape=(self.nlat,self.nlon))
-            zwmo = True
-        else:
-            zwmo = False
+        withz = 'Z' in self.var.keys()
         levbnd = {'FULL-EA':[30,90],'FULL-EI':[15,43],'STC':[10,85]}
         highbnd = levbnd[self.project][0]
         lowbnd =  levbnd[self.project][1]
@@ -1020,58 +1162,31 @@ class ECMWF_pure(object):
                        (self.var['T'][highbnd:lowbnd-1,...] - self.var['T'][highbnd+1:lowbnd,...]) / \
                        (logp[highbnd:lowbnd-1,...]-logp[highbnd+1:lowbnd,...])
 
-        for jy in range(self.nlat):
-            # standard wmo criterion
-            offset = - 0.002
-            thicktrop = 2000
-            # adaptation of the WMO offset at high latitude
-            if highlatOffset & (abs(self.attr['lats'][jy]) > 60): offset = -0.003
-            for ix in range(self.nlon):
-                # location of lapse rate exceeding the threshod
-                slope = list(np.where(lapse[:,jy,ix] > offset)[0])
-                Deltaz = 0.
-                found = False
-                # explore slope to find the first case where the slope is maintained
-                # over two km
-                # This is required to avoid shallow inversion layers to be confused with
-                # the tropopause
-                while not found:
-                    if len(slope)>0: # should be done with try but forbidden with numba
-                        # candidate tropopause
-                        test = slope.pop()
-                    else:
-                        # if all slopes have been processed without finding a suitable tropopause, mask loc
-                        self.d2d['pwmo'][jy,ix] = np.ma.masked
-                        self.d2d['Twmo'][jy,ix] = np.ma.masked
-                        if zwmo: self.d2d['zwmo'][jy,ix] = np.ma.masked
-                        found = True
-                        break
-                    # location of the basis of the interval
-                    # +1 to account for the shift of the finite difference
-                    lev0 = test+1+highbnd
-                    lev = lev0-1
-                    Deltaz = dz[lev,jy,ix]
-                    # performs search above the candidate tropopause
-                    search = True
-                    while Deltaz < thicktrop:
-                        lev -= 1
-                        Deltaz += dz[lev,jy,ix]
-                        # mean slope over the considered layer
-                        if (self.var['T'][lev,jy,ix]-self.var['T'][lev0,jy,ix])/Deltaz < offset:
-                            search = False
-                            break
-                    if search:
-                        found = True
-                        self.d2d['pwmo'][jy,ix] = self.var['P'][lev0,jy,ix]
-                        self.d2d['Twmo'][jy,ix] = self.var['T'][lev0,jy,ix]
-                        if zwmo: self.d2d['zwmo'][jy,ix] = self.var['Z'][lev0,jy,ix]
+        # standard wmo criterion
+        offset = np.full(self.nlat,-0.002)
+        thicktrop = 2000
+        # adaptation of the WMO offset at high latitude
+        if highlatOffset: offset[np.abs(self.attr['lats']) > 60] = -0.003
+        pwmo = np.empty(shape=(self.nlat,self.nlon))
+        Twmo = np.empty(shape=(self.nlat,self.nlon))
+        zwmo = np.empty(shape=(self.nlat,self.nlon))
+        found = np.empty(shape=(self.nlat,self.nlon),dtype=np.bool_)
+        # the Z field is not used when not available
+        Z = self.var['Z'] if withz else self.var['T']
+        _wmo(self.var['T'],self.var['P'],Z,dz,lapse,offset,highbnd,thicktrop,pwmo,Twmo,zwmo,found)
+        # no tropopause found: masked
+        self.d2d['pwmo'] = np.ma.array(pwmo,mask=~found)
+        self.d2d['Twmo'] = np.ma.array(Twmo,mask=~found)
+        if withz:
+            # nan as np.ma.masked stored in the former plain ndarray
+            zwmo[~found] = np.nan
+            self.d2d['zwmo'] = zwmo
         return
 
     def interpol_track(self,p,x,y,varList='All'):
         """ Writing in progress. For the moment, this is a copy of interpol_part.
         Calculate the distance to the cold point and to the LZRH .
-        We use RegularGridInterpolator that allows interpolation to a list of
-        points unlike interp2d."""
+        The surface pressure is interpolated with sample_grid."""
         if 'P' not in self.var.keys():
             self._mkp()
         if varList == 'All':
@@ -1088,10 +1203,12 @@ class ECMWF_pure(object):
         result = {}
         # test whether fhyb already attached to the instance
         if not hasattr(self,'fhyb'):
-            self.fhyb,void = tohyb()
-        # generate the 2D interpolator of the surface log pressure
-        lsp = RegularGridInterpolator((self.attr['lats'],self.attr['lons']),-np.log(self.var['SP']),bounds_error=True)
-        lspi = lsp(np.transpose([y,x]))
+            self.fhyb = tohyb_table()
+        # interpolate the -log surface pressure
+        lspi = sample_grid(self.var['SP'],x,y,self.attr['Lo1'],self.attr['La1'],
+                           self.attr['dlo'],self.attr['dla'],mlog=True)
+        if np.any(np.isnan(lspi)):
+            raise ValueError('parcels outside the domain of the surface pressure')
         # define -log sigma = -log(p) - -log(ps)
         lsig = - np.log(p) - lspi
         # find the non integer hybrib level
@@ -1449,11 +1566,11 @@ class ECMWF(ECMWF_pure):
         self.DI_open = False
         if self.DI_expected:
             try:
-                self.drb = pygrib.open(os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname))
+                self.drb = GribFile(os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname))
                 self.DI_open = True
             except:
                 try:
-                    self.drb = pygrib.open(os.path.join(self.rootdir,date.strftime('DI-true/%Y'),self.dname))
+                    self.drb = GribFile(os.path.join(self.rootdir,date.strftime('DI-true/%Y'),self.dname))
                     self.DI_open = True
                 except:
                     print('cannot open '+os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname))
@@ -1461,17 +1578,17 @@ class ECMWF(ECMWF_pure):
         self.CAMS_open = False
         if self.CAMS_expected:
             try:
-                self.crb = pygrib.open(os.path.join(self.rootdir,date.strftime('MC-true/%Y'),self.camsname))
+                self.crb = GribFile(os.path.join(self.rootdir,date.strftime('MC-true/%Y'),self.camsname))
                 self.CAMS_open = True
                 self.hemis = 'SH' # future: to be dynamically determined
             except:
                 print('cannot open '+os.path.join(self.rootdir,date.strftime('MC-true/%Y'),self.camsname))
         # opening the main EN file
         try:
-            self.grb = pygrib.open(os.path.join(self.rootdir,path1,date.strftime('%Y/%m'),self.fname))
+            self.grb = GribFile(os.path.join(self.rootdir,path1,date.strftime('%Y/%m'),self.fname))
         except:
             try:
-                self.grb = pygrib.open(os.path.join(self.rootdir,path1,date.strftime('%Y'),self.fname))
+                self.grb = GribFile(os.path.join(self.rootdir,path1,date.strftime('%Y'),self.fname))
             except:
                 print('cannot open '+os.path.join(self.rootdir,path1,date.strftime('%Y/%m'),self.fname))
                 # We do not need to open EN if we only want CAMS at 0 and 12 to calculate assimilation increment
@@ -1577,54 +1694,54 @@ class ECMWF(ECMWF_pure):
         self.CF12_open = False
         if self.DI_expected & ~self.DI_open:
             try:
-                self.drb = pygrib.open(os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname))
+                self.drb = GribFile(os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname))
                 self.DI_open = True
             except:
                 try:
-                    self.drb = pygrib.open(os.path.join(self.rootdir,date.strftime('DI-true/%Y'),self.dname))
+                    self.drb = GribFile(os.path.join(self.rootdir,date.strftime('DI-true/%Y'),self.dname))
                     self.DI_open = True
                 except:
                     print('cannot open '+os.path.join(self.rootdir,date.strftime('DI-true/grib/%Y/%m'),self.dname))
         if self.CAMS_expected & ~self.CAMS_open:
             try:
-                self.crb = pygrib.open(os.path.join(self.rootdir,date.strftime('MC-true/%Y'),self.camsname))
+                self.crb = GribFile(os.path.join(self.rootdir,date.strftime('MC-true/%Y'),self.camsname))
                 self.CAMS_open = True
                 self.hemis = 'SH' # future: to be dynamically determined
             except:
                 print('cannot open '+os.path.join(self.rootdir,date.strftime('MC-true/%Y'),self.camsname))
         if self.WT_expected:
             try:
-                self.wrb = pygrib.open(os.path.join(self.rootdir,date.strftime('WT-true/grib/%Y/%m'),self.wname))
+                self.wrb = GribFile(os.path.join(self.rootdir,date.strftime('WT-true/grib/%Y/%m'),self.wname))
                 self.WT_open = True
             except:
                 print('cannot open '+os.path.join(self.rootdir,date.strftime('WT-true/grib/%Y/%m'),self.wname))
         if self.VD_expected:
             try:
-                self.vrb = pygrib.open(os.path.join(self.rootdir,date.strftime('VD-true/grib/%Y/%m'),self.vname))
+                self.vrb = GribFile(os.path.join(self.rootdir,date.strftime('VD-true/grib/%Y/%m'),self.vname))
                 self.VD_open = True
             except:
                 print('cannot open '+os.path.join(self.rootdir,date.strftime('VD-true/grib/%Y/%m'),self.vname))
         if self.DE_expected:
             try:
-                self.derb = pygrib.open(os.path.join(self.rootdir,date.strftime('DE-true/%Y'),self.dename))
+                self.derb = GribFile(os.path.join(self.rootdir,date.strftime('DE-true/%Y'),self.dename))
                 self.DE_open = True
             except:
                 print('cannot open '+os.path.join(self.rootdir,date.strftime('DE-true/%Y'),self.dename))
         if self.x4I_expected:
             try:
-                self.x4Irb = pygrib.open(os.path.join(self.rootdir,date.strftime('EN-true/%Y'),self.x4iname))
+                self.x4Irb = GribFile(os.path.join(self.rootdir,date.strftime('EN-true/%Y'),self.x4iname))
                 self.x4I_open = True
             except:
                 print('cannot open '+os.path.join(self.rootdir,date.strftime('EN-true/%Y'),self.x4iname))
         if self.VOZ_expected:
             try:
-                self.vozrb = pygrib.open(os.path.join(self.rootdir,date.strftime('VO3-true/%Y'),self.vozname))
+                self.vozrb = GribFile(os.path.join(self.rootdir,date.strftime('VO3-true/%Y'),self.vozname))
                 self.VOZ_open = True
             except:
                 print('cannot open '+os.path.join(self.rootdir,date.strftime('VO3-true/%Y'),self.vozname))
         if self.QN_expected:
             try:
-                self.qnrb = pygrib.open(os.path.join(self.rootdir,date.strftime('QN-true/%Y'),self.qnname))
+                self.qnrb = GribFile(os.path.join(self.rootdir,date.strftime('QN-true/%Y'),self.qnname))
                 self.QN_open = True
             except:
                 print('cannot open '+os.path.join(self.rootdir,date.strftime('QN-true/%Y'),self.qnname))
@@ -1637,11 +1754,11 @@ class ECMWF(ECMWF_pure):
                 self.f12name = datef.strftime('ERA5FCST12%Y%m%d.grb')
             try:
                 if project == 'OPZ':
-                    self.f12rb = pygrib.open(os.path.join(self.rootdir,datef.strftime('EN-true/%Y'),self.f12name))
+                    self.f12rb = GribFile(os.path.join(self.rootdir,datef.strftime('EN-true/%Y'),self.f12name))
                     # contrary to initial intention these data are on full grid
                     #self.hemis = 'SH'
                 else:
-                    self.f12rb = pygrib.open(os.path.join(self.rootdir,datef.strftime('FCST12-true/%Y'),self.f12name))
+                    self.f12rb = GribFile(os.path.join(self.rootdir,datef.strftime('FCST12-true/%Y'),self.f12name))
                 self.F12_open = True
                 sp = self.f12rb.select(name='Logarithm of surface pressure',validityTime=self.attr['valTime'])[0]
                 self.var['SPF'] = np.exp(sp['values'])
@@ -1653,7 +1770,7 @@ class ECMWF(ECMWF_pure):
             else: datef = date
             self.cf12name = datef.strftime('OPZCAMS-FCST12-%Y%m%d_SH.grb')
             try:
-                self.cf12rb = pygrib.open(os.path.join(self.rootdir,datef.strftime('MC-true/%Y'),self.cf12name))
+                self.cf12rb = GribFile(os.path.join(self.rootdir,datef.strftime('MC-true/%Y'),self.cf12name))
                 self.CF12_open = True
                 sp = self.cf12rb.select(name='Logarithm of surface pressure',validityTime=self.attr['valTime'])[0]
                 self.var['SPF'] = np.exp(sp['values'])
@@ -2,8 +2,14 @@ import numpy as np
 import geosat
 import os
 import re
+import threading
 from netCDF4 import Dataset
 
+# netCDF-C and HDF5 are not thread-safe: the readers running in several
+# threads (see background.py) must hold this lock from the opening of the
+# files of an image to their closing
+nc_lock = threading.RLock()
+
 class SAFNWC(geosat.PureSat):
     
     def __init__(self,date,sat,typ,BBname=None):
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Iteration of a generator in a background thread.
+
+The generators reading the satellite images (read_sat in the convsrc
+analyses) are consumed one item at a time within the parcel slice loop.
+background runs such a generator in a worker thread, up to depth items
+ahead of the consumer, through a bounded queue. The items are delivered
+in the same order, including the None returned for missing or
+blacklisted images, so that the lease extension of the pixmaps is
+unchanged. An exception in the generator is raised in the consumer.
+io107.prefetch107 reads the part files of the runs in the same way.
+
+Usage:
+>> get_sat = background(read_sat(sdate,...),depth=2)
+>> datsat = next(get_sat)
+
+The numba kernels called by the consumer must release the GIL (nogil=True)
+for the reading to overlap with them. Libraries which are not thread-safe,
+like netCDF-C and HDF5, must be called under a lock shared by all the
+generators (see SAFNWCnc.nc_lock), so that only the rest of the processing,
+e.g. the regridding, runs concurrently.
+
+@author: Bernard Legras
+@licence: CeCILL-C
+"""
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+def background(iterable, depth=2):
+    """ Generator of the items of iterable read in a background thread,
+    at most depth items ahead """
+    fifo = queue.Queue()
+    slots = threading.Semaphore(depth)
+    stop = threading.Event()
+    end = object()
+
+    def worker():
+        items = iter(iterable)
+        while True:
+            slots.acquire()
+            if stop.is_set(): return
+            try:
+                item = next(items)
+            except StopIteration:
+                fifo.put((end, None))
+                return
+            except Exception as e:
+                fifo.put((None, e))
+                return
+            fifo.put((item, None))
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = fifo.get()
+            if error is not None: raise error
+            if item is end: break
+            # free a slot to read the next item
+            slots.release()
+            yield item
+            del item
+    finally:
+        stop.set()
+        slots.release()
+    return
@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Engine of the source attribution of the backward trajectories.
+
+The convsrc analyses of the backward TRACZILLA runs share the same
+processing of the parcels at each output step:
+- matching of the parcels present in two successive part files
+- processing of the deadborne parcels, launched and exited between two
+  outputs
+- processing of the parcels which exit the domain of the run
+- selection of the live parcels and correction of the x periodicity
+- generation of the time slices between two outputs
+- age limit and statistics
+They differ only by the criterion that stops a parcel or attributes it
+a source within a slice (cloud top pressure, detrainment, brightness
+temperature). This criterion is provided as a hit kernel, a subclass of
+HitKernel which processes each slice, and the rest is done once here.
+
+The kernels are numba functions parallelized over the parcels with prange.
+Each parcel only updates its own slot in flag_source and prod0, and the
+counters are reductions. The number of threads is set by the threads
+argument of BackEngine (1 by default, which gives a serial run).
+Kernels which accumulate on a grid use one grid per thread, see
+thread_bounds.
+
+The source fields are stored as prod0['src'][var] with shape (nsrc,numpart).
+Index 0 receives the exits, deadborne and old parcels. For single source
+kernels (nsrc = 1), the fields are returned as 1D arrays. They are float32
+from the start (int32 for the ages in seconds and the flags) and the memory
+budget is printed at the initialization. The int ages of the parcels which
+are not stopped are AGE_UNSET during the run and NaN in the output.
+
+Usage:
+>> from backsrc import BackEngine, HitKernel
+>> class CloudHit(HitKernel):
+>>     def process(self, engine, datpart):
+>>         ...
+>>         return nhits
+>> engine = BackEngine(ftraj,sdate,CloudHit(),granule_size=28800,granule_quanta=6*28800)
+>> prod0 = engine.run()
+
+Several runs, e.g. on different PT levels, are processed in lockstep by
+run_batch, so that the met fields or satellite images of each hour are
+read once for all of them when the kernels share their data source.
+>> prods = run_batch([BackEngine(ftraj,sdate,hit,...) for ftraj in ftrajs])
+
+Regional runs give exit_domain, the domain of the run, so that the exits
+through its sides are distinguished from the exits through the top and
+bottom. The runs whose parcels are not launched by granules (e.g. along
+flight tracks) override the deadborne stage in a subclass of BackEngine,
+and age_bound=None disables the age limit.
+>> engine = BackEngine(ftraj,sdate,CloudHit(),exit_domain=np.array([[-10.,160.],[0.,50.]]))
+
+Long runs can be checkpointed every checkpoint_step hours. The checkpoint
+file (npz) contains prod0 and the state of the loop, and a run started
+with resume=True restarts after the last checkpointed step.
+>> engine = BackEngine(...,checkpoint=ckpt_file,checkpoint_step=120,resume=True)
+
+@author: Bernard Legras
+@licence: CeCILL-C
+"""
+import os
+import sys
+import numpy as np
+from collections import defaultdict
+from datetime import datetime, timedelta
+import numba
+from numba import jit, prange
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from io107 import readidx107, readpart107, prefetch107
+from partmatch import matchkept, missingidx
+
+p0 = 100000.
+I_DEAD = 0x200000
+I_HIT = 0x400000
+I_OLD = 0x800000
+I_CROSSED = 0x2000000
+I_DBORNE =  0x1000000
+I_STOP = I_HIT + I_DEAD
+# int age of the parcels which are not stopped, 0 is the age of the deadborne
+AGE_UNSET = np.iinfo(np.int32).min
+
+# low p cut in the STC traczilla runs
+lowpcut = 3000
+# highpcut in the STC traczilla runs
+highpcut = 50000
+
+class HitKernel(object):
+    """ Base class of the hit criteria.
+    nsrc is the number of source locations kept for each parcel,
+    slicing is 'mid' for slices at the middle of each interval of width
+    slice_width or 'pair' for slices made of the beginning and end of each
+    interval (see slice_mid and slice_pair). """
+    nsrc = 1
+    slicing = 'mid'
+    slice_width = timedelta(minutes=5)
+    age_dtype = 'int'
+
+    def init(self, engine):
+        """ Called once after the allocation of prod0, to add the fields
+        specific to the kernel. """
+        pass
+
+    def start_step(self, engine, partante, partpost):
+        """ Called at the beginning of each step, before the matching. """
+        pass
+
+    def process(self, engine, datpart):
+        """ Processes a slice and returns the number of hits (an int or
+        an array of length nsrc). """
+        return 0
+
+    def report(self, engine, partpost):
+        """ Prints the statistics at the end of each step """
+        flag = engine.prod0['flag_source'][partpost['idx_back']-engine.idx_orgn]
+        nlive = ((flag & I_DEAD) == 0).sum()
+        n_nohit = ((flag & I_HIT) == 0).sum()
+        print('end hour ',engine.hour,'  numact', partpost['nact'], ' nexits',engine.nexits,
+              ' nhits',engine.nhits, ' nlive',nlive,' nohit',n_nohit)
+        # check that nlive + nhits + nexits = numpart, should be true after the first day
+        if engine.numpart != engine.nexits + engine.nhits + nlive + engine.ndborne:
+            print('@@@ ACHTUNG numpart not equal to sum ',engine.numpart,
+                  engine.nexits+engine.nhits+nlive+engine.ndborne)
+
+    def finalize(self, engine):
+        """ Called at the end of the run, before the conversion to float32 """
+        pass
+
+    def state(self):
+        """ Returns a dictionary of the numbers or arrays of the kernel to be
+        checkpointed with the engine. The fields of prod0 are always saved. """
+        return {}
+
+    def restore(self, engine, state):
+        """ Restores the kernel from a checkpoint, after the engine. """
+        pass
+
+class BackEngine(object):
+    """ Main loop on the output steps of a backward run """
+    # attributes of the loop saved in the checkpoints
+    state_keys = ['hour','numpart_s','idx1','nhits','nexits','ndborne','nnew','nold']
+
+    def __init__(self, ftraj, sdate, hit, step=6, hmax=1824, age_bound=44.,
+                 granule_size=28800, granule_quanta=6*28800, verbose=False,
+                 checkpoint=None, checkpoint_step=120, resume=False, threads=1,
+                 exit_domain=None):
+        """ ftraj is the directory of the part files, sdate the date of itime=0,
+        hit a HitKernel, step and hmax the step between outputs and the last
+        output in hours, age_bound the age limit in days (None for no limit)
+        and granule_size, granule_quanta the number of parcels launched at once
+        and within a step.
+        If checkpoint is a file name, the state is saved every checkpoint_step
+        hours and, if resume, the run restarts from this file when it exists.
+        threads is the number of threads used by the numba kernels.
+        exit_domain is the domain [[x0,x1],[y0,y1]] of a regional run, the
+        exits within 4 degrees of its sides are coded 3 to 6. """
+        self.ftraj = ftraj
+        self.hit = hit
+        self.step = step
+        self.hmax = hmax
+        self.dstep = timedelta(hours=step)
+        self.age_bound = age_bound
+        if exit_domain is None:
+            self.lateral = False
+            self.exit_domain = np.zeros((2,2))
+        else:
+            self.lateral = True
+            self.exit_domain = np.asarray(exit_domain,dtype=np.float64)
+        self.granule_size = granule_size
+        self.granule_quanta = granule_quanta
+        self.verbose = verbose
+        self.checkpoint = checkpoint
+        self.checkpoint_step = checkpoint_step
+        self.resume = resume
+        self.threads = min(max(threads,1),numba.config.NUMBA_NUM_THREADS)
+        numba.set_num_threads(self.threads)
+        print('number of threads ',self.threads)
+        # current_date is valid for partpost
+        self.current_date = sdate
+        self.hour = 0
+        self.nhits = np.zeros(hit.nsrc, dtype=int) if hit.nsrc > 1 else 0
+        self.nexits = 0
+        self.ndborne = 0
+        self.nnew = granule_size
+        self.nold = 0
+
+    def init(self):
+        """ Reads part_000 and allocates the result dictionary """
+        # Open the part_000 file that contains the initial positions
+        self.part0 = part0 = readidx107(os.path.join(self.ftraj,'part_000'),quiet=True)
+        print('numpart',part0['numpart'])
+        self.numpart = part0['numpart']
+        self.numpart_s = self.granule_size
+        # check flag is clean
+        print('check flag is clean ',((part0['flag']&I_HIT)!=0).sum(),((part0['flag']&I_DEAD)!=0).sum(),\
+                                     ((part0['flag']&I_CROSSED)!=0).sum())
+        # idx_orgn was not set to 1 but to 0 in M55 and GLO runs
+        self.idx_orgn = part0['idx_orgn']
+        print('IDX_ORGN ',self.idx_orgn)
+        self.idx1 = self.idx_orgn
+        # Build a dictionary to host the results
+        # The fields are allocated in float32 and int32 from the start, as they
+        # only store values (no accumulation), this gives the same result as a
+        # float64 calculation converted at the end
+        nsrc = self.hit.nsrc
+        self.prod0 = prod0 = defaultdict(dict)
+        for var in ['x','y','p','t']:
+            prod0['src'][var] = np.full((nsrc,self.numpart),fill_value=np.nan,dtype=np.float32)
+        if self.hit.age_dtype == 'int':
+            # age in seconds
+            prod0['src']['age'] = np.full((nsrc,self.numpart),fill_value=AGE_UNSET,dtype=np.int32)
+        else:
+            prod0['src']['age'] = np.full((nsrc,self.numpart),fill_value=np.nan,dtype=np.float32)
+        # the flags use the bits up to 0x2000000
+        prod0['flag_source'] = part0['flag'].astype(np.int32)
+        self.hit.init(self)
+        self.budget()
+        # first granule
+        self.partStep = {}
+        self.partStep[0] = {}
+        for var in ['x','y','p','t','idx_back','ir_start']:
+            self.partStep[0][var] = part0[var][:self.granule_size]
+        self.partStep[0]['itime'] = 0
+        print('Initialization completed')
+
+    def run(self):
+        """ Runs the analysis and returns prod0 """
+        self.start()
+        # the part files are read in a background thread, one step ahead
+        for hour, part in prefetch107(self.hours(),self.ftraj,quiet=True):
+            """  MAIN LOOP ON THE PARCEL TIME SLICES  """
+            for datpart in self.begin_step(hour, part):
+                self.nhits += self.hit.process(self, datpart)
+                sys.stdout.flush()
+            self.end_step()
+        return self.finalize()
+
+    def start(self):
+        """ Initializes the run, from the checkpoint if resume """
+        self.init()
+        if self.resume and self.checkpoint is not None and os.path.isfile(self.checkpoint):
+            self.load_checkpoint()
+
+    def hours(self):
+        """ Output hours which remain to be processed """
+        return range(self.hour+self.step,self.hmax+1,self.step)
+
+    def begin_step(self, hour, part):
+        """ Processes the parcels read at hour which are not common with the
+        previous output and returns the generator of the slices """
+        self.memory('memory use')
+        self.hour = hour
+        # Get rid of dictionary no longer used
+        self.partStep.pop(hour-2*self.step, None)
+        self.partStep[hour] = part
+        partante = self.partStep[hour-self.step]
+        partpost = self.partStep[hour]
+        if partpost['nact']>0:
+            print('hour ',hour,'  numact ', partpost['nact'], '  max p ',partpost['p'].max())
+        else:
+            print('hour ',hour,'  numact ', partpost['nact'])
+        # New date valid for partpost
+        self.current_date -= self.dstep
+        self.hit.start_step(self, partante, partpost)
+        live_a, live_p = self.do_step(partante, partpost)
+        return self.slices(partante, partpost, live_a, live_p)
+
+    def end_step(self):
+        """ Age limit, statistics and checkpoint at the end of a step """
+        partante = self.partStep[self.hour-self.step]
+        partpost = self.partStep[self.hour]
+        self.age_limit(partante)
+        self.hit.report(self, partpost)
+        if self.checkpoint is not None and self.hour % self.checkpoint_step == 0:
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        """ Saves prod0 and the state of the loop after the current step.
+        The file is written under a temporary name and then renamed, so that
+        a kill during the writing leaves the previous checkpoint. """
+        arrays = {}
+        for key, value in self.prod0.items():
+            if isinstance(value, dict):
+                for var in value:
+                    arrays['prod0/'+key+'/'+var] = value[var]
+            else:
+                arrays['prod0/'+key] = value
+        for key, value in self.hit.state().items():
+            arrays['hit/'+key] = np.asarray(value)
+        for key in self.state_keys:
+            arrays['loop/'+key] = np.asarray(getattr(self, key))
+        arrays['loop/current_date'] = np.asarray(self.current_date.isoformat())
+        tmp_file = self.checkpoint + '.tmp'
+        with open(tmp_file, 'wb') as fid:
+            np.savez(fid, **arrays)
+        os.replace(tmp_file, self.checkpoint)
+        print('checkpoint saved at hour ',self.hour,flush=True)
+
+    def load_checkpoint(self):
+        """ Restores prod0 and the state of the loop from the checkpoint and
+        reads the part file of the last processed step """
+        state = {}
+        hit_state = {}
+        with np.load(self.checkpoint) as arrays:
+            for name in arrays.files:
+                group, key = name.split('/', 1)
+                if group == 'prod0':
+                    if '/' in key:
+                        key, var = key.split('/')
+                        self.prod0[key][var] = arrays[name]
+                    else:
+                        self.prod0[key] = arrays[name]
+                elif group == 'loop':
+                    state[key] = arrays[name]
+                else:
+                    hit_state[key] = arrays[name]
+        self.current_date = datetime.fromisoformat(str(state.pop('current_date')))
+        for key in state:
+            if state[key].ndim == 0:
+                setattr(self, key, state[key].item())
+            else:
+                setattr(self, key, state[key])
+        self.hit.restore(self, hit_state)
+        if self.hour > 0:
+            self.partStep = {self.hour: readpart107(self.hour,self.ftraj,quiet=True)}
+        print('restart from checkpoint at hour ',self.hour,flush=True)
+
+    def do_step(self, partante, partpost):
+        """ Processes the parcels which are not common to partante and partpost
+        and returns the live parcels of partante and partpost """
+        prod0 = self.prod0
+        """ Select the parcels that are common to the two steps
+        kept_a is a logical field with same length as partante
+        kept_p is a logical field with same length as partpost """
+        kept_a, kept_p = matchkept(partante['idx_back'],partpost['idx_back'])
+        print('kept a, p ',len(kept_a),len(kept_p),kept_a.sum(),kept_p.sum(),'  new ',len(partpost['x'])-kept_p.sum())
+        self.nnew += len(partpost['x'])-kept_p.sum()
+
+        self.deadborne(partpost, kept_p)
+
+        """ PROCESSING OF CROSSED PARCELS """
+        # last known location before crossing stored in the index 0 of src fields
+        if len(kept_a)>0:
+            out = ~kept_a
+            exits = exiter(int((partante['itime']+partpost['itime'])/2), \
+                partante['x'][out],partante['y'][out],partante['p'][out],\
+                partante['t'][out],partante['idx_back'][out],\
+                prod0['flag_source'],prod0['src']['x'],prod0['src']['y'],\
+                prod0['src']['p'],prod0['src']['t'],prod0['src']['age'],\
+                self.part0['ir_start'],self.idx_orgn,self.exit_domain,self.lateral)
+            self.nexits += exits
+            print('exit ',self.nexits, exits, np.sum(out), len(kept_a) - len(kept_p))
+
+        """ PROCESSING OF PARCELS WHICH ARE COMMON TO THE TWO OUTPUTS  """
+        # Select the kept parcels which have not been hit yet
+        if kept_p.sum()==0:
+            live_a, live_p = kept_a, kept_p
+        else:
+            live_a = kept_a & ((prod0['flag_source'][partante['idx_back']-self.idx_orgn] & I_DEAD) == 0)
+            live_p = kept_p & ((prod0['flag_source'][partpost['idx_back']-self.idx_orgn] & I_DEAD) == 0)
+        print('live a, p ',live_a.sum(),live_p.sum())
+
+        """ Correction step that moves partante['x'] to avoid big jumps at the periodicity frontier on the x-axis """
+        diffx = partpost['x'][live_p] - partante['x'][live_a]
+        partante['x'][live_a] += np.where(diffx>180,360.,np.where(diffx<-180,-360.,0.))
+        return live_a, live_p
+
+    def deadborne(self, partpost, kept_p):
+        """ PROCESSING OF DEADBORNE PARCELS
+        Manage the parcels launched during the last step which have already
+        exited and do not appear in partpost (borne dead parcels).
+        These parcels are stored in the last part of partpost, at most
+        the last granule_quanta parcels. """
+        if self.numpart_s < self.numpart:
+            print("manage deadborne",flush=True)
+            self.numpart_s += self.granule_quanta
+            if self.hour == self.step:
+                idx_act = partpost['idx_back']
+            else:
+                idx_act = partpost['idx_back'][-self.granule_quanta:]
+            # Find the indexes of the range [idx1,numpart_s+idx_orgn[ missing in idx_act
+            idx_deadborne = missingidx(self.idx1,self.numpart_s+self.idx_orgn,idx_act)
+            self.set_deadborne(idx_deadborne - self.idx_orgn)
+            self.idx1 = self.numpart_s + self.idx_orgn
+
+    def set_deadborne(self, j):
+        """ Stops the parcels j at their initial location """
+        prod0 = self.prod0
+        prod0['flag_source'][j] |= I_DEAD+I_DBORNE
+        for var in ['x','y','p','t']:
+            prod0['src'][var][0,j] = self.part0[var][j]
+        prod0['src']['age'][0,j] = 0
+        print("number of deadborne ",len(j))
+        self.ndborne += len(j)
+
+    def slices(self, partante, partpost, live_a, live_p):
+        """ Generator of the slices of the step, according to the kernel """
+        if self.hit.slicing == 'pair':
+            gsp = slice_pair(partante,partpost,live_a,live_p,self.current_date,self.dstep,self.hit.slice_width)
+        else:
+            gsp = slice_mid(partante,partpost,live_a,live_p,self.current_date,self.dstep,self.hit.slice_width)
+        if self.verbose: print('built parcel generator for ',self.current_date)
+        return gsp
+
+    def age_limit(self, partante):
+        """ Stops the parcels older than age_bound """
+        if self.age_bound is None:
+            return
+        print("Manage age limit",flush=True)
+        prod0 = self.prod0
+        j_a = partante['idx_back']-self.idx_orgn
+        age_sec = self.part0['ir_start'][j_a]-partante['itime']
+        IIold_o = (age_sec > (self.age_bound-0.25) * 86400) & ((prod0['flag_source'][j_a] & I_STOP)==0)
+        j = j_a[IIold_o]
+        prod0['flag_source'][j] |= I_DEAD+I_OLD
+        for var in ['x','y','p','t']:
+            prod0['src'][var][0,j] = partante[var][IIold_o]
+        prod0['src']['age'][0,j] = age_sec[IIold_o]
+        print("number of IIold ",len(j))
+        self.nold += len(j)
+
+    def finalize(self):
+        """ Converts the ages into float32 (NaN for AGE_UNSET) and squeezes the
+        single source fields """
+        self.memory('memory use before clean')
+        del self.partStep
+        self.hit.finalize(self)
+        prod0 = self.prod0
+        for var in ['age','p','t','x','y']:
+            if prod0['src'][var].dtype == np.int32:
+                unset = prod0['src'][var] == AGE_UNSET
+                prod0['src'][var] = prod0['src'][var].astype(np.float32)
+                prod0['src'][var][unset] = np.nan
+            else:
+                prod0['src'][var] = prod0['src'][var].astype(np.float32,copy=False)
+            if self.hit.nsrc == 1:
+                prod0['src'][var] = prod0['src'][var][0]
+        self.memory('memory use after clean')
+        return prod0
+
+    def budget(self):
+        """ Prints the memory used by prod0 and part0 and an estimate of the
+        memory used by the part files, at most three outputs in memory (see
+        prefetch107) with 7 fields of 8 bytes per parcel """
+        nprod = 0
+        for value in self.prod0.values():
+            if isinstance(value, dict):
+                nprod += sum(a.nbytes for a in value.values())
+            else:
+                nprod += np.asarray(value).nbytes
+        npart0 = sum(a.nbytes for a in self.part0.values() if isinstance(a, np.ndarray))
+        nsteps = 3*7*8*self.numpart
+        print('memory budget: prod0 {:4.2f} gb, part0 {:4.2f} gb, part steps {:4.2f} gb, total {:4.2f} gb'\
+              .format(nprod/2**30,npart0/2**30,nsteps/2**30,(nprod+npart0+nsteps)/2**30),flush=True)
+        return nprod + npart0 + nsteps
+
+    def memory(self, msg):
+        if psutil is not None:
+            memoryUse = psutil.Process(os.getpid()).memory_info()[0]/2**30
+            print(msg+': {:4.2f} gb'.format(memoryUse))
+
+def run_batch(engines):
+    """ Runs several engines in lockstep and returns the list of their prod0.
+    The engines must have the same start date, step and slice width, for
+    instance the runs of several PT levels. The slice k of every engine is
+    processed before the slice k+1 of any of them, so that hit kernels
+    sharing their data source (a SliceCache, or a single kernel instance
+    holding the satellite maps) read each field only once. """
+    for engine in engines:
+        engine.start()
+    ref = engines[0]
+    for engine in engines[1:]:
+        if engine.current_date != ref.current_date or engine.hours() != ref.hours() \
+           or engine.hit.slice_width != ref.hit.slice_width:
+            raise ValueError('engines not in lockstep: '+engine.ftraj+' '+ref.ftraj)
+    readers = [prefetch107(engine.hours(),engine.ftraj,quiet=True) for engine in engines]
+    for parts in zip(*readers):
+        gens = [engine.begin_step(hour, part) for engine, (hour, part) in zip(engines, parts)]
+        for datparts in zip(*gens):
+            for engine, datpart in zip(engines, datparts):
+                engine.nhits += engine.hit.process(engine, datpart)
+            sys.stdout.flush()
+        for engine in engines:
+            engine.end_step()
+    return [engine.finalize() for engine in engines]
+
+#%%
+""" Functions related to the parcel data """
+
+def slice_mid(part_a,part_p,live_a,live_p,current_date,dstep,slice_width):
+    """ Generator of the slices of width slice_width between two outputs,
+    from the latest to the earliest, with the parcels interpolated at the
+    middle of the slice. """
+    nb_slices = int(dstep/slice_width)
+    ta = current_date + dstep
+    tp = current_date
+    tf = ta
+    empty_live = (live_a.sum() == 0)
+    for i in range(nb_slices):
+        ti = tf- slice_width
+        # note that 0.5*(ti+tf) cannot be calculated as we are adding two dates
+        tmid = ti+0.5*(tf-ti)
+        coefa = (tmid-tp)/dstep
+        coefp = (ta-tmid)/dstep
+        dat = {}
+        dat['time'] = tmid
+        if empty_live:
+            dat['idx_back'] = dat['x'] = dat['y'] = dat['p'] = dat['t'] = np.array([])
+            dat['itime']= None
+        else:
+            dat['idx_back'] = part_a['idx_back'][live_a]
+            for var in ['x','y','p','t']:
+                dat[var] = coefa*part_a[var][live_a] + coefp*part_p[var][live_p]
+            dat['itime'] = int(coefa*part_a['itime'] + coefp*part_p['itime'])
+        tf -= slice_width
+        yield dat
+
+def slice_pair(part_a,part_p,live_a,live_p,current_date,dstep,slice_width):
+    """ Generator of the slices of width slice_width between two outputs,
+    from the latest to the earliest. Each slice contains the coordinates
+    of the beginning (xi,yi,pi,tempi) and the end (xf,yf,pf,tempf) of
+    the interval, tp <= ti < tf <= ta. The end of a slice is the beginning
+    of the previous one and is not recalculated. """
+    nb_slices = int(dstep/slice_width+0.0001)
+    ta = current_date + dstep
+    tp = current_date
+    tf = ta
+    empty_live = (live_a.sum() == 0)
+    itime = part_p['itime']
+    names = [('x','x'),('y','y'),('p','p'),('temp','t')]
+    dat = {}
+    if not empty_live:
+        dat['idx_back'] = part_a['idx_back'][live_a]
+        for name, var in names:
+            dat[name+'i'] = part_a[var][live_a]
+    for i in range(nb_slices):
+        ti = tf - slice_width
+        itime -= slice_width.seconds
+        coefai = (ti-tp)/dstep
+        coefpi = (ta-ti)/dstep
+        dat['itime'] = itime
+        if empty_live:
+            dat['idx_back'] = dat['xi'] = dat['yi'] = dat['pi'] = np.array([])
+            dat['xf'] = dat['yf'] = dat['pf'] = []
+            dat['ti'] = dat['tf'] = None
+        else:
+            dat['ti'] = ti
+            dat['tf'] = tf
+            for name, var in names:
+                dat[name+'f'] = dat[name+'i']
+                if i == nb_slices-1:
+                    dat[name+'i'] = part_p[var][live_p]
+                else:
+                    dat[name+'i'] = coefai*part_a[var][live_a] + coefpi*part_p[var][live_p]
+        tf -= slice_width
+        yield dat
+
+#%%
+""" Function managing the exiting parcels.
+Consider only exit through top or bottom, and also through the sides of
+the domain rr if lateral.
+The last location is stored in the index 0 of the src fields. """
+
+@jit(nopython=True,parallel=True,cache=True)
+def exiter(itime, x,y,p,t,idx_back, flag,xc,yc,pc,tc,age, ir_start, idx_orgn, rr, lateral):
+    nexits = 0
+    for i in prange(len(x)):
+        i0 = idx_back[i]-idx_orgn
+        if flag[i0] & I_DEAD == 0:
+            nexits += 1
+            xc[0,i0] = x[i]
+            yc[0,i0] = y[i]
+            tc[0,i0] = t[i]
+            pc[0,i0] = p[i]
+            age[0,i0] = ir_start[i0] - itime
+            if   lateral and y[i] < rr[1,0] + 4.: excode = 6
+            elif lateral and x[i] < rr[0,0] + 4.: excode = 3
+            elif lateral and y[i] > rr[1,1] - 4.: excode = 4
+            elif lateral and x[i] > rr[0,1] - 4.: excode = 5
+            elif p[i] > highpcut - 150: excode = 1
+            elif p[i] < lowpcut  + 15 : excode = 2
+            else:                   excode = 7
+            flag[i0] |= (excode << 13) + I_DEAD + I_CROSSED
+    return nexits
+
+@jit(nopython=True,cache=True)
+def thread_bounds(n, nchunks):
+    """ Bounds of nchunks contiguous chunks of range(n), to be processed
+    by prange(nchunks) with one accumulator per chunk """
+    bounds = np.empty(nchunks+1,dtype=np.int64)
+    for c in range(nchunks+1):
+        bounds[c] = (n*c)//nchunks
+    return bounds
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Grib files read through a persistent index of their messages.
+
+pygrib scans the whole file at each select, that is for each variable of
+each ECMWF instance opened on the daily or monthly files. GribFile is a
+replacement of pygrib.open whose select uses an index of the messages,
+built by a single scan and stored in a sidecar file. The index maps
+(shortName, validityTime, level, step, iterationNumber) of each message
+to its byte offset and length in the grib file. It is rebuilt when the
+size or the modification time of the grib file change.
+
+The sidecar is <grib file>.stcidx when the directory of the grib file is
+writable, and is otherwise put in ~/.cache/gribindex (or index_dir).
+
+Usage:
+>> grb = GribFile(fname)
+>> TT = grb.select(shortName='t',validityTime=1200)
+TT is the list of the matching messages in the order of the file, as
+returned by pygrib. A select on other keys (e.g. name) is passed to pygrib.
+>> grb.close()
+
+@author: Bernard Legras
+@licence: CeCILL-C
+"""
+import os
+import pickle
+import hashlib
+try:
+    import pygrib
+except ImportError:
+    pygrib = None
+
+# keys of the index, in the order of the records
+INDEX_KEYS = ['shortName','validityTime','level','step','iterationNumber']
+SUFFIX = '.stcidx'
+# names used in select which are translated into short names
+SHORT_NAMES = {'Logarithm of surface pressure':'lnsp','Surface pressure':'sp'}
+
+def index_path(fname, index_dir=None):
+    """ Path of the sidecar index of a grib file """
+    if index_dir is None:
+        if os.access(os.path.dirname(os.path.abspath(fname)), os.W_OK):
+            return fname + SUFFIX
+        index_dir = os.path.join(os.path.expanduser('~'),'.cache','gribindex')
+    tag = hashlib.md5(os.path.abspath(fname).encode()).hexdigest()[:12]
+    return os.path.join(index_dir, os.path.basename(fname)+'-'+tag+SUFFIX)
+
+def signature(fname):
+    """ size and modification time of the grib file """
+    st = os.stat(fname)
+    return (st.st_size, st.st_mtime_ns)
+
+def scan_grib(fname):
+    """ Records (INDEX_KEYS values, offset, length) of the messages
+    of a grib file in the order of the file """
+    if pygrib is None:
+        raise ImportError('pygrib is required to index '+fname)
+    records = []
+    grbs = pygrib.open(fname)
+    try:
+        for msg in grbs:
+            keys = tuple(msg[key] if msg.valid_key(key) else None for key in INDEX_KEYS)
+            records.append(keys + (msg['offset'], msg['totalLength']))
+    finally:
+        grbs.close()
+    return records
+
+def write_index(path, sig, records):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # per process temporary file as several workers may index the same file
+    tmp = path+'.'+str(os.getpid())+'.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump({'signature':sig, 'records':records}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def read_index(path, sig):
+    """ Records of the index, or None if it is missing or outdated """
+    try:
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    if index.get('signature') != sig:
+        return None
+    return index['records']
+
+class GribIndex(object):
+    """ Index of the messages of a grib file, loaded from its sidecar
+    or built and stored """
+
+    def __init__(self, fname, index_dir=None):
+        self.fname = fname
+        self.path = index_path(fname, index_dir)
+        sig = signature(fname)
+        self.records = read_index(self.path, sig)
+        if self.records is None:
+            self.records = scan_grib(fname)
+            try:
+                write_index(self.path, sig, self.records)
+            except OSError as e:
+                print('cannot write grib index ', self.path, e)
+        # records of each (shortName, validityTime)
+        self.groups = {}
+        for rec in self.records:
+            self.groups.setdefault(rec[:2], []).append(rec)
+
+    def find(self, **keys):
+        """ (offset, length) of the messages matching keys, in the order
+        of the file; None if some key is not in the index """
+        if not set(keys) <= set(INDEX_KEYS):
+            return None
+        if 'shortName' in keys and 'validityTime' in keys:
+            records = self.groups.get((keys['shortName'], keys['validityTime']), [])
+        else:
+            records = self.records
+        match = [(INDEX_KEYS.index(key), value) for key, value in keys.items()]
+        return [rec[-2:] for rec in records if all(rec[i] == value for i, value in match)]
+
+class GribFile(object):
+    """ Replacement of pygrib.open reading the messages from their offsets """
+
+    def __init__(self, fname, index_dir=None):
+        self.fname = fname
+        self.index = GribIndex(fname, index_dir)
+        self.fid = open(fname, 'rb')
+        # pygrib opened only when a select cannot use the index
+        self.grbs = None
+
+    def select(self, **keys):
+        if 'name' in keys and keys['name'] in SHORT_NAMES:
+            keys = dict(keys)
+            keys['shortName'] = SHORT_NAMES[keys.pop('name')]
+        bounds = self.index.find(**keys)
+        if bounds is None:
+            if self.grbs is None:
+                self.grbs = pygrib.open(self.fname)
+            return self.grbs.select(**keys)
+        if len(bounds) == 0:
+            # as pygrib
+            raise ValueError('no matches found')
+        msgs = []
+        for offset, length in bounds:
+            self.fid.seek(offset)
+            msgs.append(pygrib.fromstring(self.fid.read(length)))
+        return msgs
+
+    def close(self):
+        self.fid.close()
+        if self.grbs is not None:
+            self.grbs.close()
+            self.grbs = None
@@ -12,12 +12,42 @@ name of the file without .gz suffix
 from __future__ import absolute_import, division, print_function
 from __future__ import unicode_literals
 import os
+import re
+import pickle
+import shutil
+import tempfile
 from struct import unpack, pack
-from numpy import asarray,amin,amax
+from numpy import amin,amax,asarray,frombuffer,memmap,ndarray,uint8
+from background import background
 import gzip
+# optional faster backends for gzipped files
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# fields of the 107 format, in the order of the records
+FIELDS107 = ['flag','ir_start','x','y','p','t','idx_back']
+# type of each field in the file
+DTYPES107 = {'flag':'>i4','ir_start':'>i4','x':'>f4','y':'>f4',
+             'p':'>f4','t':'>f4','idx_back':'>i4'}
+# type of each field when read in memory
+OUTTYPES107 = {'flag':'int64','ir_start':'int64','x':'float64','y':'float64',
+               'p':'float64','t':'float64','idx_back':'int64'}
+# size in bytes of the three header records (including record words)
+HEAD107 = 20 + 24 + 32
+# spacing in bytes of the seek points in the index of gzipped files
+GZ_SPACING = 4*2**20
+# number of threads used by isal to compress gzipped files
+GZ_THREADS = 4
 
 ################################
-def readpart107(hour, part_dir, quiet=False):
+def readpart107(hour, part_dir, quiet=False, mmap=False, native=False, fields=None,
+                gzindex=False):
     """ readpart107 reads 'part'
     files generated by traczilla routine partout_stc
     data = readpart(hour,dir) reads the part file for hour
@@ -32,11 +62,13 @@ def readpart107(hour, part_dir, quiet=False):
     #print hourfile_str
     hourfile_tot = os.path.join(part_dir, "part_" + hourfile_str)
     #print hourfile_tot
-    dato = readidx107(hourfile_tot, quiet)
+    dato = readidx107(hourfile_tot, quiet, mmap=mmap, native=native, fields=fields,
+                      gzindex=gzindex)
     return dato
 
 ######################
-def readidx107(fname, quiet=False):
+def readidx107(fname, quiet=False, mmap=False, native=False, fields=None,
+               gzindex=False):
     """ readpart107 reads 'part'
     files generated by traczilla routine partout_stc
     data = readpart(hour,dir) reads the part file for hour
@@ -92,6 +124,21 @@ def readidx107(fname, quiet=False):
                           with first old parcels at time t-12h, then 
                           new parcels at time t-12h (both with their idx_orgn)
 
+    The fields are returned as int64 and float64 arrays.
+    With mmap=True, an uncompressed file is memory-mapped and the fields are
+    returned as read-only big-endian views ('>i4' and '>f4') of the file, which
+    cost nothing until they are used. With native=True in addition, they are
+    converted to native int32 and float32 arrays (see native107).
+    A gzipped file cannot be mapped and is read in memory as usual.
+    fields is an optional list of the fields to be read among
+    flag, ir_start, x, y, p, t, idx_back. The records of the other fields
+    are skipped using their length word and are not present in data.
+    Gzipped files are decompressed in a separate thread when the isal
+    package is available. With gzindex=True and the indexed_gzip package
+    available, a seek-point index of the gzipped file is built at first
+    reading and stored in fname.gzidx, so that the skipped records are no
+    longer inflated (see _opengz107).
+
     A.-S. Tissier/ B. Legras May 2016 : Python version
     """
 
@@ -100,11 +147,64 @@ def readidx107(fname, quiet=False):
 
     # Open the binary file :
     print('open '+fname)
+    if mmap:
+        if os.path.isfile(fname):
+            return _mapidx107(fname, data, quiet, native, fields)
+        if not quiet: print("no plain file to map, read it in memory")
     try:
         fid = open(fname, 'rb')
     except IOError:
         if not quiet: print("try gzipped version")
-        fid=gzip.open(fname+".gz",'rb')
+        fid=_opengz107(fname+".gz", gzindex)
+
+    # Get the three header records
+    _readhead107(fid, data, quiet)
+    fields = _fields107(fields)
+
+     # case provided to read part_000 of M10
+    if data['nact']==0:
+           print("empty trajectory set")
+           for var in fields:
+               data[var]=[]
+           fid.close()
+           return data
+
+    # Get flag, ir_start (launch time), longitude and latitude (in degree),
+    # pressure (in Pascal), temperature (in Kelvin) and idx_back
+    # (mode 0 : index of old parcels in the list at stamp_date -12h;
+    # undefined for new parcels)
+    # (mode 1 : index of current active parcels among the list of parcels at
+    # stamp_date)
+    # The records are decoded in bulk and converted to int64 and float64
+    # as was done by the former struct.unpack decoding
+    for var in FIELDS107:
+        if var not in fields:
+            # skip the record using its length word
+            lrec = unpack('>l', fid.read(4))[0]
+            _skip107(fid, lrec+4)
+            continue
+        fid.read(4)  # first fortran record word (normaly 4 characters, char)
+        data[var] = frombuffer(fid.read(data['nact']*4), dtype=DTYPES107[var])\
+                    .astype(OUTTYPES107[var])
+        fid.read(4)  # last fortran record word
+        if not quiet: _info107(var, data[var])
+
+    # decode flag (commented out as not needed and slowing the reading)
+    #data['sat'] = asarray(data['flag']) & 0xF
+    #data['mod'] = (asarray(data['flag']) & 0x10) >> 4
+    #data['time_style'] = (asarray(data['flag']) & 0x20) >> 5
+    #data['vert_coord'] = (asarray(data['flag']) & 0x40) >> 6
+    #data['source_region'] = (asarray(data['flag']) & 0x1F80) >> 7
+    #print 'vert_coord', data['vert_coord'][0], data['vert_coord'][data['nact']-1]
+
+    # Close the binary file
+    fid.close()
+
+    return data
+
+def _readhead107(fid, data, quiet=False):
+    """ Reads the three header records of a 107 file from the current
+    position of fid and stores their content in the dictionary data """
 
     # Get lhead, outnfmt (format) and mode (=0, index_file; =1, historical file)
     fid.read(4)  # first fortran record word (normaly 4 characters, char)
@@ -116,7 +216,7 @@ def readidx107(fname, quiet=False):
     # Check that the format matches :
     if not data['outnfmt'] == 107:
      raise ValueError('UNKNOWN FILE FORMAT')
-     if not quiet: print(data['lhead'], data['outnfmt'], data['mode']) 
+    if not quiet: print(data['lhead'], data['outnfmt'], data['mode'])
 
     # Get stamp_date (Format YYYYMMDDHHmmss), itime (output time)
     # and step (time step)
@@ -138,87 +238,204 @@ def readidx107(fname, quiet=False):
     data['nact_lastNM'] = unpack('>l', fid.read(4))[0]
     data['nact_lastNH'] = unpack('>l', fid.read(4))[0]
     fid.read(4)  # last fortran record word
-    if not quiet:     
+    if not quiet:
         print(data['numpart'], data['nact'], data['idx_orgn'])
         print(data['nact_lastO'],data['nact_lastNM'],data['nact_lastNH'])
-     
-     # case provided to read part_000 of M10
-    if data['nact']==0:
-           print("empty trajectory set")
-           data['flag']=[]
-           data['ir_start']=[]
-           data['x']=[]
-           data['y']=[]
-           data['p']=[]
-           data['t']=[]
-           data['idx_back']=[]
-           fid.close()
-           return data 
-    # Get flag
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['flag'] = asarray(unpack('>'+str(data['nact'])+'l', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('flag', data['flag'][0], data['flag'][data['nact']-1])
-
-    # Get ir_start (launch time)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['ir_start'] = asarray(unpack('>'+str(data['nact'])+'l', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    #print('ir', data['ir_start'][0], data['ir_start'][data['nact']-1])
-    if not quiet: print('ir', amin(data['ir_start'])/86400., amax(data['ir_start'])/86400.)
-
-    # Get longitude (in degree)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['x'] = asarray(unpack('>'+str(data['nact'])+'f', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('x', amin(data['x']),amax(data['x']))
-
-    # Get latitude (in degree)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['y'] = asarray(unpack('>'+str(data['nact'])+'f', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('y', amin(data['y']),amax(data['y']))
+    return
 
-    # Get the pressure (in Pascal)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['p'] = asarray(unpack('>'+str(data['nact'])+'f', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('p', amin(data['p']),amax(data['p']))
+def _info107(var, field):
+    """ Prints a short diagnostic of a field read from a 107 file """
+    if var in ['flag','idx_back']:
+        print(var, field[0], field[len(field)-1])
+    elif var == 'ir_start':
+        print('ir', amin(field)/86400., amax(field)/86400.)
+    else:
+        print(var, amin(field),amax(field))
+    return
 
-    # Get the temperature (in Kelvin)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['t'] = asarray(unpack('>'+str(data['nact'])+'f', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('t', amin(data['t']),amax(data['t']))
+def _opengz107(fname, gzindex=False):
+    """ Opens a gzipped 107 file for reading with the fastest available backend.
+    With gzindex=True and indexed_gzip installed, the seek-point index stored
+    in fname+'idx' is loaded, or built by a full pass on the file and saved
+    if it does not exist or is older than the file. Seeking is then done
+    by inflating at most GZ_SPACING bytes from the nearest seek point.
+    Otherwise isal decompresses the file in a background thread, which is
+    faster than the standard gzip module used as a last resort.
+    """
+    if gzindex and indexed_gzip is not None:
+        idxname = fname+'idx'
+        fid = indexed_gzip.IndexedGzipFile(fname, spacing=GZ_SPACING)
+        if os.path.isfile(idxname) and os.path.getmtime(idxname) >= os.path.getmtime(fname):
+            fid.import_index(idxname)
+        else:
+            fid.build_full_index()
+            try:
+                fid.export_index(idxname)
+            except (IOError, OSError):
+                print('cannot save gzip index '+idxname)
+        return fid
+    if igzip_threaded is not None:
+        return igzip_threaded.open(fname, 'rb', threads=1)
+    return gzip.open(fname, 'rb')
+
+def _skip107(fid, nbytes):
+    """ Moves forward by nbytes in fid, reading through the data when the
+    file is not seekable as with the threaded gzip reader """
+    if fid.seekable():
+        fid.seek(nbytes, 1)
+    else:
+        while nbytes > 0:
+            nbytes -= len(fid.read(min(nbytes, GZ_SPACING)))
+    return
 
-    # Get idx_back
-    # (mode 0 : index of old parcels in the list at stamp_date -12h;
-    # undefined for new parcels)
-    # (mode 1 : index of current active parcels among the list of parcels at
-    # stamp_date)
-    fid.read(4)  # first fortran record word (normaly 4 characters, char)
-    data['idx_back'] = asarray(unpack('>'+str(data['nact'])+'l', fid.read(data['nact']*4)))
-    fid.read(4)  # last fortran record word
-    if not quiet: print('idx', data['idx_back'][0], data['idx_back'][data['nact']-1])
+def _fields107(fields):
+    """ Checks a list of fields to be read in a 107 file """
+    if fields is None: return FIELDS107
+    for var in fields:
+        if var not in FIELDS107:
+            raise ValueError('UNKNOWN FIELD '+str(var))
+    return fields
+
+def _mapidx107(fname, data, quiet=False, native=False, fields=None):
+    """ Memory-maps an uncompressed 107 file. The header is decoded and
+    the fields are returned as big-endian views on the mapped file. The
+    record length words are checked against nact. """
+    with open(fname, 'rb') as fid:
+        _readhead107(fid, data, quiet)
+    fields = _fields107(fields)
+    nact = data['nact']
+    if nact==0:
+        print("empty trajectory set")
+        for var in fields:
+            data[var]=[]
+        return data
+    mm = memmap(fname, dtype=uint8, mode='r')
+    for k, var in enumerate(FIELDS107):
+        if var not in fields: continue
+        pos = HEAD107 + k*(nact*4+8)
+        if frombuffer(mm[pos:pos+4], dtype='>i4')[0] != nact*4:
+            raise ValueError('WRONG RECORD LENGTH FOR '+var)
+        data[var] = mm[pos+4:pos+4+nact*4].view(DTYPES107[var])
+    if native: native107(data)
+    return data
 
-    # decode flag (commented out as not needed and slowing the reading)
-    #data['sat'] = asarray(data['flag']) & 0xF
-    #data['mod'] = (asarray(data['flag']) & 0x10) >> 4
-    #data['time_style'] = (asarray(data['flag']) & 0x20) >> 5
-    #data['vert_coord'] = (asarray(data['flag']) & 0x40) >> 6
-    #data['source_region'] = (asarray(data['flag']) & 0x1F80) >> 7
-    #print 'vert_coord', data['vert_coord'][0], data['vert_coord'][data['nact']-1]
+def native107(data, fields=None):
+    """ Converts in place the fields of data that have a non native byte
+    order, as those returned by readidx107 with mmap=True, into native
+    int32 and float32 arrays. This is the step where the data are actually
+    read from the disk. Other fields are left unchanged.
+    usage: native107(data,['p','t'])
+    """
+    if fields is None: fields = FIELDS107
+    for var in fields:
+        if isinstance(data.get(var), ndarray) and not data[var].dtype.isnative:
+            data[var] = data[var].astype(data[var].dtype.newbyteorder('='))
+    return data
 
-    # Close the binary file
-    fid.close()
+#############################
+def prefetch107(hours, part_dir, depth=1, quiet=True, **kwargs):
+    """ prefetch107 is a generator of (hour, data) for the part files of
+    the list hours in part_dir, where the files are read by readpart107
+    in a background thread, up to depth files ahead of the one last
+    delivered. With depth=1, the next file is read while the current
+    one is processed, so that at most three steps are in memory in a loop
+    that keeps the previous step. Additional arguments are passed to
+    readpart107. An error in the reading is raised in the caller.
+    The thread is managed by background.
+    usage:
+        for hour, data in prefetch107(range(step,hmax+1,step),ftraj):
+    """
+    return background(((hour, readpart107(hour, part_dir, quiet, **kwargs))
+                       for hour in hours), depth)
 
-    return data
+#############################
+def scan107(run_dir, index_file=None, quiet=True):
+    """ scan107 scans a directory containing the output of a TRACZILLA run
+    and reads only the three header records of every part_XXX file, plain
+    or gzipped (the plain file is retained when both exist).
+    usage: index = scan107(run_dir)
+    index is a dictionary indexed by the hour of each part file containing
+        file: path of the file (with the .gz suffix if gzipped)
+        gz: True if the file is gzipped
+        size, mtime: size and modification time of the file
+        stamp_date, itime, step, numpart, nact, idx_orgn: from the header
+        offsets: dictionary giving for each field the position in bytes of
+                 its first record word in the uncompressed file
+    The index is saved as a pickle file in index_file, by default
+    part_index.pkl in run_dir. The entries of a previous index are kept
+    for the files which have not changed since, so that scan107 can be
+    called repeatedly to follow the progress of a run.
+    """
+    if index_file is None:
+        index_file = os.path.join(run_dir, 'part_index.pkl')
+    try:
+        old = loadidx107(run_dir, index_file)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        old = {}
+    # list the part files
+    files = {}
+    for name in sorted(os.listdir(run_dir)):
+        match = re.match(r'part_(\d{3,})(\.gz)?$', name)
+        if match is None: continue
+        hour = int(match.group(1))
+        if hour in files and match.group(2) is not None: continue
+        files[hour] = name
+    index = {}
+    for hour in sorted(files):
+        fname = os.path.join(run_dir, files[hour])
+        stat = os.stat(fname)
+        if hour in old and old[hour]['file'] == fname and \
+           old[hour]['size'] == stat.st_size and old[hour]['mtime'] == stat.st_mtime:
+            index[hour] = old[hour]
+            continue
+        entry = {'file':fname, 'gz':fname.endswith('.gz'),
+                 'size':stat.st_size, 'mtime':stat.st_mtime}
+        if entry['gz']:
+            fid = _opengz107(fname)
+        else:
+            fid = open(fname, 'rb')
+        try:
+            _readhead107(fid, entry, quiet=True)
+        except Exception as e:
+            # file being written or corrupted
+            print('cannot read header of '+fname, e)
+            continue
+        finally:
+            fid.close()
+        entry['offsets'] = {}
+        for k, var in enumerate(FIELDS107):
+            entry['offsets'][var] = HEAD107 + k*(entry['nact']*4+8)
+        index[hour] = entry
+        if not quiet: print(hour, entry['itime'], entry['numpart'], entry['nact'])
+    with open(index_file, 'wb') as fid:
+        pickle.dump(index, fid, pickle.HIGHEST_PROTOCOL)
+    return index
+
+def loadidx107(run_dir, index_file=None):
+    """ Loads the index of a run directory generated by scan107 """
+    if index_file is None:
+        index_file = os.path.join(run_dir, 'part_index.pkl')
+    with open(index_file, 'rb') as fid:
+        index = pickle.load(fid)
+    return index
+
+def missing107(index, hmax=None):
+    """ Returns the list of hours missing in the index generated by scan107,
+    assuming a constant output interval between the part files """
+    hours = sorted(index)
+    if len(hours) < 2: return []
+    inc = min(b-a for a, b in zip(hours[:-1], hours[1:]))
+    if hmax is None: hmax = hours[-1]
+    return [h for h in range(hours[0], hmax+inc, inc) if h not in index]
 
 #############################
 def writeidx107(fname, data,cmp=False):
     """ writeidx107 writes file under 107 format
     usage: writeidx107(fname,data)
     data is a dictionary containing the data
+    The fields can be lists or numpy arrays of any type, they are
+    converted to 32 bits big-endian and written in bulk.
+    If cmp is True the file is gzipped (fname must then end with .gz)
 
     Description of format 107
     Fortran 32bits binary file is made of records with one control
@@ -233,10 +450,34 @@ def writeidx107(fname, data,cmp=False):
 
     # Open the binary file:
     if cmp:
-        fid=gzip.open(fname,'wb')
+        fid = _opengzw107(fname)
     else:    
         fid = open(fname, 'wb')
 
+    # Write the three header records
+    _writehead107(fid, data)
+
+    # Write flag, ir_start (launch time), longitude and latitude (in degree),
+    # pressure (in Pascal), temperature (in Kelvin) and idx_back
+    # (mode 0 : index of old parcels in the list at stamp_date -12h;
+    # undefined for new parcels)
+    # (mode 1 : index of current active parcels among the list of
+    # parcels at stamp_date)
+    cwd = pack('>l', data['nact']*4)
+    for var in FIELDS107:
+        rec = asarray(data[var]).astype(DTYPES107[var])
+        if len(rec) != data['nact']:
+            raise ValueError('WRONG LENGTH FOR '+var)
+        fid.write(cwd+rec.tobytes()+cwd)
+
+    # Close the file
+    fid.close()
+
+    return
+
+def _writehead107(fid, data):
+    """ Writes the three header records of a 107 file """
+
     if data['lhead'] != 3:
            print('!!!!!')
            print('lhead not equal to 3 : change lhead')
@@ -262,41 +503,109 @@ def writeidx107(fname, data,cmp=False):
     rec = pack('>6l', data['numpart'], data['nact'], data['idx_orgn'],
            data['nact_lastO'],data['nact_lastNM'],data['nact_lastNH'])
     fid.write(cwd+rec+cwd)
-
-    # Write flag
-    cwd = pack('>l', data['nact']*4)
-    rec = pack('>'+str(data['nact'])+'l', *data['flag'])
-    fid.write(cwd+rec+cwd)
-
-    # Write ir_start (launch time)
-    rec = pack('>'+str(data['nact'])+'l', *data['ir_start'])
-    fid.write(cwd+rec+cwd)
-
-    # Write longitude (in degree)
-    rec = pack('>'+str(data['nact'])+'f', *data['x'])
-    fid.write(cwd+rec+cwd)
-
-    # Write latitude (in degree)
-    rec = pack('>'+str(data['nact'])+'f', *data['y'])
-    fid.write(cwd+rec+cwd)
-
-    # Write the pressure (in Pascal)
-    rec = pack('>'+str(data['nact'])+'f', *data['p'])
-    fid.write(cwd+rec+cwd)
-
-    # Write the temperature (in Kelvin)
-    rec = pack('>'+str(data['nact'])+'f', *data['t'])
-    fid.write(cwd+rec+cwd)
-
-    # Write idx_back
-    # (mode 0 : index of old parcels in the list at stamp_date -12h;
-    # undefined for new parcels)
-    # (mode 1 : index of current active parcels among the list of
-    # parcels at stamp_date)
-    rec = pack('>'+str(data['nact'])+'l', *data['idx_back'])
-    fid.write(cwd+rec+cwd)
-
-    # Close the file
-    fid.close()
-
     return
+
+def _opengzw107(fname):
+    """ Opens a gzipped file for writing, compressing with GZ_THREADS
+    threads when isal is available """
+    if igzip_threaded is not None:
+        return igzip_threaded.open(fname, 'wb', threads=GZ_THREADS)
+    return gzip.open(fname, 'wb')
+
+class Writer107(object):
+    """ Incremental writer of 107 files.
+    The parcels are appended by chunks, for instance hour by hour when a
+    part_000 file is generated, and only the current chunk is held in
+    memory. Each field is spooled in a temporary file located in the
+    directory of fname and the 107 file is assembled when closing, where
+    nact is set to the number of appended parcels.
+    usage:
+        wr = Writer107(fname,head,cmp=False)
+        wr.append(chunk)   # as many times as needed
+        wr.close()
+    or used as a context manager.
+    head is a dictionary containing the header values as in writeidx107.
+    numpart is set to nact if it is absent or None.
+    chunk is a dictionary containing the seven fields as arrays of same length.
+    If cmp is True the file is gzipped (fname must then end with .gz).
+    """
+    def __init__(self, fname, head, cmp=False):
+        self.fname = fname
+        self.head = dict(head)
+        self.cmp = cmp
+        self.nact = 0
+        self.spool = {}
+        tmp_dir = os.path.dirname(os.path.abspath(fname))
+        for var in FIELDS107:
+            self.spool[var] = tempfile.TemporaryFile(dir=tmp_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._clear()
+        return False
+
+    def append(self, chunk):
+        """ Appends a chunk of parcels, multidimensional arrays are flattened """
+        n = asarray(chunk['x']).size
+        for var in FIELDS107:
+            rec = asarray(chunk[var]).astype(DTYPES107[var]).ravel()
+            if len(rec) != n:
+                raise ValueError('WRONG LENGTH FOR '+var)
+            self.spool[var].write(rec.tobytes())
+        self.nact += n
+        return
+
+    def close(self):
+        """ Assembles the 107 file from the spooled fields """
+        self.head['nact'] = self.nact
+        if self.head.get('numpart') is None:
+            self.head['numpart'] = self.nact
+        if self.cmp:
+            fid = _opengzw107(self.fname)
+        else:
+            fid = open(self.fname, 'wb')
+        _writehead107(fid, self.head)
+        cwd = pack('>l', self.nact*4)
+        for var in FIELDS107:
+            self.spool[var].seek(0)
+            fid.write(cwd)
+            shutil.copyfileobj(self.spool[var], fid, GZ_SPACING)
+            fid.write(cwd)
+        fid.close()
+        self._clear()
+        return
+
+    def _clear(self):
+        for var in self.spool:
+            self.spool[var].close()
+        self.spool = {}
+        return
+
+def writegen107(fname, head, chunks, cmp=False):
+    """ Writes a 107 file from an iterable or a generator of chunks of
+    parcels using Writer107. Returns the number of written parcels. """
+    with Writer107(fname, head, cmp) as wr:
+        for chunk in chunks:
+            wr.append(chunk)
+    return wr.nact
+
+if __name__ == '__main__':
+    """ Scans a run directory and reports its progress """
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("run_dir",type=str,help="directory of the run")
+    parser.add_argument("-H","--hmax",type=int,help="last expected hour")
+    args = parser.parse_args()
+    index = scan107(args.run_dir, quiet=False)
+    if len(index) == 0:
+        print('no part file found')
+    else:
+        print('number of part files ', len(index))
+        print('first and last hours ', min(index), max(index))
+        print('numpart ', index[min(index)]['numpart'], ' nact at last hour ', index[max(index)]['nact'])
+        print('missing hours ', missing107(index, args.hmax))
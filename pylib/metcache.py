@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Disk cache of hourly meteorological slices with background prefetch.
+
+The back-trajectory source runs read one meteorological slice per hour of
+the parcel slices, and the same hours are decoded again for each PT level
+or month that is processed. The slices produced by a loader (for instance
+read_ECMWF of convsrc2FullBack) are stored once as float32 .npy files, one
+directory per hour, and are read back as memory maps. The next hours are
+decoded by a worker process while the current slice is processed.
+
+Usage:
+>> cache = SliceCache(cache_dir,read_ECMWF,variables=['UDR','SP'],
+>>                    attrs=['Lo1','La1','dlo','dla','levs'],
+>>                    prefetch=2,step=timedelta(hours=-1),end=date_end,
+>>                    max_slices=2000)
+>> dat = cache.get(date)
+>> dat.var['UDR'], dat.attr['Lo1']
+>> cache.close()
+The last slice is kept, so that the kernels of runs processed in lockstep
+(see backsrc.run_batch) get it without reading it again.
+No slice is prefetched beyond end, the date of the last slice of the run.
+
+Size of the cache: a slice of the full ERA5 UDR and SP takes about 50 MB,
+that is about 90 GB for a 76 days backward run. The cache is kept between
+runs, as the runs of successive months share most of their hours. With
+max_slices, the least recently used slices are removed when the cache
+holds more than max_slices slices of the prefix. The jobs sharing a cache
+directory should use the same limit. Without max_slices, the cache grows
+without bound and must be cleaned up by the user, for instance with
+cache.clear() or by removing the directory when the runs are done.
+
+The loader is called as loader(date) and must return an object with var
+and attr dictionaries. When prefetch > 0, it must be picklable (a module
+level function) as it runs in a worker process, and the calling script
+must be protected by if __name__ == '__main__'.
+
+@author: Bernard Legras
+@licence: CeCILL-C
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import multiprocessing
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+class MetSlice(object):
+    """ Slice read from the cache """
+    def __init__(self):
+        self.var = {}
+        self.attr = {}
+
+class SliceCache(object):
+
+    def __init__(self, cache_dir, loader, variables, attrs=None, prefetch=0,
+                 step=None, prefix='', end=None, max_slices=None):
+        """ cache_dir: directory of the cache, created if needed
+        loader: function returning the slice of a date
+        variables: list of the variables of the slice which are cached
+        attrs: list of the attributes which are cached (all if None)
+        prefetch: number of slices decoded in advance
+        step: time step between two successive slices (can be negative
+        for backward runs)
+        prefix: prefix of the slice directories to distinguish several
+        datasets in the same cache_dir
+        end: date of the last slice of the run, not prefetched beyond
+        max_slices: maximum number of slices of the prefix kept in cache_dir
+        (no limit if None) """
+        self.cache_dir = cache_dir
+        self.loader = loader
+        self.variables = list(variables)
+        self.attrs = attrs
+        self.prefetch = prefetch
+        self.step = step
+        self.prefix = prefix
+        self.end = end
+        self.max_slices = max_slices
+        self.pending = {}
+        # last slice, returned again to the kernels of a batch of runs
+        self.last = (None, None)
+        self.nloaded = 0
+        self.nread = 0
+        self.nevicted = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        if prefetch > 0:
+            # spawn rather than fork as the numba threads of the parent
+            # may deadlock a forked child
+            self.pool = ProcessPoolExecutor(max_workers=1,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.pool = None
+
+    def path(self, date):
+        return os.path.join(self.cache_dir, self.prefix+date.strftime('%Y%m%d%H'))
+
+    def get(self, date):
+        """ Returns the slice of date, from the cache if available """
+        if self.last[0] == date:
+            return self.last[1]
+        future = self.pending.pop(date, None)
+        if future is not None:
+            # waits for the worker, the slice is loaded below if it failed
+            try:
+                future.result()
+            except Exception as e:
+                print('error in prefetch', e)
+        if not os.path.isdir(self.path(date)):
+            store_slice(self.path(date), self.loader(date), self.variables, self.attrs)
+            self.nloaded += 1
+        if self.pool is not None:
+            for k in range(1, self.prefetch+1):
+                self._submit(date + k*self.step)
+        self.nread += 1
+        try:
+            dat = load_slice(self.path(date))
+        except FileNotFoundError:
+            # removed meanwhile by another job sharing the cache
+            store_slice(self.path(date), self.loader(date), self.variables, self.attrs)
+            self.nloaded += 1
+            dat = load_slice(self.path(date))
+        self.last = (date, dat)
+        if self.max_slices is not None:
+            # marks the slice as used for the eviction
+            os.utime(self.path(date))
+            self.evict(self.max_slices)
+        return self.last[1]
+
+    def _submit(self, date):
+        if self.end is not None:
+            # end of the run, in the direction of step
+            if (self.step > timedelta(0) and date > self.end) or \
+               (self.step < timedelta(0) and date < self.end):
+                return
+        if date in self.pending or os.path.isdir(self.path(date)):
+            return
+        self.pending[date] = self.pool.submit(_fill, self.path(date), self.loader, date,
+                                              self.variables, self.attrs)
+
+    def slices(self):
+        """ Paths of the slices of the prefix in the cache """
+        return [os.path.join(self.cache_dir, fname) for fname in os.listdir(self.cache_dir)
+                if fname.startswith(self.prefix) and not fname.startswith('.tmp-')]
+
+    def evict(self, max_slices):
+        """ Removes the least recently used slices beyond max_slices,
+        except the current slice and those being prefetched, which are
+        counted even if not yet stored """
+        keep = {self.path(date) for date in self.pending}
+        if self.last[0] is not None:
+            keep.add(self.path(self.last[0]))
+        mtime = {}
+        for path in self.slices():
+            try:
+                mtime[path] = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        nexcess = len(set(mtime) | keep) - max_slices
+        if nexcess <= 0:
+            return
+        old = sorted((path for path in mtime if path not in keep), key=mtime.get)
+        for path in old[:nexcess]:
+            shutil.rmtree(path, ignore_errors=True)
+            self.nevicted += 1
+
+    def clear(self):
+        """ Removes all the slices of the prefix """
+        self.close()
+        for path in self.slices():
+            shutil.rmtree(path, ignore_errors=True)
+        self.last = (None, None)
+
+    def close(self):
+        """ Waits for the pending slices and stops the worker """
+        if self.pool is not None:
+            for future in self.pending.values():
+                try:
+                    future.result()
+                except Exception as e:
+                    print('error in prefetch', e)
+            self.pending = {}
+            self.pool.shutdown()
+            self.pool = None
+
+def _fill(path, loader, date, variables, attrs):
+    if not os.path.isdir(path):
+        store_slice(path, loader(date), variables, attrs)
+
+def store_slice(path, dat, variables, attrs=None):
+    """ Stores the variables and attributes of dat in the directory path.
+    The directory is first written under a temporary name and renamed, so
+    that a slice is either complete or absent, even when several jobs
+    share the cache. """
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        for var in variables:
+            np.save(os.path.join(tmp, var+'.npy'), np.asarray(dat.var[var], dtype=np.float32))
+        if attrs is None:
+            attr = dat.attr
+        else:
+            attr = {key:dat.attr[key] for key in attrs}
+        with open(os.path.join(tmp, 'attr.pkl'), 'wb') as fid:
+            pickle.dump(attr, fid)
+        os.rename(tmp, path)
+    except OSError:
+        # the slice has been stored meanwhile by another job
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+def load_slice(path):
+    """ Reads a slice stored by store_slice, the variables are memory maps """
+    dat = MetSlice()
+    for fname in os.listdir(path):
+        if fname.endswith('.npy'):
+            dat.var[fname[:-4]] = np.load(os.path.join(path, fname), mmap_mode='r')
+    with open(os.path.join(path, 'attr.pkl'), 'rb') as fid:
+        dat.attr = pickle.load(fid)
+    return dat
@@ -11,13 +11,22 @@ an interpolator to the eta coordinate (all commented out here)
 @author: Bernard Legras
 """
 
+import os
+import hashlib
 import numpy as np
 from itertools import chain
 #from scipy.interpolate import CloughTocher2DInterpolator, Akima1DInterpolator
 from scipy.interpolate import CloughTocher2DInterpolator
-import matplotlib.pyplot as plt
+from numba import jit, prange
 
-def tohyb(rea):
+# Directory of the serialized lookup tables
+table_dir = os.path.dirname(os.path.abspath(__file__))
+# Range of the lookup tables in -log sigma and -log ps
+LSIG_RANGE = (0., 4.72)
+LPS_RANGE = (-np.log(110000.), -np.log(45000.))
+
+def half_levels(rea='ERA5'):
+    """ Coefficients alp (Pa) and blp of the half levels of the reanalysis """
     if rea == 'ERA5':
         # Half levels from ECMWF 137 level discretization
         alp=np.array([0.000000, 2.000365, 3.102241, 4.666084, 6.827977,
@@ -139,7 +148,10 @@ def tohyb(rea):
         0.967645227909,0.979662716389,\
         0.988270103931,0.994019448757,\
         0.997630119324,1.000000000000])
-    
+    return alp, blp
+
+def tohyb(rea='ERA5'):
+    alp, blp = half_levels(rea)
     # Definition of full levels
     al = 0.5*(alp[:-1]+alp[1:])
     bl = 0.5*(blp[:-1]+blp[1:])
@@ -189,7 +201,96 @@ def tohyb(rea):
     scorhyb = hybm-fhyb(np.transpose([sigm,psm]))
     return fhyb, scorhyb
 
+def tohyb_table(rea='ERA5', nsig=2000, nps=100, table_file=None):
+    """ Returns a HybTable which can be used in place of the fhyb interpolator
+    of tohyb. The table is calculated from fhyb on a regular grid of nsig x nps
+    points the first time and stored in table_dir as hybtable-<rea>.npz.
+    The stored table is used only if its grid and the digest of the half
+    levels it was built from match the current ones. """
+    if table_file is None:
+        table_file = os.path.join(table_dir,'hybtable-'+rea+'.npz')
+    gsig = np.linspace(LSIG_RANGE[0],LSIG_RANGE[1],nsig)
+    gps = np.linspace(LPS_RANGE[0],LPS_RANGE[1],nps)
+    grid = [gsig[0],gsig[1]-gsig[0],gps[0],gps[1]-gps[0]]
+    source = levels_digest(rea)
+    if os.path.isfile(table_file):
+        tab = HybTable.load(table_file)
+        if tab.table.shape == (nsig,nps) and tab.source == source \
+           and np.allclose([tab.lsig0,tab.dlsig,tab.lps0,tab.dlps],grid,rtol=1e-12,atol=0):
+            return tab
+        print('rebuilding the outdated hybrid level table ',table_file)
+    fhyb, void = tohyb(rea)
+    zsig, zps = np.meshgrid(gsig,gps,indexing='ij')
+    table = fhyb(np.transpose([zsig.ravel(),zps.ravel()])).reshape(nsig,nps)
+    tab = HybTable(table,*grid,source=source)
+    try:
+        tab.save(table_file)
+    except OSError:
+        print('cannot store the hybrid level table in ',table_file)
+    return tab
+
+def levels_digest(rea='ERA5'):
+    """ Digest of the half levels, stored with the table """
+    alp, blp = half_levels(rea)
+    return hashlib.md5(np.concatenate((alp,blp)).astype(np.float64).tobytes()).hexdigest()
+
+class HybTable(object):
+    """ Lookup table of the hybrid level as a function of -log sigma and -log ps
+    on a regular grid, with bilinear interpolation.
+    Like fhyb, it is called with an array of shape (n,2) of the pairs
+    [-log sigma, -log ps] and returns NaN outside the domain of the table or
+    near points where fhyb is not defined. """
+
+    def __init__(self, table, lsig0, dlsig, lps0, dlps, source=''):
+        self.table = np.ascontiguousarray(table, dtype=np.float32)
+        self.lsig0 = float(lsig0)
+        self.dlsig = float(dlsig)
+        self.lps0 = float(lps0)
+        self.dlps = float(dlps)
+        # digest of the half levels the table was built from
+        self.source = source
+
+    def __call__(self, xi):
+        xi = np.asarray(xi, dtype=np.float64)
+        shape = xi.shape[:-1]
+        xi = xi.reshape(-1, 2)
+        out = np.empty(len(xi))
+        _bilinear(np.ascontiguousarray(xi[:,0]), np.ascontiguousarray(xi[:,1]), self.table,
+                  self.lsig0, self.dlsig, self.lps0, self.dlps, out)
+        return out.reshape(shape)
+
+    def save(self, fname):
+        np.savez(fname, table=self.table,
+                 grid=np.array([self.lsig0,self.dlsig,self.lps0,self.dlps]),
+                 source=np.array(self.source))
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as data:
+            # tables stored without source are rebuilt by tohyb_table
+            source = str(data['source']) if 'source' in data else ''
+            return cls(data['table'], *data['grid'], source=source)
+
+@jit(nopython=True, parallel=True, cache=True)
+def _bilinear(lsig, lps, table, lsig0, dlsig, lps0, dlps, out):
+    ns, nps = table.shape
+    for i in prange(len(lsig)):
+        u = (lsig[i]-lsig0)/dlsig
+        v = (lps[i]-lps0)/dlps
+        # the negated test also catches NaN
+        if not ((u >= 0) and (u <= ns-1) and (v >= 0) and (v <= nps-1)):
+            out[i] = np.nan
+            continue
+        i0 = min(int(u), ns-2)
+        j0 = min(int(v), nps-2)
+        a = u - i0
+        b = v - j0
+        out[i] = (1-a)*(1-b)*table[i0,j0] + a*(1-b)*table[i0+1,j0] \
+               + (1-a)*b*table[i0,j0+1] + a*b*table[i0+1,j0+1]
+    return
+
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
     fhyb,scorhyb = tohyb('ERA-I')
     # Calculate the score on the generating points and plot it
     #scoreta = etam-feta(np.transpose([sigm,psm]))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Matching of the parcel indexes between two outputs of a TRACZILLA run.
+
+These functions replace the calls to np.in1d on idx_back in the convsrc
+back-trajectory analyses, which sort both arrays at each step.
+Within a part file, idx_back is increasing or made of a few increasing
+segments (old parcels, then new parcels). When both arrays are sorted,
+the kept parcels are found by a linear merge. Otherwise the arrays are
+sorted by a stable sort (timsort) which is nearly linear on segmented
+data before the merge.
+
+Usage:
+>> from partmatch import matchkept, missingidx
+>> kept_a, kept_p = matchkept(partante['idx_back'],partpost['idx_back'])
+which is equivalent to
+>> kept_a = np.in1d(partante['idx_back'],partpost['idx_back'],assume_unique=True)
+>> kept_p = np.in1d(partpost['idx_back'],partante['idx_back'],assume_unique=True)
+and
+>> idx_deadborne = missingidx(idx1,idx2,idx_act)
+which is equivalent to
+>> idx_theor = np.arange(idx1,idx2)
+>> idx_deadborne = idx_theor[~np.in1d(idx_theor,idx_act,assume_unique=True)]
+
+@author: Bernard Legras
+@licence: CeCILL-C
+"""
+import numpy as np
+from numba import jit
+
+def matchkept(idx_a, idx_p):
+    """ Returns the boolean masks kept_a and kept_p of the elements of idx_a
+    found in idx_p and of the elements of idx_p found in idx_a.
+    Both arrays are assumed to have unique elements. """
+    idx_a = np.ascontiguousarray(idx_a, dtype=np.int64)
+    idx_p = np.ascontiguousarray(idx_p, dtype=np.int64)
+    kept_a = np.zeros(len(idx_a), dtype=np.bool_)
+    kept_p = np.zeros(len(idx_p), dtype=np.bool_)
+    if len(idx_a) == 0 or len(idx_p) == 0:
+        return kept_a, kept_p
+    sorted_a = _increasing(idx_a)
+    sorted_p = _increasing(idx_p)
+    if sorted_a and sorted_p:
+        _merge(idx_a, idx_p, kept_a, kept_p)
+        return kept_a, kept_p
+    # order broken: merge on the sorted arrays and scatter back
+    if sorted_a:
+        order_a = np.arange(len(idx_a))
+    else:
+        order_a = np.argsort(idx_a, kind='stable')
+    if sorted_p:
+        order_p = np.arange(len(idx_p))
+    else:
+        order_p = np.argsort(idx_p, kind='stable')
+    ks_a = np.zeros(len(idx_a), dtype=np.bool_)
+    ks_p = np.zeros(len(idx_p), dtype=np.bool_)
+    _merge(idx_a[order_a], idx_p[order_p], ks_a, ks_p)
+    kept_a[order_a] = ks_a
+    kept_p[order_p] = ks_p
+    return kept_a, kept_p
+
+def missingidx(idx1, idx2, idx_act):
+    """ Returns the indexes in [idx1,idx2[ which are not in idx_act,
+    in increasing order. idx_act does not need to be sorted and can
+    contain indexes outside this interval. """
+    idx_act = np.ascontiguousarray(idx_act, dtype=np.int64)
+    found = np.zeros(max(idx2-idx1, 0), dtype=np.bool_)
+    _mark(idx1, idx2, idx_act, found)
+    return idx1 + np.flatnonzero(~found)
+
+@jit(nopython=True, cache=True)
+def _increasing(a):
+    for i in range(1, len(a)):
+        if a[i] <= a[i-1]:
+            return False
+    return True
+
+@jit(nopython=True, cache=True)
+def _merge(a, b, kept_a, kept_b):
+    i = 0
+    j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            kept_a[i] = True
+            kept_b[j] = True
+            i += 1
+            j += 1
+    return
+
+@jit(nopython=True, cache=True)
+def _mark(idx1, idx2, idx_act, found):
+    for i in range(len(idx_act)):
+        if idx_act[i] >= idx1 and idx_act[i] < idx2:
+            found[idx_act[i]-idx1] = True
+    return
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Storage of the results (prod0) of the convsrc back-trajectory analyses.
+
+prod0 is a dictionary of arrays and of dictionaries of arrays (src). It is
+written in a single HDF5 file (PyTables) where each dictionary is a group
+and each array a compressed CArray. The arrays of the parcels, whose last
+dimension is numpart, are chunked along the parcel axis so that a range of
+parcels or one source index can be read without decompressing the rest.
+The layout is that of deepdish, so that the former .hdf5z/.hdf5b files
+written by dd.io.save can be read by load_prod as well.
+
+Usage:
+>> from prodstore import save_prod, load_prod
+>> save_prod(out_file,prod0)
+read everything (as dd.io.load)
+>> prod0 = load_prod(out_file)
+read only some fields, for the parcels of index in [i1,i2[
+>> prod0 = load_prod(out_file,fields=['flag_source','src/x','src/y'],idx_range=[i1,i2])
+at the end of a run, save with a fallback to pickle
+>> save_prod_or_pickle(out_file,prod0,out_file2)
+
+@author: Bernard Legras
+@licence: CeCILL-C
+"""
+from __future__ import absolute_import, division, print_function
+import pickle
+import numpy as np
+import tables
+
+# size of the chunks along the parcel axis
+CHUNK = 2**18
+
+def save_prod_or_pickle(fname, prod0, fname2):
+    """ Writes prod0 in fname with save_prod, or in the pickle file fname2
+    if save_prod fails. The error of the pickle is raised if it fails too,
+    so that the loss of the results of a run is not silent. """
+    try:
+        save_prod(fname, prod0)
+    except Exception as e:
+        print('error with save_prod ', fname, e)
+        print('saving to pickle ', fname2)
+        with open(fname2, 'wb') as f:
+            pickle.dump(prod0, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def save_prod(fname, prod0, complevel=5, complib='blosc:lz4'):
+    """ Writes prod0 in fname. The number of parcels is taken from
+    prod0['flag_source'] and stored as an attribute of the file. """
+    numpart = len(prod0['flag_source'])
+    filters = tables.Filters(complevel=complevel, complib=complib, shuffle=True)
+    with tables.open_file(fname, mode='w', filters=filters) as h5:
+        h5.root._v_attrs.numpart = numpart
+        _save_group(h5, h5.root, prod0, numpart)
+
+def _save_group(h5, group, dic, numpart):
+    for key, value in dic.items():
+        if isinstance(value, dict):
+            _save_group(h5, h5.create_group(group, key), value, numpart)
+            continue
+        value = np.asarray(value)
+        if value.ndim == 0:
+            h5.create_array(group, key, obj=value)
+            continue
+        if value.shape[-1] == numpart:
+            # chunks along the parcel axis, one chunk per row for 2D fields
+            chunkshape = (1,)*(value.ndim-1) + (min(CHUNK, numpart),)
+        else:
+            chunkshape = None
+        h5.create_carray(group, key, obj=value, chunkshape=chunkshape)
+
+def load_prod(fname, fields=None, idx_range=None):
+    """ Reads fname written by save_prod (or dd.io.save) and returns a
+    dictionary like prod0.
+    fields is a list of paths ('flag_source', 'src/x', or 'src' for the
+    whole group), by default all of them.
+    idx_range = [i1,i2] selects the parcels of index i1 <= i < i2 (index
+    in prod0 arrays, that is idx_back-idx_orgn) in the parcel fields,
+    the other fields are read entirely. """
+    prod0 = {}
+    with tables.open_file(fname, mode='r') as h5:
+        if 'numpart' in h5.root._v_attrs:
+            numpart = int(h5.root._v_attrs.numpart)
+        else:
+            numpart = h5.get_node('/flag_source').shape[-1]
+        if fields is None:
+            fields = [node._v_name for node in h5.list_nodes('/')]
+        for field in fields:
+            node = h5.get_node('/'+field)
+            if isinstance(node, tables.Group):
+                leaves = h5.walk_nodes(node, classname='Leaf')
+            else:
+                leaves = [node]
+            for leaf in leaves:
+                path = leaf._v_pathname.strip('/').split('/')
+                dic = prod0
+                for name in path[:-1]:
+                    dic = dic.setdefault(name, {})
+                dic[path[-1]] = _read_leaf(leaf, numpart, idx_range)
+    return prod0
+
+def _read_leaf(leaf, numpart, idx_range):
+    if idx_range is None or leaf.ndim == 0 or leaf.shape[-1] != numpart:
+        return leaf.read()
+    i1, i2 = idx_range
+    if leaf.ndim == 1:
+        return leaf[i1:i2]
+    return leaf[..., i1:i2]
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time cubes of the cloud top pressure of the SAFNWC images.
+
+The convsrcSAF back runs compare the parcels to the cloud top pressure ptop
+of the last satellite image of each zone (MSG1 and Hima) of the pixmap.
+Instead of reading and regridding the netCDF files of the images in each
+run, the ptop block of each zone, filtered by cloud type, is computed once
+per month (see STC-back/mkSAFcube.py) and stored in a cube directory:
+    <zone>.u16  raw uint16 array (nimages,biny,binx), ptop in hPa, with
+                p0/100 where there is no selected cloud
+    <zone>.npz  validity table: lease and date (in seconds since
+                1970-01-01) of each image and the shape of the cube
+The images are written backward in time, as read by the runs.
+
+A run opens the cubes of all the months with SatCube, which memory-maps
+them. An image is valid over ]lease,date]. As in the runs, a missing image
+extends the lease of the following one to the date of the previous one,
+so that the image used at time t is the one with the smallest date >= t.
+
+Usage:
+writing a cube
+>> cw = CubeWriter(cube_dir,'MSG1',(500,1000))
+>> cw.add(ptop_block,lease_time,date)
+>> cw.close()
+reading
+>> cube = SatCube(cube_months(cube_root,cloud_type,date1,date2))
+>> block, ti, tf = cube.find('MSG1',t)
+the block in Pa is then 100.*block, valid for ti < t <= tf
+
+@author: Bernard Legras
+@licence: CeCILL-C
+"""
+import os
+from datetime import datetime, timedelta
+import numpy as np
+
+EPOCH = datetime(1970,1,1)
+ZONES = ['MSG1','Hima']
+
+def tosec(date):
+    return int((date - EPOCH).total_seconds())
+
+def todate(sec):
+    return EPOCH + timedelta(seconds=int(sec))
+
+def cube_path(cube_root, cloud_type, date):
+    """ Directory of the cube of the month of date """
+    return os.path.join(cube_root, 'SAF-'+cloud_type+date.strftime('-%Y-%m'))
+
+def cube_months(cube_root, cloud_type, date1, date2):
+    """ Directories of the cubes of the months from date1 to date2 """
+    dirs = []
+    month = datetime(date1.year, date1.month, 1)
+    while month <= date2:
+        dirs.append(cube_path(cube_root, cloud_type, month))
+        month = datetime(month.year+month.month//12, month.month%12+1, 1)
+    return dirs
+
+class CubeWriter(object):
+    """ Appends the images of a zone to a cube """
+
+    def __init__(self, cube_dir, zone, shape):
+        os.makedirs(cube_dir, exist_ok=True)
+        self.fname = os.path.join(cube_dir, zone)
+        self.shape = tuple(shape)
+        self.fid = open(self.fname+'.u16.tmp', 'wb')
+        self.lease = []
+        self.date = []
+
+    def add(self, ptop, lease_time, date):
+        """ ptop in hPa, rounded to uint16 """
+        if len(self.date) > 0 and tosec(date) >= self.date[-1]:
+            raise ValueError('images must be added backward in time')
+        ptop = np.asarray(ptop)
+        if ptop.shape != self.shape:
+            raise ValueError('bad shape '+str(ptop.shape))
+        self.fid.write(np.round(ptop).astype(np.uint16).tobytes())
+        self.lease.append(tosec(lease_time))
+        self.date.append(tosec(date))
+
+    def close(self):
+        self.fid.close()
+        np.savez(self.fname+'.npz', lease=np.array(self.lease, dtype=np.int64),
+                 date=np.array(self.date, dtype=np.int64),
+                 shape=np.array((len(self.date),)+self.shape))
+        # the cube is visible only when complete
+        os.replace(self.fname+'.u16.tmp', self.fname+'.u16')
+
+class SatCube(object):
+    """ Memory maps of the cubes of a list of directories (one per month) """
+
+    def __init__(self, cube_dirs, zones=ZONES):
+        self.data = {}
+        self.index = {}
+        self.lease = {}
+        self.date = {}
+        for zone in zones:
+            data = []
+            index = []
+            lease = []
+            date = []
+            for cube_dir in cube_dirs:
+                fname = os.path.join(cube_dir, zone)
+                if not os.path.isfile(fname+'.u16'):
+                    print('no cube for ', zone, ' in ', cube_dir)
+                    continue
+                with np.load(fname+'.npz') as table:
+                    shape = tuple(table['shape'])
+                    lease.append(table['lease'])
+                    date.append(table['date'])
+                if shape[0] == 0:
+                    continue
+                index.append(np.transpose([np.full(shape[0], len(data)), np.arange(shape[0])]))
+                data.append(np.memmap(fname+'.u16', dtype=np.uint16, mode='r', shape=shape))
+            if len(data) == 0:
+                raise FileNotFoundError('no cube for '+zone)
+            date = np.concatenate(date)
+            # decreasing dates over all the months
+            order = np.argsort(-date, kind='stable')
+            self.data[zone] = data
+            self.index[zone] = np.concatenate(index)[order]
+            self.lease[zone] = np.concatenate(lease)[order]
+            self.date[zone] = date[order]
+
+    def find(self, zone, t):
+        """ Returns the ptop block (uint16 hPa) of the image valid at t and
+        the bounds ]ti,tf] of its validity, including the extension over the
+        missing images """
+        date = self.date[zone]
+        # number of images with date >= t
+        k = np.searchsorted(-date, -tosec(t), side='right') - 1
+        if k < 0:
+            raise ValueError('no image after '+str(t)+' for '+zone)
+        tf = todate(date[k])
+        if k+1 < len(date):
+            ti = todate(date[k+1])
+        else:
+            # no earlier image: extended as by missing images
+            ti = datetime.min
+        icube, irec = self.index[zone][k]
+        return self.data[zone][icube][irec], ti, tf
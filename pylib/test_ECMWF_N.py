@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of the interpolations of ECMWF_N against the former versions
+(column by column loops, RegularGridInterpolator), on synthetic fields
+
+@author: Bernard Legras
+"""
+import warnings
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+from ECMWF_N import ECMWF_pure, sample_grid
+import constants as cst
+
+NLEV = 100
+NLAT = 12
+NLON = 16
+
+def make_data():
+    rng = np.random.default_rng(0)
+    dat = ECMWF_pure()
+    eta = np.linspace(0.01, 1, NLEV)
+    dat.attr['am'] = 20000*eta*(1-eta) + 100*(1-eta)
+    dat.attr['bm'] = eta**2
+    dat.attr['levs'] = np.arange(1, NLEV+1)
+    dat.attr['lats'] = np.linspace(-30, 30, NLAT)
+    dat.attr['lons'] = np.linspace(0, 75, NLON)
+    dat.nlev, dat.nlat, dat.nlon = NLEV, NLAT, NLON
+    dat.date = None
+    dat.var['SP'] = 1.e5 + 2000*rng.normal(size=(NLAT, NLON))
+    dat.var['P'] = dat.attr['am'][:,None,None] + dat.attr['bm'][:,None,None]*dat.var['SP']
+    zeta = -7000*np.log(dat.var['P']/1.e5)
+    dat.var['T'] = 290 - 0.0065*np.minimum(zeta, 16000) + 0.002*np.maximum(zeta-20000, 0) \
+                 + 0.1*rng.normal(size=(NLEV, NLAT, NLON))
+    dat.var['U'] = 10*np.sin(zeta/5000) + rng.normal(size=(NLEV, NLAT, NLON))
+    dat.var['PT'] = dat.var['T']*(1.e5/dat.var['P'])**0.286
+    dat.var['Z'] = 7000*np.log(1.e5/dat.var['P'])
+    return dat
+
+def interpolP_loop(dat, p, var, nlatmin=0, nlatmax=NLAT, nlonmin=0, nlonmax=NLON):
+    """ former version of interpolP """
+    pmin = np.min(p)
+    pmax = np.max(p)
+    res = np.empty(shape=(len(p),nlatmax-nlatmin,nlonmax-nlonmin))
+    jyt = 0
+    for jys in range(nlatmin,nlatmax):
+        ixt = 0
+        for ixs in range(nlonmin,nlonmax):
+            npmin = np.abs(dat.var['P'][:,jys,ixs]-pmin).argmin()
+            npmax = np.abs(dat.var['P'][:,jys,ixs]-pmax).argmin()+1
+            npmin = max(npmin - 3,0)
+            npmax = min(npmax + 3,dat.nlev)
+            res[:,jyt,ixt] = np.interp(np.log(p),np.log(dat.var['P'][npmin:npmax,jys,ixs]),dat.var[var][npmin:npmax,jys,ixs])
+            ixt += 1
+        jyt += 1
+    return res
+
+def interpolPT_loop(dat, pt, var):
+    """ former version of interpolPT for monotonic columns """
+    ptrev = [-x for x in pt]
+    thetmin = np.min(pt)
+    thetmax = np.max(pt)
+    res = np.empty(shape=(len(pt),NLAT,NLON))
+    for jys in range(NLAT):
+        for ixs in range(NLON):
+            npup = np.abs(dat.var['PT'][:,jys,ixs]-thetmax).argmin()
+            npbot = np.abs(dat.var['PT'][:,jys,ixs]-thetmin).argmin()+1
+            npup = max(npup - 1,0)
+            npbot = min(npbot + 1,dat.nlev)
+            pts = -dat.var['PT'][npup:npbot,jys,ixs]
+            res[:,jys,ixs] = np.interp(ptrev,pts,dat.var[var][npup:npbot,jys,ixs])
+    return res
+
+def first_crossing(theta, field, pt):
+    """ interpolation at the highest crossing of pt in a column """
+    for l in range(len(theta)-1):
+        if min(theta[l], theta[l+1]) <= pt <= max(theta[l], theta[l+1]) and theta[l] != theta[l+1]:
+            return field[l] + (pt-theta[l])/(theta[l+1]-theta[l])*(field[l+1]-field[l])
+    return field[0] if pt > theta[0] else field[-1]
+
+def test_interpolP():
+    dat = make_data()
+    # including pressures above the top and below the surface
+    p = [50., 1000., 7000., 10000., 25000., 85000., 1.1e5]
+    new = dat.interpolP(p, varList=['T','U'])
+    for var in ['T','U']:
+        assert new.var[var].shape == (len(p), NLAT, NLON)
+        assert np.allclose(new.var[var], interpolP_loop(dat, p, var), rtol=1e-12, atol=1e-10)
+    # subdomain and single level
+    new = dat.interpolP(10000., varList='T', latRange=[-10,20], lonRange=[20,60])
+    assert new.nlev == 1
+    nlatmin = np.abs(dat.attr['lats']+10).argmin()
+    nlatmax = np.abs(dat.attr['lats']-20).argmin()+1
+    nlonmin = np.abs(dat.attr['lons']-20).argmin()
+    nlonmax = np.abs(dat.attr['lons']-60).argmin()+1
+    assert np.allclose(new.var['T'], interpolP_loop(dat, [10000.], 'T', nlatmin, nlatmax, nlonmin, nlonmax),
+                       rtol=1e-12, atol=1e-10)
+
+def test_interpolPT():
+    dat = make_data()
+    # inversions in some columns
+    dat.var['PT'][40:44,2,3] = [300., 297., 301., 296.]
+    dat.var['PT'][10:14,5,7] = dat.var['PT'][13:9:-1,5,7]
+    monotonic = np.all(np.diff(dat.var['PT'],axis=0) < 0, axis=0)
+    assert not monotonic[2,3] and not monotonic[5,7] and monotonic.sum() > NLAT*NLON//2
+    pt = [296.5, 298., 340., 350., 360., 370., 380., 390., 400., 1.e4]
+    new = dat.interpolPT(pt, varList=['T','U'])
+    for var in ['T','U']:
+        assert new.var[var].shape == (len(pt), NLAT, NLON)
+        ref = interpolPT_loop(dat, pt, var)
+        assert np.allclose(new.var[var][:,monotonic], ref[:,monotonic], rtol=1e-12, atol=1e-10)
+        for jy, ix in zip(*np.where(~monotonic)):
+            for k in range(len(pt)):
+                assert np.isclose(new.var[var][k,jy,ix],
+                                  first_crossing(dat.var['PT'][:,jy,ix], dat.var[var][:,jy,ix], pt[k]))
+    # above the top
+    assert np.array_equal(new.var['T'][-1], dat.var['T'][0])
+
+def test_interpolZ():
+    dat = make_data()
+    z = [1000., 5000., 14000., 16500., 20000.]
+    new = dat.interpolZ(z, varList=['T','U'])
+    for var in ['T','U']:
+        ref = np.empty((len(z), NLAT, NLON))
+        for jy in range(NLAT):
+            for ix in range(NLON):
+                # Z decreases along the column
+                ref[:,jy,ix] = np.interp(z, dat.var['Z'][::-1,jy,ix], dat.var[var][::-1,jy,ix])
+        assert np.allclose(new.var[var], ref, rtol=1e-12, atol=1e-10)
+    # brackets reused for the same altitudes
+    idx = dat.zbrackets['idx']
+    new = dat.interpolZ(z, varList='U')
+    assert dat.zbrackets['idx'] is idx
+    new = dat.interpolZ(z[:2], varList='U')
+    assert dat.zbrackets['idx'] is not idx and new.var['U'].shape == (2, NLAT, NLON)
+
+def WMO_loop(dat, highbnd, lowbnd, highlatOffset):
+    """ former version of _WMO """
+    pwmo = np.ma.empty(shape=(NLAT,NLON))
+    Twmo = np.ma.empty(shape=(NLAT,NLON))
+    zwmo = np.empty(shape=(NLAT,NLON))
+    T = dat.var['T']
+    logp = np.log(dat.var['P'])
+    dz = cst.R/cst.g * T[1:,:,:] * (logp[1:,:,:]-logp[:-1,:,:])
+    lapse = - cst.g/cst.R * (1/T[highbnd+1:lowbnd,...]) * \
+                   (T[highbnd:lowbnd-1,...] - T[highbnd+1:lowbnd,...]) / \
+                   (logp[highbnd:lowbnd-1,...]-logp[highbnd+1:lowbnd,...])
+    for jy in range(NLAT):
+        offset = - 0.002
+        thicktrop = 2000
+        if highlatOffset & (abs(dat.attr['lats'][jy]) > 60): offset = -0.003
+        for ix in range(NLON):
+            slope = list(np.where(lapse[:,jy,ix] > offset)[0])
+            found = False
+            while not found:
+                if len(slope)>0:
+                    test = slope.pop()
+                else:
+                    pwmo[jy,ix] = np.ma.masked
+                    Twmo[jy,ix] = np.ma.masked
+                    # converted to nan in the plain ndarray
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore')
+                        zwmo[jy,ix] = np.ma.masked
+                    break
+                lev0 = test+1+highbnd
+                lev = lev0-1
+                Deltaz = dz[lev,jy,ix]
+                search = True
+                while Deltaz < thicktrop:
+                    lev -= 1
+                    Deltaz += dz[lev,jy,ix]
+                    if (T[lev,jy,ix]-T[lev0,jy,ix])/Deltaz < offset:
+                        search = False
+                        break
+                if search:
+                    found = True
+                    pwmo[jy,ix] = dat.var['P'][lev0,jy,ix]
+                    Twmo[jy,ix] = T[lev0,jy,ix]
+                    zwmo[jy,ix] = dat.var['Z'][lev0,jy,ix]
+    return pwmo, Twmo, zwmo
+
+def test_tropopause():
+    dat = make_data()
+    dat.project = 'STC'
+    dat.attr['lats'] = np.linspace(-80, 80, NLAT)
+    zeta = dat.var['Z']
+    # no tropopause
+    dat.var['T'][:,0,0] = 290 - 0.0065*zeta[:,0,0]
+    # shallow inversion below the tropopause
+    dat.var['T'][:,3,4] += 3*np.exp(-((zeta[:,3,4]-8000)/300)**2)
+    # cold point
+    dat.d2d = {}
+    dat._CPT()
+    nc = np.argmin(dat.var['T'][10:90], axis=0) + 10
+    for jy in range(NLAT):
+        for ix in range(NLON):
+            assert dat.d2d['pcold'][jy,ix] == dat.var['P'][nc[jy,ix],jy,ix]
+            assert dat.d2d['Tcold'][jy,ix] == dat.var['T'][nc[jy,ix],jy,ix]
+            assert dat.d2d['zcold'][jy,ix] == dat.var['Z'][nc[jy,ix],jy,ix]
+    # WMO tropopause
+    for highlatOffset in [False, True]:
+        dat._WMO(highlatOffset=highlatOffset)
+        pwmo, Twmo, zwmo = WMO_loop(dat, 10, 85, highlatOffset)
+        mask = np.ma.getmaskarray(pwmo)
+        assert mask[0,0] and mask.sum() < NLAT*NLON//2
+        for var, ref in [('pwmo',pwmo), ('Twmo',Twmo)]:
+            assert np.array_equal(np.ma.getmaskarray(dat.d2d[var]), mask)
+            assert np.array_equal(dat.d2d[var].compressed(), ref.compressed())
+        # zwmo is a plain ndarray, nan where no tropopause is found as before
+        assert not np.ma.isMaskedArray(dat.d2d['zwmo'])
+        assert np.isnan(zwmo[0,0])
+        assert np.array_equal(dat.d2d['zwmo'], zwmo, equal_nan=True)
+
+def test_sample_grid():
+    rng = np.random.default_rng(1)
+    Lo1, La1, dlo, dla = -10., 0., 0.25, 0.5
+    nlev, nlat, nlon = 101, 21, 41
+    lats = La1 + dla*np.arange(nlat)
+    lons = Lo1 + dlo*np.arange(nlon)
+    SP = 1.e5 + 3000*rng.normal(size=(nlat, nlon))
+    field = rng.normal(size=(nlev, nlat, nlon))
+    npart = 1000
+    # inside the grid (the east and north edges excluded, see below)
+    x = rng.uniform(lons[0], lons[-1]-1.e-6, npart)
+    y = rng.uniform(lats[0], lats[-1]-1.e-6, npart)
+    # -log(SP) as with the former RegularGridInterpolator
+    lsp = RegularGridInterpolator((lats, lons), -np.log(SP), bounds_error=True)
+    lspi = sample_grid(SP, x, y, Lo1, La1, dlo, dla, mlog=True)
+    assert np.allclose(lspi, lsp(np.transpose([y, x])), rtol=1e-12, atol=1e-12)
+    # 3D, against the former vhigh/vlow formula of interpol_part, including
+    # levels clipped below 0 and above 99 and hyb > 100
+    hyb = rng.uniform(-0.5, 101.5, npart)
+    hyb[:10] = [-0.3, 0., 0.5, 99., 99.7, 100., 100.2, 100.9, 101.3, 50.]
+    lhyb = np.clip(np.floor(hyb).astype(np.int64), 0, 99)
+    ix = np.clip(np.floor((x-Lo1)/dlo).astype(np.int64), 0, nlon-2)
+    jy = np.clip(np.floor((y-La1)/dla).astype(np.int64), 0, nlat-2)
+    px = ((x - Lo1) % dlo)/dlo
+    py = ((y - La1) % dla)/dla
+    vhigh = (1-px)*(1-py)*field[lhyb,jy,ix] + (1-px)*py*field[lhyb,jy+1,ix] \
+          + px*(1-py)*field[lhyb,jy,ix+1] + px*py*field[lhyb,jy+1,ix+1]
+    vlow  = (1-px)*(1-py)*field[lhyb+1,jy,ix] + (1-px)*py*field[lhyb+1,jy+1,ix] \
+          + px*(1-py)*field[lhyb+1,jy,ix+1] + px*py*field[lhyb+1,jy+1,ix+1]
+    hc = hyb - lhyb
+    res = sample_grid(field, x, y, Lo1, La1, dlo, dla, hyb=hyb)
+    assert np.allclose(res, (1-hc)*vhigh + hc*vlow, rtol=1e-10, atol=1e-10)
+    # the east edge itself is now interpolated (the former modulo gave px=0)
+    xe = np.array([lons[-1]])
+    ye = np.array([lats[3]])
+    assert np.isclose(sample_grid(SP, xe, ye, Lo1, La1, dlo, dla), SP[3,-1])
+    # outside the grid
+    xo = np.array([lons[0]-0.1, lons[-1]+0.1, -5., -5., np.nan, -5.])
+    yo = np.array([5., 5., lats[0]-0.1, lats[-1]+0.1, 5., 5.])
+    out = sample_grid(SP, xo, yo, Lo1, La1, dlo, dla, mlog=True)
+    assert np.all(np.isnan(out[:5])) and not np.isnan(out[5])
+    out = sample_grid(field, xo, yo, Lo1, La1, dlo, dla, hyb=np.array([50.,50.,50.,50.,50.,np.nan]))
+    assert np.all(np.isnan(out))
+
+if __name__ == '__main__':
+    test_sample_grid()
+    test_interpolP()
+    test_interpolPT()
+    test_interpolZ()
+    test_tropopause()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of background
+
+@author: Bernard Legras
+"""
+import threading
+import time
+from background import background
+
+def images(n, missing, log):
+    for i in range(n):
+        log.append(i)
+        yield None if i in missing else i
+
+def failing():
+    yield 0
+    raise FileNotFoundError('no image')
+
+def test_order():
+    log = []
+    items = list(background(images(10, [3, 4], log), depth=2))
+    assert items == [0, 1, 2, None, None, 5, 6, 7, 8, 9]
+    assert log == list(range(10))
+
+def test_ahead():
+    log = []
+    gen = background(images(100, [], log), depth=2)
+    assert next(gen) == 0
+    time.sleep(0.2)
+    # at most depth items read ahead of the consumer
+    assert len(log) == 3
+    gen.close()
+    time.sleep(0.1)
+    assert len(log) <= 4
+    assert threading.active_count() < 10
+
+def test_error():
+    gen = background(failing())
+    assert next(gen) == 0
+    try:
+        next(gen)
+    except FileNotFoundError:
+        pass
+    else:
+        assert False
+
+if __name__ == '__main__':
+    test_order()
+    test_ahead()
+    test_error()
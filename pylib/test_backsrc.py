@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of backsrc
+
+A small synthetic backward run is written in a temporary directory and
+processed with a kernel which stops the parcels below a pressure level.
+
+@author: Bernard Legras
+"""
+import os
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
+import io107
+from backsrc import BackEngine, HitKernel, run_batch, slice_mid, slice_pair, thread_bounds, \
+    I_DEAD, I_HIT, I_CROSSED, I_DBORNE, I_OLD
+
+G = 10
+Q = 20
+NUMPART = G + Q
+
+def write_part(run_dir, hour, idx, p, itime):
+    """ Writes the parcels idx (idx_orgn=1) at pressure p """
+    nact = len(idx)
+    data = {'lhead':3, 'outnfmt':107, 'mode':2, 'stamp_date':20170801000000,
+            'itime':itime, 'step':450, 'numpart':NUMPART, 'nact':nact,
+            'idx_orgn':1, 'nact_lastO':0, 'nact_lastNM':0, 'nact_lastNH':0}
+    data['flag'] = np.zeros(nact, dtype=int)
+    data['ir_start'] = np.where(idx > G, -10800, 0)
+    data['x'] = np.full(nact, 100.)
+    data['y'] = np.full(nact, 20.)
+    data['p'] = np.asarray(p, dtype=float)
+    data['t'] = np.full(nact, 360.)
+    data['idx_back'] = np.asarray(idx)
+    io107.writeidx107(os.path.join(run_dir, 'part_%03d' % hour), data)
+
+class PHit(HitKernel):
+    """ Hit when the parcel is below 40000 Pa """
+    slice_width = timedelta(hours=1)
+
+    def __init__(self, log=None):
+        self.nslices = 0
+        self.log = log
+
+    def process(self, engine, datpart):
+        self.nslices += 1
+        if self.log is not None:
+            self.log.append((engine.ftraj, datpart['time']))
+        if datpart['itime'] is None:
+            return 0
+        sel = datpart['p'] > 40000
+        j = datpart['idx_back'][sel] - engine.idx_orgn
+        j = j[(engine.prod0['flag_source'][j] & I_DEAD) == 0]
+        engine.prod0['flag_source'][j] |= I_HIT + I_DEAD
+        engine.prod0['src']['p'][0, j] = datpart['p'][sel][:len(j)]
+        return len(j)
+
+    def state(self):
+        return {'nslices':self.nslices}
+
+    def restore(self, engine, state):
+        self.nslices = int(state['nslices'])
+
+def make_run(run_dir, ihit=2, phit=50000.):
+    idx_all = np.arange(1, NUMPART+1)
+    write_part(run_dir, 0, idx_all, np.full(NUMPART, 20000.), 0)
+    # at 6h, parcels 11, 12, 13 are deadborne
+    idx6 = np.concatenate((np.arange(1, G+1), np.arange(14, NUMPART+1)))
+    p6 = np.full(len(idx6), 20000.)
+    # parcel 3 hits in the first step
+    p6[ihit] = phit
+    write_part(run_dir, 6, idx6, p6, -21600)
+    # at 12h, parcels 1 and 2 have exited and the remaining parcels
+    # of the first granule are old
+    idx12 = idx6[2:]
+    write_part(run_dir, 12, idx12, np.full(len(idx12), 20000.), -43200)
+
+def test_engine():
+    with tempfile.TemporaryDirectory() as tmp:
+        make_run(tmp)
+        hit = PHit()
+        engine = BackEngine(tmp, datetime(2017,9,1), hit, step=6, hmax=12,
+                            age_bound=0.45, granule_size=G, granule_quanta=Q)
+        prod0 = engine.run()
+    flag = prod0['flag_source']
+    assert hit.nslices == 12
+    assert prod0['src']['x'].shape == (NUMPART,)
+    assert prod0['src']['x'].dtype == np.float32
+    assert sorted(np.flatnonzero(flag & I_DBORNE)+1) == [11, 12, 13]
+    assert sorted(np.flatnonzero(flag & I_CROSSED)+1) == [1, 2]
+    assert sorted(np.flatnonzero(flag & I_OLD)+1) == list(range(4, G+1))
+    assert engine.nhits == 1 and (flag[2] & I_HIT)
+    assert engine.ndborne == 3 and engine.nexits == 2 and engine.nold == G-3
+    assert np.all(prod0['src']['p'][flag & I_DEAD != 0] > 0)
+
+def test_resume():
+    with tempfile.TemporaryDirectory() as tmp:
+        make_run(tmp)
+        ckpt = os.path.join(tmp, 'run.ckpt')
+        kwargs = dict(step=6, age_bound=0.45, granule_size=G, granule_quanta=Q)
+        ref = BackEngine(tmp, datetime(2017,9,1), PHit(), hmax=12, **kwargs).run()
+        # run killed after the first step
+        BackEngine(tmp, datetime(2017,9,1), PHit(), hmax=6, checkpoint=ckpt,
+                   checkpoint_step=6, **kwargs).run()
+        assert os.path.isfile(ckpt)
+        hit = PHit()
+        engine = BackEngine(tmp, datetime(2017,9,1), hit, hmax=12, checkpoint=ckpt,
+                            checkpoint_step=6, resume=True, **kwargs)
+        prod0 = engine.run()
+    assert hit.nslices == 12
+    assert engine.nexits == 2 and engine.ndborne == 3 and engine.nhits == 1
+    assert engine.current_date == datetime(2017,8,31,12)
+    assert np.array_equal(ref['flag_source'], prod0['flag_source'])
+    for var in ref['src']:
+        assert np.array_equal(ref['src'][var], prod0['src'][var], equal_nan=True)
+
+def test_threads():
+    assert list(thread_bounds(10, 3)) == [0, 3, 6, 10]
+    assert list(thread_bounds(2, 4)) == [0, 0, 1, 1, 2]
+    with tempfile.TemporaryDirectory() as tmp:
+        make_run(tmp)
+        kwargs = dict(step=6, hmax=12, age_bound=0.45, granule_size=G, granule_quanta=Q)
+        ref = BackEngine(tmp, datetime(2017,9,1), PHit(), **kwargs).run()
+        prod0 = BackEngine(tmp, datetime(2017,9,1), PHit(), threads=4, **kwargs).run()
+    assert np.array_equal(ref['flag_source'], prod0['flag_source'])
+
+class RecHit(PHit):
+    """ Keeps the float64 values stored in prod0 """
+    def __init__(self):
+        PHit.__init__(self)
+        self.ref = {}
+
+    def process(self, engine, datpart):
+        assert engine.prod0['src']['p'].dtype == np.float32
+        assert engine.prod0['src']['age'].dtype == np.int32
+        assert engine.prod0['flag_source'].dtype == np.int32
+        if datpart['itime'] is not None:
+            for i in np.flatnonzero(datpart['p'] > 40000):
+                j = datpart['idx_back'][i] - engine.idx_orgn
+                if j not in self.ref:
+                    self.ref[j] = datpart['p'][i]
+        return PHit.process(self, engine, datpart)
+
+def test_float32():
+    # the float32 fields give the float64 values converted at the end
+    with tempfile.TemporaryDirectory() as tmp:
+        make_run(tmp, phit=51234.56789012345)
+        hit = RecHit()
+        engine = BackEngine(tmp, datetime(2017,9,1), hit, step=6, hmax=12,
+                            age_bound=0.45, granule_size=G, granule_quanta=Q)
+        prod0 = engine.run()
+    assert len(hit.ref) == 1
+    for j, p in hit.ref.items():
+        assert p != np.float64(np.float32(p))
+        assert prod0['src']['p'][j] == np.float32(p)
+    # ages in seconds: exits, old parcels stopped at 6h, deadborne (0)
+    # and parcels not stopped (NaN)
+    flag = prod0['flag_source']
+    age = prod0['src']['age']
+    assert np.all(age[(flag & I_CROSSED) != 0] == 10800+21600)
+    assert ((flag & I_OLD) != 0).sum() > 0
+    assert np.all(age[(flag & I_OLD) != 0] == 21600)
+    assert np.all(age[(flag & I_DBORNE) != 0] == 0)
+    assert np.all(np.isnan(age[(flag & I_DEAD) == 0]))
+    assert engine.budget() > NUMPART*(4*4+4+4)
+
+def test_batch():
+    with tempfile.TemporaryDirectory() as tmp:
+        dirs = [os.path.join(tmp, 'L%d' % i) for i in range(2)]
+        for i, run_dir in enumerate(dirs):
+            os.mkdir(run_dir)
+            make_run(run_dir, ihit=2+i)
+        kwargs = dict(step=6, hmax=12, age_bound=0.45, granule_size=G, granule_quanta=Q)
+        refs = [BackEngine(run_dir, datetime(2017,9,1), PHit(), **kwargs).run() for run_dir in dirs]
+        log = []
+        prods = run_batch([BackEngine(run_dir, datetime(2017,9,1), PHit(log), **kwargs)
+                           for run_dir in dirs])
+    # the slices of the two runs alternate
+    assert len(log) == 24
+    assert [run_dir for run_dir, time in log] == dirs*12
+    assert all(log[2*i][1] == log[2*i+1][1] for i in range(12))
+    for ref, prod0 in zip(refs, prods):
+        assert np.array_equal(ref['flag_source'], prod0['flag_source'])
+        assert np.array_equal(ref['src']['p'], prod0['src']['p'], equal_nan=True)
+    assert not np.array_equal(prods[0]['flag_source'], prods[1]['flag_source'])
+
+def test_slices():
+    part_a = {'itime':-21600, 'idx_back':np.arange(3)}
+    part_p = {'itime':-43200, 'idx_back':np.arange(3)}
+    for var in ['x','y','p','t']:
+        part_a[var] = np.zeros(3)
+        part_p[var] = np.full(3, 6.)
+    live = np.array([True, False, True])
+    date = datetime(2017,8,31,18)
+    mids = [dat['x'][0] for dat in slice_mid(part_a,part_p,live,live,date,
+                                             timedelta(hours=6),timedelta(hours=1))]
+    assert np.allclose(mids, np.arange(6)+0.5)
+    pairs = [(dat['xi'][0],dat['xf'][0],dat['itime']) for dat in
+             slice_pair(part_a,part_p,live,live,date,timedelta(hours=6),timedelta(hours=1))]
+    assert pairs[0][:2] == (1., 0.)
+    assert pairs[-1][:2] == (6., 5.)
+    assert all(pairs[i][1] == pairs[i-1][0] for i in range(1, 6))
+    assert all(pairs[i][2] == pairs[i-1][2] - 3600 for i in range(1, 6))
+
+def test_lateral():
+    # parcels 1 and 2 exit at x=100, within 4 degrees of the east side
+    with tempfile.TemporaryDirectory() as tmp:
+        make_run(tmp)
+        kwargs = dict(step=6, hmax=12, age_bound=0.45, granule_size=G, granule_quanta=Q)
+        ref = BackEngine(tmp, datetime(2017,9,1), PHit(), **kwargs).run()
+        east = BackEngine(tmp, datetime(2017,9,1), PHit(),
+                          exit_domain=[[-10.,102.],[0.,50.]], **kwargs).run()
+        inner = BackEngine(tmp, datetime(2017,9,1), PHit(),
+                           exit_domain=[[-10.,160.],[0.,50.]], **kwargs).run()
+    excode = lambda prod0: list((prod0['flag_source'][:2] >> 13) & 0xF)
+    assert excode(ref) == [7, 7]
+    assert excode(east) == [5, 5]
+    assert excode(inner) == [7, 7]
+    assert np.array_equal(ref['flag_source'][2:], east['flag_source'][2:])
+
+class TrackEngine(BackEngine):
+    """ All parcels launched at once, the missing ones are deadborne """
+    state_keys = BackEngine.state_keys + ['nchecks']
+
+    def init(self):
+        BackEngine.init(self)
+        self.nchecks = 0
+
+    def deadborne(self, partpost, kept_p):
+        self.nchecks += 1
+        if self.hour == self.step:
+            idx = np.arange(self.numpart) + self.idx_orgn
+            self.set_deadborne(idx[~np.isin(idx, partpost['idx_back'])] - self.idx_orgn)
+
+def test_deadborne():
+    with tempfile.TemporaryDirectory() as tmp:
+        make_run(tmp)
+        ckpt = os.path.join(tmp, 'run.ckpt')
+        kwargs = dict(step=6, age_bound=None, granule_size=NUMPART, granule_quanta=0)
+        engine = TrackEngine(tmp, datetime(2017,9,1), PHit(), hmax=12, **kwargs)
+        prod0 = engine.run()
+        TrackEngine(tmp, datetime(2017,9,1), PHit(), hmax=6, checkpoint=ckpt,
+                    checkpoint_step=6, **kwargs).run()
+        resumed = TrackEngine(tmp, datetime(2017,9,1), PHit(), hmax=12, checkpoint=ckpt,
+                              checkpoint_step=6, resume=True, **kwargs)
+        prod1 = resumed.run()
+    flag = prod0['flag_source']
+    assert sorted(np.flatnonzero(flag & I_DBORNE)+1) == [11, 12, 13]
+    assert sorted(np.flatnonzero(flag & I_CROSSED)+1) == [1, 2]
+    # no age limit
+    assert engine.nold == 0 and not np.any(flag & I_OLD)
+    assert engine.nchecks == 2 and resumed.nchecks == 2
+    assert np.array_equal(flag, prod1['flag_source'])
+
+if __name__ == '__main__':
+    test_slices()
+    test_engine()
+    test_resume()
+    test_threads()
+    test_batch()
+    test_float32()
+    test_lateral()
+    test_deadborne()
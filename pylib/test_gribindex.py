@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of the sidecar index of gribindex
+(the scan of the grib files requires pygrib)
+
+@author: Bernard Legras
+"""
+import os
+import tempfile
+import types
+import gribindex
+from gribindex import GribIndex, GribFile, index_path, signature, write_index, read_index
+
+def make_records():
+    records = []
+    offset = 0
+    for hour in [0, 100, 200]:
+        for var in ['lnsp', 't', 'u']:
+            levels = [1] if var == 'lnsp' else [1, 2, 3]
+            for lev in levels:
+                records.append((var, hour, lev, 0, None, offset, 100))
+                offset += 100
+    return records
+
+def test_index():
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'ERA5EN20170801.grb')
+        with open(fname, 'wb') as f:
+            f.write(b'GRIB'*10)
+        path = index_path(fname)
+        assert path == fname + '.stcidx'
+        records = make_records()
+        write_index(path, signature(fname), records)
+        index = GribIndex(fname)
+        assert index.records == records
+        bounds = index.find(shortName='t', validityTime=100)
+        assert bounds == [(800, 100), (900, 100), (1000, 100)]
+        assert index.find(shortName='u', validityTime=200, level=2) == [(1900, 100)]
+        assert index.find(shortName='lnsp') == [(0, 100), (700, 100), (1400, 100)]
+        assert index.find(shortName='q', validityTime=100) == []
+        # not indexed key
+        assert index.find(name='Temperature') is None
+        # the index is outdated when the grib file changes
+        with open(fname, 'ab') as f:
+            f.write(b'GRIB')
+        assert read_index(path, signature(fname)) is None
+        # index in a separate directory
+        other = index_path(fname, index_dir=os.path.join(tmp, 'idx'))
+        assert os.path.dirname(other) == os.path.join(tmp, 'idx')
+        assert other.endswith('.stcidx')
+
+class FakeGrbs(object):
+    """ pygrib.open for the selects which are not indexed """
+    def __init__(self, fname):
+        self.selects = []
+        self.closed = False
+    def select(self, **keys):
+        self.selects.append(keys)
+        return ['from pygrib']
+    def close(self):
+        self.closed = True
+
+def test_select(monkeypatch):
+    opened = []
+    def fake_open(fname):
+        opened.append(FakeGrbs(fname))
+        return opened[-1]
+    # the messages are returned as the bytes read at their offsets
+    monkeypatch.setattr(gribindex, 'pygrib', types.SimpleNamespace(open=fake_open, fromstring=bytes))
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'ERA5EN20170801.grb')
+        records = make_records()
+        with open(fname, 'wb') as f:
+            for rec in records:
+                f.write(('%-100s' % ('%s %d %d' % rec[:3])).encode())
+        write_index(index_path(fname), signature(fname), records)
+        grb = GribFile(fname)
+        msgs = grb.select(shortName='t', validityTime=100)
+        assert [m.split() for m in msgs] == [[b't', b'100', str(lev).encode()] for lev in [1, 2, 3]]
+        # name translated into shortName, read from the index
+        msgs = grb.select(name='Logarithm of surface pressure', validityTime=200)
+        assert [m.split() for m in msgs] == [[b'lnsp', b'200', b'1']]
+        assert len(opened) == 0
+        # no match
+        try:
+            grb.select(shortName='q', validityTime=100)
+        except ValueError:
+            pass
+        else:
+            assert False
+        # not indexed key: passed to pygrib, opened once
+        assert grb.select(name='Temperature', validityTime=100) == ['from pygrib']
+        assert grb.select(typeOfLevel='hybrid') == ['from pygrib']
+        assert len(opened) == 1
+        assert opened[0].selects == [{'name':'Temperature', 'validityTime':100},
+                                     {'typeOfLevel':'hybrid'}]
+        grb.close()
+        assert opened[0].closed
+
+if __name__ == '__main__':
+    test_index()
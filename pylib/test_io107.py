@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of io107
+
+A small synthetic part file is written with writeidx107 and read back
+with the different reading modes of readidx107.
+
+@author: Bernard Legras
+"""
+import os
+import tempfile
+import numpy as np
+import io107
+
+def make_part(nact=1000, seed=0):
+    """ Generates a synthetic dictionary in 107 format """
+    rng = np.random.default_rng(seed)
+    data = {'lhead':3, 'outnfmt':107, 'mode':2, 'stamp_date':20170801000000,
+            'itime':-21600, 'step':450, 'numpart':2*nact, 'nact':nact,
+            'idx_orgn':1, 'nact_lastO':nact//2, 'nact_lastNM':0, 'nact_lastNH':0}
+    data['flag'] = rng.integers(0, 0x1000000, nact)
+    data['ir_start'] = rng.integers(-86400*30, 0, nact)
+    data['x'] = rng.uniform(-10, 160, nact).astype(np.float32)
+    data['y'] = rng.uniform(0, 50, nact).astype(np.float32)
+    data['p'] = rng.uniform(3000, 50000, nact).astype(np.float32)
+    data['t'] = rng.uniform(180, 300, nact).astype(np.float32)
+    data['idx_back'] = np.sort(rng.choice(2*nact, nact, replace=False)) + 1
+    return data
+
+def check_equal(ref, data):
+    for var in io107.FIELDS107:
+        assert np.array_equal(np.asarray(ref[var]), np.asarray(data[var])), var
+    for key in ['stamp_date','itime','step','numpart','nact','idx_orgn']:
+        assert ref[key] == data[key], key
+
+def test_read():
+    ref = make_part()
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_006')
+        io107.writeidx107(fname, ref)
+        data = io107.readpart107(6, tmp, quiet=True)
+        check_equal(ref, data)
+        assert data['x'].dtype == np.float64
+
+def test_mmap():
+    ref = make_part()
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        io107.writeidx107(fname, ref)
+        data = io107.readidx107(fname, quiet=True, mmap=True)
+        assert data['x'].dtype == np.dtype('>f4')
+        assert data['flag'].dtype == np.dtype('>i4')
+        check_equal(ref, data)
+        io107.native107(data, ['p'])
+        assert data['p'].dtype.isnative and not data['t'].dtype.isnative
+        data = io107.readidx107(fname, quiet=True, mmap=True, native=True)
+        assert data['t'].dtype == np.float32
+        check_equal(ref, data)
+        del data
+
+def test_gzip():
+    ref = make_part()
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        io107.writeidx107(fname+'.gz', ref, cmp=True)
+        # mapping falls back to the usual reading
+        data = io107.readidx107(fname, quiet=True, mmap=True)
+        check_equal(ref, data)
+
+def test_fields():
+    ref = make_part()
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        io107.writeidx107(fname, ref)
+        io107.writeidx107(fname+'x.gz', ref, cmp=True)
+        for data in [io107.readidx107(fname, quiet=True, fields=['p','idx_back']),
+                     io107.readidx107(fname+'x', quiet=True, fields=['p','idx_back']),
+                     io107.readidx107(fname, quiet=True, mmap=True, fields=['p','idx_back'])]:
+            assert 'x' not in data and 'flag' not in data
+            assert np.array_equal(data['p'], ref['p'])
+            assert np.array_equal(data['idx_back'], ref['idx_back'])
+
+def test_scan():
+    ref = make_part()
+    with tempfile.TemporaryDirectory() as tmp:
+        io107.writeidx107(os.path.join(tmp, 'part_000'), ref)
+        io107.writeidx107(os.path.join(tmp, 'part_006.gz'), ref, cmp=True)
+        io107.writeidx107(os.path.join(tmp, 'part_018'), ref)
+        index = io107.scan107(tmp)
+        assert sorted(index) == [0, 6, 18]
+        assert index[6]['gz'] and not index[0]['gz']
+        assert index[18]['nact'] == ref['nact']
+        assert io107.missing107(index, 24) == [12, 24]
+        # the offsets give the position of each record
+        with open(os.path.join(tmp, 'part_018'), 'rb') as fid:
+            fid.seek(index[18]['offsets']['p']+4)
+            p = np.frombuffer(fid.read(4*ref['nact']), dtype='>f4')
+        assert np.array_equal(p, ref['p'])
+        assert io107.loadidx107(tmp).keys() == index.keys()
+
+def test_gzindex():
+    ref = make_part(nact=100000)
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        io107.writeidx107(fname+'.gz', ref, cmp=True)
+        data = io107.readidx107(fname, quiet=True, gzindex=True, fields=['t'])
+        assert np.array_equal(data['t'], ref['t'])
+        if io107.indexed_gzip is not None:
+            assert os.path.isfile(fname+'.gzidx')
+        # second reading with the stored index
+        data = io107.readidx107(fname, quiet=True, gzindex=True)
+        check_equal(ref, data)
+
+def test_writer():
+    ref = make_part()
+    head = dict((key, ref[key]) for key in ['lhead','outnfmt','mode','stamp_date','itime',
+                'step','idx_orgn','nact_lastO','nact_lastNM','nact_lastNH'])
+    head['numpart'] = ref['numpart']
+    chunks = [dict((var, ref[var][i:i+300]) for var in io107.FIELDS107)
+              for i in range(0, ref['nact'], 300)]
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'part_000')
+        assert io107.writegen107(fname, head, iter(chunks)) == ref['nact']
+        check_equal(ref, io107.readidx107(fname, quiet=True))
+        io107.writegen107(fname+'x.gz', head, chunks, cmp=True)
+        check_equal(ref, io107.readidx107(fname+'x', quiet=True))
+        assert sorted(os.listdir(tmp)) == ['part_000', 'part_000x.gz']
+
+def test_prefetch():
+    with tempfile.TemporaryDirectory() as tmp:
+        parts = {}
+        for hour in [6, 12, 18]:
+            parts[hour] = make_part(nact=100, seed=hour)
+            io107.writeidx107(os.path.join(tmp, 'part_%03d' % hour), parts[hour])
+        hours = []
+        for hour, data in io107.prefetch107(range(6, 19, 6), tmp, fields=['x']):
+            assert np.array_equal(data['x'], parts[hour]['x'])
+            hours.append(hour)
+        assert hours == [6, 12, 18]
+        # missing file raised in the loop after the available ones
+        hours = []
+        try:
+            for hour, data in io107.prefetch107(range(6, 25, 6), tmp):
+                hours.append(hour)
+        except IOError:
+            pass
+        else:
+            assert False
+        assert hours == [6, 12, 18]
+
+if __name__ == '__main__':
+    test_read()
+    test_prefetch()
+    test_writer()
+    test_gzindex()
+    test_scan()
+    test_fields()
+    test_mmap()
+    test_gzip()
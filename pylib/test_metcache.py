@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of metcache with a synthetic loader
+
+@author: Bernard Legras
+"""
+import os
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
+from metcache import SliceCache, MetSlice
+
+def loader(date):
+    dat = MetSlice()
+    dat.var['UDR'] = np.full((3,4,5), date.hour, dtype=np.float64)
+    dat.var['SP'] = np.full((4,5), 1.e5+date.hour)
+    dat.var['T'] = np.zeros((3,4,5))
+    dat.attr['Lo1'] = -10.
+    dat.attr['levs'] = np.arange(3)
+    dat.attr['date'] = date
+    return dat
+
+def failing_loader(date):
+    raise ValueError('no data')
+
+def test_cache():
+    date = datetime(2017,8,31,23)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = SliceCache(tmp, loader, ['UDR','SP'], attrs=['Lo1','levs'],
+                           prefetch=2, step=timedelta(hours=-1))
+        dat = cache.get(date)
+        assert cache.nloaded == 1
+        assert set(dat.var.keys()) == {'UDR','SP'}
+        assert set(dat.attr.keys()) == {'Lo1','levs'}
+        assert dat.var['UDR'].dtype == np.float32
+        assert isinstance(dat.var['UDR'], np.memmap)
+        assert np.all(dat.var['UDR'] == 23) and np.all(dat.var['SP'] == 1.e5+23)
+        # same slice for another run of a batch
+        assert cache.get(date) is dat and cache.nread == 1
+        # the next two hours are prefetched by the worker
+        for h in [22, 21]:
+            dat = cache.get(date.replace(hour=h))
+            assert np.all(dat.var['UDR'] == h)
+        cache.close()
+        assert cache.nloaded == 1 and cache.nread == 3
+        assert os.path.isdir(cache.path(datetime(2017,8,31,19)))
+        assert not [f for f in os.listdir(tmp) if f.startswith('.tmp')]
+        # a second cache on the same directory does not call the loader
+        cache = SliceCache(tmp, failing_loader, ['UDR','SP'])
+        assert np.all(cache.get(date).var['SP'] == 1.e5+23)
+        assert cache.nloaded == 0
+
+def test_end():
+    date = datetime(2017,8,31,23)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = SliceCache(tmp, loader, ['SP'], prefetch=2, step=timedelta(hours=-1),
+                           end=date-timedelta(hours=2))
+        for h in [23, 22, 21]:
+            assert np.all(cache.get(date.replace(hour=h)).var['SP'] == 1.e5+h)
+        cache.close()
+        # nothing prefetched before the end of the run
+        assert sorted(os.listdir(tmp)) == ['2017083121', '2017083122', '2017083123']
+
+def test_limit():
+    date = datetime(2017,8,31,23)
+    with tempfile.TemporaryDirectory() as tmp:
+        # slices of another dataset are not counted nor removed
+        other = SliceCache(tmp, loader, ['SP'], prefix='X-')
+        other.get(date)
+        cache = SliceCache(tmp, loader, ['SP'], prefetch=1, step=timedelta(hours=-1),
+                           prefix='STC-', max_slices=3)
+        for h in range(23, 15, -1):
+            assert np.all(cache.get(date.replace(hour=h)).var['SP'] == 1.e5+h)
+            assert len(cache.slices()) <= 3
+        cache.close()
+        # 9 slices with the prefetched one, the current and the prefetched
+        # ones are kept with the most recently used
+        assert cache.nevicted == 6
+        assert sorted(cache.slices()) == [cache.path(date.replace(hour=h)) for h in [15, 16, 17]]
+        assert os.path.isdir(other.path(date))
+        cache.clear()
+        assert os.listdir(tmp) == [os.path.basename(other.path(date))]
+
+def test_failure():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = SliceCache(tmp, failing_loader, ['SP'], prefetch=1, step=timedelta(hours=1))
+        try:
+            cache.get(datetime(2017,8,1))
+        except ValueError:
+            pass
+        else:
+            assert False
+        cache.close()
+        assert os.listdir(tmp) == []
+
+if __name__ == '__main__':
+    test_cache()
+    test_end()
+    test_limit()
+    test_failure()
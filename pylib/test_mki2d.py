@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of the lookup table of the hybrid levels against the CloughTocher
+interpolator fhyb of tohyb
+
+@author: Bernard Legras
+"""
+import os
+import tempfile
+import numpy as np
+from mki2d import tohyb, tohyb_table, HybTable
+
+def random_points(n=50000, seed=0):
+    rng = np.random.default_rng(seed)
+    lsig = -np.log(rng.uniform(0.01, 0.9, n))
+    lps = -np.log(rng.uniform(45000, 110000, n))
+    return np.transpose([lsig, lps])
+
+def test_table():
+    pts = random_points()
+    for rea in ['ERA5', 'ERAI']:
+        fhyb, void = tohyb(rea)
+        ref = fhyb(pts)
+        with tempfile.TemporaryDirectory() as tmp:
+            table_file = os.path.join(tmp, 'hybtable.npz')
+            tab = tohyb_table(rea, table_file=table_file)
+            assert os.path.isfile(table_file)
+            hyb = tab(pts)
+            # second call reads the stored table
+            assert np.array_equal(tohyb_table(rea, table_file=table_file)(pts), hyb, equal_nan=True)
+        valid = ~np.isnan(ref)
+        assert np.all(~np.isnan(hyb[valid]))
+        assert np.abs(hyb[valid] - ref[valid]).max() < 2e-3
+        # the nearest level differs only within the tolerance of a half level
+        diff = np.floor(hyb+0.5) != np.floor(ref+0.5)
+        assert np.all(np.abs(ref[diff & valid] % 1 - 0.5) < 2e-3)
+
+def test_stale():
+    pts = random_points(2000)
+    with tempfile.TemporaryDirectory() as tmp:
+        table_file = os.path.join(tmp, 'hybtable.npz')
+        ref = tohyb_table('ERAI', nsig=200, nps=20, table_file=table_file)
+        # same shape, other grid
+        HybTable(ref.table, ref.lsig0+0.1, ref.dlsig, ref.lps0, ref.dlps, ref.source).save(table_file)
+        tab = tohyb_table('ERAI', nsig=200, nps=20, table_file=table_file)
+        assert tab.lsig0 == ref.lsig0
+        assert np.array_equal(tab(pts), ref(pts), equal_nan=True)
+        # same grid, built from other half levels
+        HybTable(ref.table+1, ref.lsig0, ref.dlsig, ref.lps0, ref.dlps, 'other').save(table_file)
+        assert np.array_equal(tohyb_table('ERAI', nsig=200, nps=20, table_file=table_file)(pts),
+                              ref(pts), equal_nan=True)
+        # table stored without source
+        np.savez(table_file, table=ref.table+1,
+                 grid=np.array([ref.lsig0, ref.dlsig, ref.lps0, ref.dlps]))
+        assert HybTable.load(table_file).source == ''
+        assert np.array_equal(tohyb_table('ERAI', nsig=200, nps=20, table_file=table_file)(pts),
+                              ref(pts), equal_nan=True)
+        # the rebuilt table is stored and reused
+        assert HybTable.load(table_file).source == ref.source
+
+def test_outside():
+    tab = HybTable(np.arange(12.).reshape(4, 3), 0., 1., 0., 1.)
+    hyb = tab([[1.5, 0.5], [3., 2.], [-0.1, 1.], [1., 2.1], [np.nan, 1.]])
+    assert np.allclose(hyb[:2], [5., 11.])
+    assert np.all(np.isnan(hyb[2:]))
+
+if __name__ == '__main__':
+    test_outside()
+    test_stale()
+    test_table()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of partmatch against np.in1d on sorted, segmented and shuffled
+index lists.
+
+@author: Bernard Legras
+"""
+import numpy as np
+from partmatch import matchkept, missingidx
+
+def check(idx_a, idx_p):
+    kept_a, kept_p = matchkept(idx_a, idx_p)
+    assert np.array_equal(kept_a, np.isin(idx_a, idx_p, assume_unique=True))
+    assert np.array_equal(kept_p, np.isin(idx_p, idx_a, assume_unique=True))
+
+def test_matchkept():
+    rng = np.random.default_rng(0)
+    idx_a = np.sort(rng.choice(100000, 20000, replace=False))
+    idx_p = np.sort(rng.choice(100000, 30000, replace=False))
+    check(idx_a, idx_p)
+    # segmented: old parcels then new parcels
+    check(np.concatenate((idx_a[5000:], idx_a[:5000])), idx_p)
+    check(idx_a, np.concatenate((idx_p[10000:], idx_p[:10000])))
+    check(rng.permutation(idx_a), rng.permutation(idx_p))
+    check(idx_a[:0], idx_p)
+    check(idx_a, [])
+
+def test_missingidx():
+    rng = np.random.default_rng(1)
+    idx_act = rng.permutation(rng.choice(5000, 3000, replace=False))
+    idx_theor = np.arange(1000, 4000)
+    ref = idx_theor[~np.isin(idx_theor, idx_act, assume_unique=True)]
+    assert np.array_equal(missingidx(1000, 4000, idx_act), ref)
+    assert len(missingidx(10, 10, idx_act)) == 0
+
+if __name__ == '__main__':
+    test_matchkept()
+    test_missingidx()
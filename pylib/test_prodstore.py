@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of prodstore
+
+@author: Bernard Legras
+"""
+import os
+import tempfile
+import numpy as np
+import tables
+import pickle
+from prodstore import save_prod, load_prod, save_prod_or_pickle
+
+NUMPART = 1000
+
+def make_prod():
+    rng = np.random.default_rng(0)
+    prod0 = {'src':{}}
+    for var in ['x','y','p','t','age']:
+        prod0['src'][var] = rng.normal(size=(6,NUMPART)).astype(np.float32)
+    prod0['flag_source'] = rng.integers(0, 2**25, NUMPART).astype(np.int32)
+    prod0['chi'] = rng.uniform(size=NUMPART).astype(np.float32)
+    prod0['source'] = rng.uniform(size=(201,681)).astype(np.float32)
+    return prod0
+
+def test_prod():
+    prod0 = make_prod()
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'prod.hdf5z')
+        save_prod(fname, prod0)
+        with tables.open_file(fname) as h5:
+            assert h5.root.src.x.chunkshape == (1, NUMPART)
+        full = load_prod(fname)
+        part = load_prod(fname, fields=['flag_source','src/x','source'], idx_range=[100,300])
+        src = load_prod(fname, fields=['src'])
+    assert set(full.keys()) == {'src','flag_source','chi','source'}
+    for var in prod0['src']:
+        assert np.array_equal(full['src'][var], prod0['src'][var])
+        assert full['src'][var].dtype == np.float32
+    for var in ['flag_source','chi','source']:
+        assert np.array_equal(full[var], prod0[var])
+    assert set(part.keys()) == {'src','flag_source','source'}
+    assert list(part['src'].keys()) == ['x']
+    assert np.array_equal(part['src']['x'], prod0['src']['x'][:,100:300])
+    assert np.array_equal(part['flag_source'], prod0['flag_source'][100:300])
+    # not a parcel field
+    assert np.array_equal(part['source'], prod0['source'])
+    assert set(src.keys()) == {'src'} and len(src['src']) == 5
+
+def test_fallback():
+    prod0 = make_prod()
+    with tempfile.TemporaryDirectory() as tmp:
+        # the hdf5 file cannot be written
+        fname = os.path.join(tmp, 'missing', 'prod.hdf5z')
+        fname2 = os.path.join(tmp, 'prod.pkl')
+        save_prod_or_pickle(fname, prod0, fname2)
+        with open(fname2, 'rb') as f:
+            prod1 = pickle.load(f)
+        assert np.array_equal(prod1['flag_source'], prod0['flag_source'])
+        # both fail: the error is raised
+        try:
+            save_prod_or_pickle(fname, prod0, os.path.join(tmp, 'missing', 'prod.pkl'))
+        except OSError:
+            pass
+        else:
+            assert False
+
+if __name__ == '__main__':
+    test_prod()
+    test_fallback()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of satcube with synthetic images
+
+@author: Bernard Legras
+"""
+import os
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
+from satcube import CubeWriter, SatCube, cube_path, cube_months
+
+DT = timedelta(minutes=15)
+SHAPE = (5, 4)
+
+def write_month(cube_root, month, missing):
+    """ images of value the minute of the day, as read by mkSAFcube """
+    mdate = datetime(2017, month, 1)
+    edate = datetime(2017, month+1, 1)
+    writer = CubeWriter(cube_path(cube_root, 'silviahigh', mdate), 'MSG1', SHAPE)
+    current_time = edate - DT
+    while current_time >= mdate:
+        if current_time not in missing:
+            date = current_time + DT
+            writer.add(np.full(SHAPE, date.hour*60+date.minute+0.3), current_time, date)
+        current_time -= DT
+    writer.close()
+    return writer
+
+def test_cube():
+    missing = [datetime(2017,8,1,0,0), datetime(2017,8,10,12,0), datetime(2017,8,10,11,45)]
+    with tempfile.TemporaryDirectory() as tmp:
+        write_month(tmp, 7, missing)
+        writer = write_month(tmp, 8, missing)
+        assert len(writer.date) == 31*96-3
+        dirs = cube_months(tmp, 'silviahigh', datetime(2017,7,20), datetime(2017,9,1))
+        assert [os.path.basename(d) for d in dirs] == \
+            ['SAF-silviahigh-2017-07', 'SAF-silviahigh-2017-08', 'SAF-silviahigh-2017-09']
+        cube = SatCube(dirs, zones=['MSG1'])
+        block, ti, tf = cube.find('MSG1', datetime(2017,8,20,10,5))
+        assert block.dtype == np.uint16 and block.shape == SHAPE
+        assert np.all(block == 10*60+15)
+        assert ti == datetime(2017,8,20,10,0) and tf == datetime(2017,8,20,10,15)
+        # end of the interval is included
+        block, ti, tf = cube.find('MSG1', datetime(2017,8,20,10,15))
+        assert tf == datetime(2017,8,20,10,15)
+        # two missing images: the following one is extended
+        block, ti, tf = cube.find('MSG1', datetime(2017,8,10,11,50))
+        assert ti == datetime(2017,8,10,11,45) and tf == datetime(2017,8,10,12,30)
+        assert np.all(block == 12*60+30)
+        # missing image at the beginning of the month, extended over July 31
+        block, ti, tf = cube.find('MSG1', datetime(2017,8,1,0,10))
+        assert ti == datetime(2017,8,1,0,0) and tf == datetime(2017,8,1,0,30)
+        block, ti, tf = cube.find('MSG1', datetime(2017,8,1,0,0))
+        assert ti == datetime(2017,7,31,23,45) and tf == datetime(2017,8,1,0,0)
+        # before the first image
+        block, ti, tf = cube.find('MSG1', datetime(2017,6,30))
+        assert ti == datetime.min and tf == datetime(2017,7,1,0,15)
+        try:
+            cube.find('MSG1', datetime(2017,9,2))
+        except ValueError:
+            pass
+        else:
+            assert False
+
+if __name__ == '__main__':
+    test_cube()
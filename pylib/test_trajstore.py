@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test of trajstore
+
+A synthetic run directory is ingested and read back step by step.
+
+@author: Bernard Legras
+"""
+import os
+import tempfile
+import numpy as np
+import io107
+from trajstore import ingest, TrajStore, transpose, ParcelStore, segstats
+from test_io107 import make_part
+
+def test_store():
+    with tempfile.TemporaryDirectory() as tmp:
+        parts = {}
+        for hour in [0, 6, 12]:
+            parts[hour] = make_part(nact=500+hour, seed=hour)
+            parts[hour]['itime'] = -3600*hour
+            io107.writeidx107(os.path.join(tmp, 'part_%03d' % hour), parts[hour])
+        store_file = os.path.join(tmp, 'store.h5')
+        # empty run directory
+        os.mkdir(os.path.join(tmp, 'empty'))
+        assert ingest(os.path.join(tmp, 'empty'), store_file) == []
+        # unsorted hours and missing steps
+        assert ingest(tmp, store_file, hours=[6, 24, 0]) == [0, 6]
+        assert ingest(tmp, store_file) == [12]
+        with TrajStore(store_file) as store:
+            assert store.hours == [0, 6, 12]
+            for hour, data in store.steps_range(6, 12):
+                ref = parts[hour]
+                order = np.argsort(ref['idx_back'])
+                assert data['itime'] == ref['itime'] and data['nact'] == ref['nact']
+                for var in io107.FIELDS107:
+                    assert np.array_equal(data[var], np.asarray(ref[var])[order]), var
+            ref = parts[6]
+            idx1, idx2 = 100, 400
+            data = store.readpart(6, fields=['p', 'idx_back'], idx_range=[idx1, idx2])
+            sel = (ref['idx_back'] >= idx1) & (ref['idx_back'] < idx2)
+            assert 'x' not in data
+            assert np.array_equal(data['idx_back'], np.sort(ref['idx_back'][sel]))
+            assert np.array_equal(data['p'], ref['p'][sel][np.argsort(ref['idx_back'][sel])])
+
+def test_transpose():
+    with tempfile.TemporaryDirectory() as tmp:
+        parts = {}
+        for hour in [0, 6, 12, 18]:
+            parts[hour] = make_part(nact=400, seed=hour)
+            io107.writeidx107(os.path.join(tmp, 'part_%03d' % hour), parts[hour])
+        store_file = os.path.join(tmp, 'store.h5')
+        parcel_file = os.path.join(tmp, 'parcels.h5')
+        ingest(tmp, store_file)
+        # hour and t: 8 bytes per record, blocks of at most 250 records
+        transpose(store_file, parcel_file, max_bytes=2000, fields=['t'])
+        with ParcelStore(parcel_file) as pstore:
+            numpart = pstore.numpart
+            for i1, offsets, data in pstore.blocks(250):
+                count, tmean, tmin, tmax = segstats(data['t'], offsets)
+                for i in range(len(offsets)-1):
+                    idx = i1 + i + pstore.idx_orgn
+                    hours = [h for h in sorted(parts) if idx in parts[h]['idx_back']]
+                    tt = [parts[h]['t'][parts[h]['idx_back'] == idx][0] for h in hours]
+                    assert count[i] == len(hours)
+                    assert list(data['hour'][offsets[i]:offsets[i+1]]) == hours
+                    if count[i] > 0:
+                        assert np.isclose(tmean[i], np.mean(tt)) and tmin[i] == min(tt) and tmax[i] == max(tt)
+            assert i1 + len(offsets) - 1 == numpart
+
+if __name__ == '__main__':
+    test_store()
+    test_transpose()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Columnar store of the output of a TRACZILLA run.
+
+The part files of a run directory are ingested once into a single HDF5 file
+(PyTables) where each field of the 107 format is a chunked and compressed
+column made of the concatenation of all the steps. Within each step, the
+parcels are sorted by idx_back. A small table gives for each step the
+hour, itime, nact and the position of the first parcel of the step in
+the columns.
+The analyses can then read only the steps, the fields and the parcel
+index ranges they need, and several analyses can share the same ingest.
+
+Usage:
+>> from trajstore import ingest, TrajStore
+ingest a run directory (steps already in the store are skipped)
+>> ingest(run_dir,store_file)
+open the store and read a step like readpart107
+>> store = TrajStore(store_file)
+>> data = store.readpart(hour,fields=['p','t','idx_back'])
+read only the parcels with idx_back in [idx1,idx2[
+>> data = store.readpart(hour,idx_range=[idx1,idx2])
+loop on a range of steps
+>> for hour, data in store.steps_range(hour1,hour2,fields=['x','y']): ...
+
+The store can be transposed into a parcel-major layout where the trajectory
+of each parcel is contiguous. An offsets array in CSR style gives the
+position of the first record of each parcel, ordered by idx_back-idx_orgn.
+>> transpose(store_file,parcel_file)
+>> pstore = ParcelStore(parcel_file)
+>> for i1, offsets, data in pstore.blocks(2**20,fields=['p','t']):
+>>     count, mean, vmin, vmax = segstats(data['t'],offsets)
+where count[i] ... are the statistics for the parcel of idx_back i1+i+idx_orgn
+
+From the command line:
+python trajstore.py run_dir store_file [-t parcel_file]
+
+@author: Bernard Legras
+@licence: CeCILL-C
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import numpy as np
+import tables
+from numba import jit, prange
+import io107
+
+# size of the chunks along the parcel axis
+CHUNK = 2**20
+# header values of the part files stored in the table of steps
+HEADS = ['itime','nact','numpart','idx_orgn','stamp_date','step','mode',
+         'nact_lastO','nact_lastNM','nact_lastNH']
+
+class StepDesc(tables.IsDescription):
+    hour = tables.Int32Col(pos=0)
+    start = tables.Int64Col(pos=1)
+    itime = tables.Int32Col(pos=2)
+    nact = tables.Int32Col(pos=3)
+    numpart = tables.Int32Col(pos=4)
+    idx_orgn = tables.Int32Col(pos=5)
+    stamp_date = tables.Int64Col(pos=6)
+    step = tables.Int32Col(pos=7)
+    mode = tables.Int32Col(pos=8)
+    nact_lastO = tables.Int32Col(pos=9)
+    nact_lastNM = tables.Int32Col(pos=10)
+    nact_lastNH = tables.Int32Col(pos=11)
+
+def ingest(run_dir, store_file, hours=None, complevel=5, quiet=True):
+    """ Ingests the part files of run_dir into store_file.
+    hours is an optional list of hours to be ingested, by default all the
+    part files found by io107.scan107. The steps which are already in the
+    store are skipped, so that a store can be completed while the run is
+    progressing. The steps are appended in increasing order of hours.
+    The requested hours without part file are skipped.
+    Returns the list of ingested hours.
+    """
+    index = io107.scan107(run_dir)
+    if len(index) == 0:
+        print('no part file in ',run_dir)
+        return []
+    if hours is None:
+        hours = sorted(index)
+    else:
+        missing = sorted(set(hours) - set(index))
+        if len(missing) > 0:
+            print('steps without part file, skipped ',missing)
+        hours = sorted(set(hours) & set(index))
+    filters = tables.Filters(complevel=complevel, complib='blosc:lz4', shuffle=True)
+    h5 = tables.open_file(store_file, mode='a')
+    try:
+        if 'steps' not in h5.root:
+            h5.create_table('/', 'steps', StepDesc, 'steps of the run')
+            for var in io107.FIELDS107:
+                h5.create_earray('/', var, tables.Atom.from_dtype(_native(var)),
+                                 shape=(0,), filters=filters, chunkshape=(CHUNK,),
+                                 expectedrows=index[min(index)]['numpart']*max(len(hours),1))
+            h5.root._v_attrs.run_dir = os.path.abspath(run_dir)
+        steps = h5.root.steps
+        done = set(steps.col('hour'))
+        last = max(done) if len(done) > 0 else -1
+        ingested = []
+        for hour in hours:
+            if hour in done:
+                continue
+            if hour < last:
+                print('step ',hour,' older than the last stored step, skipped')
+                continue
+            data = io107.readidx107(index[hour]['file'][:-3] if index[hour]['gz'] else index[hour]['file'],
+                                    quiet=True, mmap=True)
+            row = steps.row
+            row['hour'] = hour
+            row['start'] = h5.root.x.nrows
+            for key in HEADS:
+                row[key] = data[key]
+            if data['nact'] > 0:
+                order = np.argsort(data['idx_back'], kind='stable')
+                for var in io107.FIELDS107:
+                    h5.get_node('/', var).append(data[var][order].astype(_native(var)))
+            row.append()
+            steps.flush()
+            del data
+            ingested.append(hour)
+            last = hour
+            if not quiet: print('ingested step ', hour, index[hour]['nact'])
+    finally:
+        h5.close()
+    return ingested
+
+class TrajStore(object):
+    """ Read access to a store produced by ingest """
+    def __init__(self, store_file):
+        self.h5 = tables.open_file(store_file, mode='r')
+        self.steps = self.h5.root.steps.read()
+        self.hours = list(self.steps['hour'])
+        self._pos = dict((h, i) for i, h in enumerate(self.hours))
+
+    def close(self):
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def head(self, hour):
+        """ Header values of the part file for hour """
+        st = self.steps[self._pos[hour]]
+        data = {'lhead':3, 'outnfmt':107}
+        for key in HEADS:
+            data[key] = int(st[key])
+        return data
+
+    def bounds(self, hour, idx_range=None):
+        """ Positions in the columns of the first and after last parcels of
+        hour, restricted to idx_back in [idx_range[0],idx_range[1][ """
+        st = self.steps[self._pos[hour]]
+        i1 = int(st['start'])
+        i2 = i1 + int(st['nact'])
+        if idx_range is not None and i2 > i1:
+            idx = self.h5.root.idx_back
+            # binary search on the sorted idx_back of the step, reading one element at a time
+            i1, i2 = _search(idx, i1, i2, idx_range[0]), _search(idx, i1, i2, idx_range[1])
+        return i1, i2
+
+    def readpart(self, hour, fields=None, idx_range=None):
+        """ Reads a step as readpart107 with fields as in readpart107
+        and idx_range restricting the parcels to idx_back in
+        [idx_range[0],idx_range[1][. The parcels are sorted by idx_back. """
+        if fields is None: fields = io107.FIELDS107
+        data = self.head(hour)
+        i1, i2 = self.bounds(hour, idx_range)
+        for var in fields:
+            data[var] = self.h5.get_node('/', var).read(i1, i2)
+        data['nact'] = i2 - i1
+        return data
+
+    def steps_range(self, hour1=None, hour2=None, fields=None, idx_range=None):
+        """ Generator of (hour, data) for the stored steps in [hour1, hour2] """
+        for hour in self.hours:
+            if hour1 is not None and hour < hour1: continue
+            if hour2 is not None and hour > hour2: continue
+            yield hour, self.readpart(hour, fields, idx_range)
+
+def transpose(store_file, parcel_file, max_bytes=2**30, fields=None, idx_orgn=None,
+              complevel=5, quiet=True):
+    """ Transposes a store produced by ingest into a parcel-major store.
+    The parcels are processed by blocks of consecutive indexes whose records
+    hold in a buffer of at most max_bytes (a block contains at least one
+    parcel). For each block, the idx_back range of each step is read from the store,
+    which is cheap as the steps are sorted by idx_back, and the records are
+    written contiguously per parcel and in increasing order of hours.
+    fields is the list of fields to be kept, by default all of them
+    except idx_back which is implicit. The hour of each record is also
+    stored. idx_orgn is taken from the first step if not provided.
+    """
+    if fields is None:
+        fields = [var for var in io107.FIELDS107 if var != 'idx_back']
+    filters = tables.Filters(complevel=complevel, complib='blosc:lz4', shuffle=True)
+    with TrajStore(store_file) as store:
+        head = store.head(store.hours[0])
+        numpart = head['numpart']
+        if idx_orgn is None:
+            idx_orgn = head['idx_orgn']
+        # first pass: number of records per parcel
+        count = np.zeros(numpart, dtype=np.int64)
+        for hour in store.hours:
+            idx = store.readpart(hour, fields=['idx_back'])['idx_back']
+            count += np.bincount(idx-idx_orgn, minlength=numpart)
+        offsets = np.zeros(numpart+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(count)
+        del count
+        h5 = tables.open_file(parcel_file, mode='w')
+        try:
+            h5.create_array('/', 'offsets', offsets)
+            h5.root._v_attrs.numpart = numpart
+            h5.root._v_attrs.idx_orgn = idx_orgn
+            h5.root._v_attrs.fields = fields
+            cols = {}
+            for var, dtype in [('hour', np.dtype('int32'))] + [(var, _native(var)) for var in fields]:
+                cols[var] = h5.create_earray('/', var, tables.Atom.from_dtype(dtype),
+                                            shape=(0,), filters=filters, chunkshape=(CHUNK,),
+                                            expectedrows=offsets[-1])
+            # second pass by blocks of parcels, the end of each block is chosen
+            # from the offsets so that its records fit in max_bytes
+            max_records = max(1, max_bytes // sum(cols[var].atom.dtype.itemsize for var in cols))
+            i1 = 0
+            while i1 < numpart:
+                i2 = int(np.searchsorted(offsets, offsets[i1]+max_records, side='right')) - 1
+                i2 = min(max(i2, i1+1), numpart)
+                buf = {}
+                for var in cols:
+                    buf[var] = np.empty(offsets[i2]-offsets[i1], dtype=cols[var].atom.dtype)
+                fill = offsets[i1:i2] - offsets[i1]
+                for hour in store.hours:
+                    data = store.readpart(hour, fields+['idx_back'],
+                                          idx_range=[i1+idx_orgn, i2+idx_orgn])
+                    if data['nact'] == 0: continue
+                    j = data['idx_back'] - idx_orgn - i1
+                    pos = fill[j]
+                    buf['hour'][pos] = hour
+                    for var in fields:
+                        buf[var][pos] = data[var]
+                    fill[j] += 1
+                for var in cols:
+                    cols[var].append(buf[var])
+                del buf
+                if not quiet: print('transposed parcels ', i1, i2)
+                i1 = i2
+        finally:
+            h5.close()
+    return
+
+class ParcelStore(object):
+    """ Read access to a parcel-major store produced by transpose """
+    def __init__(self, parcel_file):
+        self.h5 = tables.open_file(parcel_file, mode='r')
+        self.offsets = self.h5.root.offsets.read()
+        self.numpart = int(self.h5.root._v_attrs.numpart)
+        self.idx_orgn = int(self.h5.root._v_attrs.idx_orgn)
+        self.fields = list(self.h5.root._v_attrs.fields)
+
+    def close(self):
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def read(self, i1, i2, fields=None):
+        """ Reads the trajectories of the parcels i1 to i2-1 (counted from 0).
+        Returns the offsets relative to the first record of parcel i1,
+        of length i2-i1+1, and a dictionary of the fields including hour. """
+        if fields is None: fields = self.fields
+        j1 = self.offsets[i1]
+        j2 = self.offsets[i2]
+        data = {}
+        for var in ['hour'] + list(fields):
+            data[var] = self.h5.get_node('/', var).read(j1, j2)
+        return self.offsets[i1:i2+1] - j1, data
+
+    def blocks(self, block, fields=None):
+        """ Generator of (i1, offsets, data) over blocks of block parcels """
+        for i1 in range(0, self.numpart, block):
+            i2 = min(i1+block, self.numpart)
+            offsets, data = self.read(i1, i2, fields)
+            yield i1, offsets, data
+
+@jit(nopython=True, parallel=True, cache=True)
+def segstats(values, offsets):
+    """ Count, mean, min and max of values over each segment
+    values[offsets[i]:offsets[i+1]], in parallel over the segments.
+    Empty segments get a zero count and NaN statistics. """
+    n = len(offsets) - 1
+    count = np.zeros(n, dtype=np.int32)
+    vmean = np.full(n, np.nan)
+    vmin = np.full(n, np.nan)
+    vmax = np.full(n, np.nan)
+    for i in prange(n):
+        j1 = offsets[i]
+        j2 = offsets[i+1]
+        if j2 > j1:
+            s = 0.
+            a = values[j1]
+            b = values[j1]
+            for j in range(j1, j2):
+                s += values[j]
+                a = min(a, values[j])
+                b = max(b, values[j])
+            count[i] = j2 - j1
+            vmean[i] = s / (j2 - j1)
+            vmin[i] = a
+            vmax[i] = b
+    return count, vmean, vmin, vmax
+
+def _native(var):
+    """ Native dtype of a field of the 107 format """
+    return np.dtype(io107.DTYPES107[var]).newbyteorder('=')
+
+def _search(col, i1, i2, value):
+    """ First position in col[i1:i2] (sorted) with col >= value """
+    while i1 < i2:
+        im = (i1 + i2) // 2
+        if col[im] < value:
+            i1 = im + 1
+        else:
+            i2 = im
+    return i1
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("run_dir",type=str,help="directory of the run")
+    parser.add_argument("store_file",type=str,help="HDF5 store")
+    parser.add_argument("-c","--complevel",type=int,default=5,help="compression level")
+    parser.add_argument("-t","--transpose",type=str,help="parcel-major store to be generated")
+    args = parser.parse_args()
+    ingested = ingest(args.run_dir, args.store_file, complevel=args.complevel, quiet=False)
+    print('number of ingested steps ', len(ingested))
+    if args.transpose is not None:
+        transpose(args.store_file, args.transpose, complevel=args.complevel, quiet=False)